@@ -1,14 +1,30 @@
 from trial import trial
 from typing import Dict, List, Optional, Tuple, Any
 import numpy as np
+import itertools
 import json
+import logging
 from collections import defaultdict, deque
+import conc_matrix
+import formulation
+import inventory
+import snapshot
+import table_ingest
+from compact import NameTable, CompactMap
+from table_order import SortedKeys
+import topo_order
+from topo_order import TopologicalOrder
+from transaction import CompositeTransaction
+from metrics import logger, timed_stage
 
 class Experiment:
+    # 进程内唯一的实验编号，同一 rootId 被重新创建时也不会与旧实验的缓存混淆
+    _uid_counter = itertools.count(1)
 
-    def __init__(self, name, sample_dict: Dict[str, List[Any]]  = {},
-                 substance_dict: Dict[str, List[Any]] = {},
-                 id_trial_name: Dict[str, str] = {}, table_id=None, extra_info=None, date=None):
+    def __init__(self, name, sample_dict: Dict[str, List[Any]] = None,
+                 substance_dict: Dict[str, List[Any]] = None,
+                 id_trial_name: Dict[str, str] = None, table_id=None, extra_info=None, date=None,
+                 conc_engine="dict", recompute_mode="full"):
         """
         这里需要一个id管理系统，与前端挂钩
         :param name:
@@ -18,33 +34,64 @@ class Experiment:
         :param substance_dict: 就是所有的substance名字为键，substance的值为列表[id，路由]
         :param extra_info:
         :param date:
+        :param conc_engine: 浓度计算引擎，"dict"为逐个trial的字典计算，"matrix"为基于numpy的整体矩阵求解，
+                            "parallel"为按弱连通分量拆分后把大分量交给进程池用矩阵方法求解（见 parallel_* 属性）
+        :param recompute_mode: recompute_concentrations 的方式，"full"为全部重算，"incremental"为只重算被修改trial及其下游
         """
         self.name = name
-        self.sample_dict = sample_dict
+        self.sample_dict = sample_dict if sample_dict is not None else {}
         ##sample_dict 是名字：地址，用来储存所有相关sample访问方式
-        self.substance_dict = substance_dict
+        self.substance_dict = substance_dict if substance_dict is not None else {}
         ##substance_dict 是名字：地址，用来储存所有相关sample访问方式，则为仅有名字的简单物质记录
         self.table_id = table_id if table_id else Experiment.generate_serial_number()
-        self.id_trial_name = id_trial_name
+        self.id_trial_name = id_trial_name if id_trial_name is not None else {}
         self.extra_info = extra_info if extra_info is not None else {}
         self.date = date
+        self.conc_engine = conc_engine
+        self.recompute_mode = recompute_mode
+        ##"parallel" 引擎的参数：非stock试样少于 parallel_min_trials 时直接在本进程用矩阵引擎；
+        ##不少于 parallel_min_component 个试样的分量才交给进程池；parallel_workers 为进程数（None 为CPU核数）
+        self.parallel_min_trials = 20000
+        self.parallel_min_component = 2000
+        self.parallel_workers = None
+        ##dirty_trials 是自上次重算后被修改过的trial名字，增量重算时从它们沿master向下游传播
+        self.dirty_trials = set()
+        self.recompute_stats = {"requests": 0, "last_dirty": 0, "last_recomputed": 0, "total_recomputed": 0}
+        ##substance_index 是 物质名：{trial名：浓度} 的倒排索引，只含浓度>0的trial，随trial的增删、改名和浓度重算增量维护
+        self.substance_index: Dict[str, Dict[str, float]] = {}
+        ##_sorted_index_cache 是 物质名：按浓度从高到低排好的[(trial名，浓度)]，该物质的索引变化时失效
+        self._sorted_index_cache: Dict[str, List[Tuple[str, float]]] = {}
+        ##substance_columns 是浓度表的列：所有trial的 substance_conc 中出现的物质（含浓度为0的），计数为含有它的trial数；
+        ##trial_rows 是浓度表的行：全部trial名。两者都按名字排好序并随增删改名增量维护，渲染时不再收集、排序（见 table_order.py）
+        self.substance_columns = SortedKeys()
+        self.trial_rows = SortedKeys()
+        ##composite_order 是全部trial的拓扑顺序（组分在使用者之前），加组分时在线调整并拒绝会形成循环的边，
+        ##dict 引擎重算浓度时直接按它的顺序而不再排序（见 topo_order.py）
+        self.composite_order = TopologicalOrder(self.sample_dict)
+        ##trial_name_table/substance_name_table 是本实验的名字驻留表，trial 的 composite/master/substance_conc 以其中的整数id为键紧凑存储
+        self.trial_name_table = NameTable()
+        self.substance_name_table = NameTable()
+        ##version 在每次修改（trial增删改名、组分、浓度）时递增，与 uid 一起作为渲染结果缓存与 ETag 的键
+        self.uid = next(Experiment._uid_counter)
+        self.version = 0
+        self.rebuild_substance_index()
 
     def get_trial(self, trial_name=None, trial_id=None):
         if trial_name:
             if trial_name not in self.sample_dict:
-                print(f"trial_name {trial_name} not found in sample_dict")
+                logger.warning("trial_name %s not found in sample_dict", trial_name)
             trial_in_sample_dict = self.sample_dict[trial_name]
             the_trial = trial_in_sample_dict[1]
             return the_trial
         elif trial_id:
             if trial_id not in self.id_trial_name:
-                print(f"trial_id {trial_id} not found in id_trial_name")
+                logger.warning("trial_id %s not found in id_trial_name", trial_id)
             trial_name = self.id_trial_name[trial_id]
             trial_in_sample_dict = self.sample_dict[trial_name]
             the_trial = trial_in_sample_dict[1]
             return the_trial
         else:
-            print("Either trial_name or trial_id must be provided")
+            logger.warning("Either trial_name or trial_id must be provided")
 
 
     @staticmethod
@@ -57,36 +104,116 @@ class Experiment:
         return "Experiment-" + str(random.randint(10000000, 99999999))
 
     def gen_substance_trial_dict(self):
-        returning_dict = {}
-        for trial_keys, trial_lists in self.sample_dict.items():
-            the_trial = trial_lists[1]
-            for substance_name, substance_concs in the_trial.substance_conc.items():
-                if substance_concs > 0:
-                    if substance_name in returning_dict:
-                        returning_dict[substance_name].append(trial_keys)
-                    else:
-                        returning_dict[substance_name] = [trial_keys]
+        """物质：[含有该物质（浓度>0）的trial名]，直接由 substance_index 得到，不再扫描全部trial"""
+        returning_dict = {
+            substance_name: list(trials_of_substance)
+            for substance_name, trials_of_substance in self.substance_index.items()
+        }
         self.extra_info["substance_trial_dict"] = returning_dict
         return returning_dict
 
+    def bump_version(self):
+        """实验内容有变化，此前按版本缓存的表格随之失效"""
+        self.version += 1
+
+    def rebuild_substance_index(self):
+        """从 sample_dict 全量重建 substance_index（并把trial绑定到本实验的名字驻留表），仅在直接批量改写 sample_dict 之后需要调用"""
+        self.bump_version()
+        self.substance_index = {}
+        self._sorted_index_cache = {}
+        self.substance_columns = SortedKeys()
+        self.trial_rows = SortedKeys(dict.fromkeys(self.sample_dict, 1))
+        self.composite_order.invalidate()
+        for trial_name, trial_lists in self.sample_dict.items():
+            trial_lists[1].bind_name_tables(self.trial_name_table, self.substance_name_table)
+            self._index_substance_conc(trial_name, trial_lists[1].substance_conc)
+
+    def _index_substance_conc(self, trial_name, substance_conc, columns=True):
+        """:param columns: 是否同时计入 substance_columns（set_substance_conc 只在物质集合变化时另行调整）"""
+        if columns:
+            add_column = self.substance_columns.add
+            for substance_name in substance_conc:
+                add_column(substance_name)
+        for substance_name, conc in substance_conc.items():
+            if conc > 0:
+                self.substance_index.setdefault(substance_name, {})[trial_name] = conc
+                self._sorted_index_cache.pop(substance_name, None)
+
+    def _unindex_substance_conc(self, trial_name, substance_conc, columns=True):
+        if columns:
+            discard_column = self.substance_columns.discard
+            for substance_name in substance_conc:
+                discard_column(substance_name)
+        for substance_name in substance_conc:
+            trials_of_substance = self.substance_index.get(substance_name)
+            if trials_of_substance is not None and trial_name in trials_of_substance:
+                del trials_of_substance[trial_name]
+                self._sorted_index_cache.pop(substance_name, None)
+                if not trials_of_substance:
+                    del self.substance_index[substance_name]
+
+    def set_substance_conc(self, the_trial: trial, substance_conc: Dict[str, float]):
+        """修改trial浓度的统一入口，同时维护 substance_index 与 substance_columns"""
+        old_substances = list(the_trial.substance_conc.keys())
+        self._unindex_substance_conc(the_trial.name, old_substances, columns=False)
+        the_trial.substance_conc = substance_conc
+        self._index_substance_conc(the_trial.name, substance_conc, columns=False)
+        # 重算浓度通常不改变含有的物质（且顺序相同），此时列的计数不变
+        new_substances = list(substance_conc.keys())
+        if old_substances != new_substances and set(old_substances) != set(new_substances):
+            for substance_name in old_substances:
+                self.substance_columns.discard(substance_name)
+            for substance_name in new_substances:
+                self.substance_columns.add(substance_name)
+        self.bump_version()
+
+    def trials_by_concentration(self, substance_name, min_conc=0.0) -> List[Tuple[str, float]]:
+        """
+        含有某物质的trial，按该物质浓度从高到低排列
+        :param substance_name: 物质名
+        :param min_conc: 只返回浓度不低于此值的trial
+        :return: [(trial名, 浓度)]
+        """
+        sorted_trials = self._sorted_index_cache.get(substance_name)
+        if sorted_trials is None:
+            sorted_trials = sorted(self.substance_index.get(substance_name, {}).items(),
+                                   key=lambda item: item[1], reverse=True)
+            self._sorted_index_cache[substance_name] = sorted_trials
+        if min_conc > 0:
+            return [item for item in sorted_trials if item[1] >= min_conc]
+        return list(sorted_trials)
+
 
     def generate_trial(self, the_trial):
         #总之这里就是你得先创建一个trial再加进来
-        print(f"generate_trial: Adding trial: id: {the_trial.id}, name:{the_trial.name} into Experiment {self.name}")
-        self.sample_dict[the_trial.name] = [the_trial.id, the_trial]
+        logger.debug("generate_trial: Adding trial: id: %s, name:%s into Experiment %s", the_trial.id, the_trial.name, self.name)
+        if the_trial.composite:
+            # 带组分登记（如 _create_final_trial）时与整批登记相同：先经事务检查组分关系（不形成循环），再修改 sample_dict
+            self.generate_trials_bulk([the_trial])
+            return
+        # 先移除占用同一id的原trial，再登记新trial，避免同名时把新trial一起删掉
         if the_trial.id in self.id_trial_name:
             ori_trial_name = self.id_trial_name[the_trial.id]
             ori_trial = self.sample_dict[ori_trial_name][1]
             self.remove_trial(ori_trial)
-            del self.id_trial_name[the_trial.id]
+        if the_trial.name in self.sample_dict:
+            self._unindex_substance_conc(the_trial.name, self.sample_dict[the_trial.name][1].substance_conc)
+        else:
+            self.trial_rows.add(the_trial.name)
+        the_trial.bind_name_tables(self.trial_name_table, self.substance_name_table)
+        self.sample_dict[the_trial.name] = [the_trial.id, the_trial]
+        self.composite_order.add(the_trial.name)
+        self._index_substance_conc(the_trial.name, the_trial.substance_conc)
         self.id_trial_name[the_trial.id] = the_trial.name
+        self.dirty_trials.add(the_trial.name)
+        self.bump_version()
         for keys, conc_num in the_trial.substance_conc.items():
             if keys not in self.substance_dict:
                 self.substance_dict[keys] = []
 
     def remove_trial(self, the_trial:trial, trial_name = None, keep_substance = False):
         #keep_substance 0 and 1, whether keep the substances，从substance_dict中抹除
-        print(f"removing trial {the_trial.name}, {the_trial.id}")
+        logger.debug("removing trial %s, %s", the_trial.name, the_trial.id)
         if the_trial:
             trial_obj = the_trial
         else:
@@ -94,22 +221,25 @@ class Experiment:
 
         del self.id_trial_name[trial_obj.id]
         del self.sample_dict[trial_obj.name]
+        self.trial_rows.discard(trial_obj.name)
+        self.composite_order.discard(trial_obj.name)
+        self._unindex_substance_conc(trial_obj.name, trial_obj.substance_conc)
+        self.dirty_trials.discard(trial_obj.name)
+        self.mark_dirty(*trial_obj.master)
+        self.bump_version()
 
         if not keep_substance:
-            substance_trial_dict = self.gen_substance_trial_dict()
-            for substances, trial_lists in substance_trial_dict.items():
-                if trial_name in trial_lists:
-                    trial_lists.remove(trial_name)
-            for substances, trial_lists in substance_trial_dict.items():
-                if trial_lists == []:
-                    del self.substance_dict[substances]
+            # 已没有任何trial含有的物质从substance_dict中移除
+            for substances in trial_obj.substance_conc:
+                if substances not in self.substance_index:
+                    self.substance_dict.pop(substances, None)
         else:
             pass
 
     def change_trial_name(self, new_trial_name:str, trial_id : str = None, ori_trial_name:str = None, ori_trial:trial =None):
         ##修改一个id所对应的trial的名字及其相关，不含trial中互作的情况
         if trial_id is None and ori_trial_name is None and ori_trial is None:
-            print("No original trial info input to change name")
+            logger.warning("No original trial info input to change name")
 
         if ori_trial:
             ori_trial_name = ori_trial.name
@@ -123,26 +253,37 @@ class Experiment:
         list_trial = self.sample_dict[ori_trial_name]
         del (self.sample_dict[ori_trial_name])
         self.sample_dict[new_trial_name] = list_trial
-
-        print(f"name of trial changed: {ori_trial_name} into {new_trial_name}")
-
-
+        self.trial_rows.discard(ori_trial_name)
+        self.trial_rows.add(new_trial_name)
+        self.composite_order.rename(ori_trial_name, new_trial_name)
+        self._unindex_substance_conc(ori_trial_name, ori_trial.substance_conc)
+        self._index_substance_conc(new_trial_name, ori_trial.substance_conc)
+        self.id_trial_name[list_trial[0]] = new_trial_name
+        # 同步trial自身的名字以及上下游composite/master中的引用，保证master反向引用可用于增量重算
+        ori_trial.change_name(new_trial_name, self.sample_dict)
+        if ori_trial_name in self.dirty_trials:
+            self.dirty_trials.discard(ori_trial_name)
+            self.dirty_trials.add(new_trial_name)
+        self.bump_version()
+
+        logger.debug("name of trial changed: %s into %s", ori_trial_name, new_trial_name)
+
+
+    @timed_stage("stock_from_2d_array")
     def stock_from_2d_array(self,
         stacked_chem_op_2D_array: Dict[str, Dict[str, float]],
         id_array: [List[str]] = None):
-        print("success getting into stock_from_2d_array")
+        logger.debug("success getting into stock_from_2d_array")
         num_trials = len(stacked_chem_op_2D_array)
         if id_array is None or "":
             id_array = [Experiment.generate_serial_number() + str(i) for i in range(num_trials)]
         if len(id_array) != num_trials:
-            print("stock_from_2d_array: id_array长度必须与输入数据行数一致")
+            logger.warning("stock_from_2d_array: id_array长度必须与输入数据行数一致")
             id_array = [Experiment.generate_serial_number() + str(i) for i in range(num_trials)]
         #创建所有stock
         try:
             for (trial_name, substance_dict), trial_id in zip(
                 stacked_chem_op_2D_array.items(), id_array):
-                    print("stock_creation initialized")
-
                     if len(substance_dict) == 0 or substance_dict is None:
                         new_trial = trial(
                             name=trial_name,
@@ -162,35 +303,57 @@ class Experiment:
                         )
                     #将试样添加到实验（假设generate_trial处理注册到sample_dict）
                     if trial_name in self.sample_dict:
-                        self.sample_dict[trial_name][1] = new_trial
+                        # 原地更新已有stock，保留其master反向引用，只有浓度变化时才标记为dirty
+                        existing_trial = self.sample_dict[trial_name][1]
+                        if existing_trial.substance_conc != new_trial.substance_conc or not existing_trial.stock:
+                            self.mark_dirty(trial_name)
+                        self.set_substance_conc(existing_trial, new_trial.substance_conc)
+                        existing_trial.stock = True
+                        existing_trial.solvent = new_trial.solvent
+                        new_trial = existing_trial
+                        for keys in new_trial.substance_conc:
+                            if keys not in self.substance_dict:
+                                self.substance_dict[keys] = []
                     else:
                         self.generate_trial(new_trial)
-                    print(f"stock generated: {new_trial}, name: {new_trial.name}, substance_conc: {new_trial.substance_conc}\n")
+                    logger.debug("stock generated: %s, name: %s, substance_conc: %s", new_trial, new_trial.name, new_trial.substance_conc)
 
         except Exception as e:
-            print("stock generation failed from stock_from_2d_array")
+            logger.error("stock generation failed from stock_from_2d_array")
             raise RuntimeError(f"创建试样失败: {str(e)}") from e
 
 
+    @timed_stage("new_exp_from_2d_array")
     def new_exp_from_2d_array(
         self,
         stacked_chem_op_2D_array,
-        id_array: List[str] = None,) -> None:
-        print("success getting into new_exp_from_2d_array")
+        id_array: List[str] = None,
+        row_changed: List[int] = None,
+        check_inventory: bool = True) -> Dict[str, int]:
+        logger.debug("success getting into new_exp_from_2d_array")
         """
-        从二维字典结构批量创建试样并建立组分关系（优化后版本）
+        从二维字典结构批量创建试样并建立组分关系（按行差分更新版本）
+        以试样名作为稳定的行标识，与当前 sample_dict/composite 比较，只增删改发生变化的行和组分关系，不再清空重建
 
         Args:
             stacked_chem_op_2D_array: 外层键为试样名，内层键为组分名，值为用量。
                                      示例: {"Sample1": {"Water": 10.0, "Salt": 5.0}}
-            id_array: 每个试样的ID列表，长度需与stacked_chem_op_2D_array一致，必选，根据这个调整或创建
-            changed_rows: 与id array同长度，顺序地用1表示“该行内容被修改过”，0为“未被修改”
+                                     也可以是 table_ingest.IngestedTable（同样的映射，由矩阵按行生成）
+            id_array: 每个试样的ID列表，长度需与stacked_chem_op_2D_array一致，根据这个调整或创建；
+                      某行名字是新的、而其id对应的原试样名已不在表中时，视为对原试样改名
+            row_changed: 与id array同长度，顺序地用1表示“该行内容被修改过”，0为“未被修改”，为0的已有行直接跳过
+            check_inventory: 为 True 时先一次检查有限量试样的总用量（inventory.check_submission），超量时不做任何修改
+        Returns:
+            各类变化的行数 {"renamed": , "removed": , "added": , "modified": }
         Raises:
             ValueError: 输入数据格式错误或依赖缺失
+            inventory.InventoryError: 有限量的试样被超量使用
+            topo_order.CycleError: 提交后的组分关系有循环
             还需要考虑到stock的问题，因为stock会在conc表格更新后加入到exp表格，也许在此时进行一次update_exp
         """
+        summary = {"renamed": 0, "removed": 0, "added": 0, "modified": 0}
         if not stacked_chem_op_2D_array:
-            return  # 无数据直接返回
+            return summary  # 无数据直接返回
 
         # 预处理ID数组
         num_trials = len(stacked_chem_op_2D_array)
@@ -198,139 +361,378 @@ class Experiment:
             fake_root = Experiment.generate_serial_number()
             id_array = [fake_root + str(i) for i in range(num_trials)]
         elif len(id_array) != num_trials:
-            print("new_exp_from_2d_array: id_array长度必须与输入数据行数一致")
+            logger.warning("new_exp_from_2d_array: id_array长度必须与输入数据行数一致")
             fake_root = Experiment.generate_serial_number()
             id_array = [fake_root + str(i) for i in range(num_trials)]
+        if row_changed is not None and len(row_changed) != num_trials:
+            row_changed = None
 
-        # 第零阶段：清空自身除stock外trial
-        print("new_exp_from_2d_array: starting, phase 0 clearing")
-        keys_to_remove = []
-        for names, id_adds in self.sample_dict.items():
-            the_trial = id_adds[1]
-            if the_trial.stock and names in stacked_chem_op_2D_array:
-                pass
-            else:
-                keys_to_remove.append(names)
-
-        for key in keys_to_remove:
-            id_adds = self.sample_dict[key]
-            self.sample_dict.pop(key)
-            self.id_trial_name.pop(id_adds[0])
+        existed_before = set(self.sample_dict)
 
-        # 第一阶段：创建所有试样
-        print("new_exp_from_2d_array: starting, phase 1 generating")
+        # 新名字的行若其id对应的原试样已不在表中，则沿用原试样（改名）
+        renames, renamed_from = {}, set()
+        for trial_name, trial_id in zip(stacked_chem_op_2D_array, id_array):
+            if trial_name in self.sample_dict:
+                continue
+            ori_trial_name = self.id_trial_name.get(trial_id)
+            if ori_trial_name in self.sample_dict and ori_trial_name not in stacked_chem_op_2D_array \
+                    and ori_trial_name not in renamed_from:
+                renames[trial_name] = ori_trial_name
+                renamed_from.add(ori_trial_name)
+
+        skipped = None
+        if row_changed is not None:
+            skipped = {trial_name for row_index, trial_name in enumerate(stacked_chem_op_2D_array)
+                       if not row_changed[row_index] and (trial_name in existed_before or trial_name in renames)}
+        # 在修改任何状态之前检查组分与用量，后面各阶段不会因输入数据出错而停在中途
+        self._check_table_components(stacked_chem_op_2D_array, skipped)
+        self._check_table_cycles(stacked_chem_op_2D_array, renames, skipped)
+        if check_inventory:
+            inventory.check_submission(self, stacked_chem_op_2D_array, aliases=renames, skipped=skipped)
+
+        # 以下各阶段中途出错时按撤销记录整体恢复（见 _undo_table_submission），提交要么全部生效要么不生效
+        undo = {"items": list(self.sample_dict.items()), "id_trial_name": dict(self.id_trial_name),
+                "dirty_trials": set(self.dirty_trials), "renamed": [], "detach": None, "removed": [], "added": []}
         try:
-            for (trial_name, composite_dict), trial_id in zip(
-                stacked_chem_op_2D_array.items(), id_array
-            ):
-
-
-                if trial_id in self.id_trial_name:
-                    the_trial_name = self.id_trial_name[trial_id]
-                    the_trial = self.sample_dict[the_trial_name][1]
-                    self.change_trial_name(trial_name, ori_trial= the_trial)
-
-                else:
-                    # 创建试样实例（假设Trial类已正确定义）
+            # 第一阶段：改名
+            logger.debug("new_exp_from_2d_array: starting, phase 1 renaming")
+            for trial_name, ori_trial_name in renames.items():
+                the_trial = self.sample_dict[ori_trial_name][1]
+                self.change_trial_name(trial_name, ori_trial=the_trial)
+                undo["renamed"].append((the_trial, ori_trial_name))
+                existed_before.add(trial_name)
+                summary["renamed"] += 1
+
+            # 第二阶段：删除表中已不存在的试样，其所有组分关系在一个 CompositeTransaction 中一次解除
+            logger.debug("new_exp_from_2d_array: starting, phase 2 removing")
+            removed = [name for name in self.sample_dict if name not in stacked_chem_op_2D_array]
+            if removed:
+                undo["detach"] = self.transaction(check_inventory=False)
+                for trial_name in removed:
+                    undo["detach"].detach(trial_name)
+                undo["detach"].commit()
+            for trial_name in removed:
+                id_adds = self.sample_dict.pop(trial_name)
+                undo["removed"].append((trial_name, id_adds))
+                self.trial_rows.discard(trial_name)
+                self.composite_order.discard(trial_name)
+                self._unindex_substance_conc(trial_name, id_adds[1].substance_conc)
+                self.id_trial_name.pop(id_adds[0], None)
+                self.dirty_trials.discard(trial_name)
+                summary["removed"] += 1
+
+            # 第三阶段：创建新增的试样
+            logger.debug("new_exp_from_2d_array: starting, phase 3 generating")
+            try:
+                for trial_name, trial_id in zip(stacked_chem_op_2D_array, id_array):
+                    if trial_name in self.sample_dict:
+                        continue
+                    if trial_id in self.id_trial_name:
+                        # 行号生成的id可能已被保留下来的其他试样占用，此时另起一个id，避免generate_trial覆盖该试样
+                        trial_id = f"{trial_id}_{Experiment.generate_serial_number()}"
                     new_trial = trial(
-                    name=trial_name,
-                    exp_name=self.name,
-                    id=trial_id,
-                    composite={},  # 先初始化空字典，后续填充
+                        name=trial_name,
+                        exp_name=self.name,
+                        id=trial_id,
+                        composite={},  # 先初始化空字典，后续填充
                     )
-                    #将试样添加到实验（假设generate_trial处理注册到sample_dict）
                     self.generate_trial(new_trial)
-        except Exception as e:
-            raise RuntimeError(f"创建试样失败: {str(e)}") from e
-        print("new_exp_from_2d_array: Success creating trials","\n","self sample_dict:",self.sample_dict)
-        # 第二阶段：建立组分关系
-        for (trial_name, composite_dict), trial_id in zip(
-                stacked_chem_op_2D_array.items(), id_array,
-        ):
+                    undo["added"].append(new_trial)
+                    summary["added"] += 1
+            except Exception as e:
+                raise RuntimeError(f"创建试样失败: {str(e)}") from e
+
+            # 第四阶段：逐行比较，发生变化的组分关系在一个 CompositeTransaction 中一次更新（它自己出错时已经回滚）
+            logger.debug("new_exp_from_2d_array: starting, phase 4 composing")
+            with self.transaction(check_inventory=False) as changes:
+                for row_index, trial_name in enumerate(stacked_chem_op_2D_array):
+                    if row_changed is not None and not row_changed[row_index] and trial_name in existed_before:
+                        continue
+                    # 跳过的行不取出其组分字典（IngestedTable 在取出时才由矩阵生成）
+                    changes.set_composite(trial_name, stacked_chem_op_2D_array[trial_name])
+            summary["modified"] = len(changes.changed)
+        except BaseException:
+            self._undo_table_submission(undo)
+            logger.error("new_exp_from_2d_array: 提交出错，已恢复提交之前的状态")
+            raise
+
+        logger.debug("new_exp_from_2d_array: done, %s", summary)
+        return summary
+
+    def _undo_table_submission(self, undo):
+        """
+        按 new_exp_from_2d_array 的撤销记录恢复提交之前的状态：删去新建的试样，放回被删除的试样并恢复解除的组分关系，
+        把改名改回去，最后按原来的顺序恢复 sample_dict 并重建索引
+        """
+        for new_trial in reversed(undo["added"]):
+            if self.sample_dict.get(new_trial.name, [None, None])[1] is new_trial:
+                self.remove_trial(new_trial)
+        for trial_name, id_adds in undo["removed"]:
+            self.sample_dict[trial_name] = id_adds
+        if undo["detach"] is not None:
+            undo["detach"].revert()
+        for the_trial, ori_trial_name in reversed(undo["renamed"]):
+            self.change_trial_name(ori_trial_name, ori_trial=the_trial)
+        self.sample_dict.clear()
+        self.sample_dict.update(undo["items"])
+        self.id_trial_name = undo["id_trial_name"]
+        self.rebuild_substance_index()
+        self.dirty_trials = undo["dirty_trials"]
+        self.mark_dirty(*(trial_name for trial_name, _ in undo["removed"]))
+
+    def _check_table_components(self, stacked_chem_op_2D_array, skipped=None):
+        """
+        整表提交中要更新的行所用的组分须是表中的行（表中没有的试样会被删除）
+        IngestedTable 只检查不在行名中的那几列有没有数值
+        :param skipped: 不更新的行名
+        :raises ValueError: 组分不在表中
+        """
+        skipped = skipped or ()
+        if isinstance(stacked_chem_op_2D_array, table_ingest.IngestedTable):
+            table = stacked_chem_op_2D_array
+            missing = [j for j, column in enumerate(table.columns) if column not in table]
+            if not missing:
+                return
+            rows = slice(None)
+            if skipped or len(table) != len(table.rows):
+                rows = [table.index_of(name) for name in table if name not in skipped]
+            for j in missing:
+                if table.mask[rows, j].any():
+                    raise ValueError(f"组分 {table.columns[j]} 未找到，请检查输入数据")
+            return
+        for trial_name, composite_dict in stacked_chem_op_2D_array.items():
+            if trial_name in skipped:
+                continue
+            for composite_name, composite_num in composite_dict.items():
+                if composite_name not in stacked_chem_op_2D_array and isinstance(composite_num, (int, float)):
+                    raise ValueError(f"组分 {composite_name} 未找到，请检查输入数据")
 
+    def _check_table_cycles(self, stacked_chem_op_2D_array, renames, skipped=None):
+        """
+        整表提交之后的组分关系图（更新的行取表中的组分，跳过的行保留当前的组分，不在表中的试样被删除）中不能有循环
+        在改名、删除之前对整张图做一次排序（IngestedTable 直接取矩阵中有值的单元格）
+        :param renames: {新名字: 原试样名}
+        :param skipped: 不更新的行名
+        :raises topo_order.CycleError: 表中有循环
+        """
+        skipped = skipped or ()
+        names = list(stacked_chem_op_2D_array)
+        node = {name: i for i, name in enumerate(names)}
+        edge_row, edge_col = [], []
+        if isinstance(stacked_chem_op_2D_array, table_ingest.IngestedTable):
+            table = stacked_chem_op_2D_array
+            node_of_row = np.full(len(table.rows), -1, dtype=np.int64)
+            for name, i in node.items():
+                if name not in skipped:
+                    node_of_row[table.index_of(name)] = i
+            node_of_column = np.asarray([node.get(column, -1) for column in table.columns], dtype=np.int64)
+            r, c = np.nonzero(table.mask)
+            rows, columns = node_of_row[r], node_of_column[c]
+            keep = (rows >= 0) & (columns >= 0)
+            edge_row.append(rows[keep])
+            edge_col.append(columns[keep])
+        else:
+            for name, composite_dict in stacked_chem_op_2D_array.items():
+                if name in skipped:
+                    continue
+                for component, amount in composite_dict.items():
+                    if component in node and isinstance(amount, (int, float)):
+                        edge_row.append(node[name])
+                        edge_col.append(node[component])
+            edge_row, edge_col = [np.asarray(edge_row, dtype=np.int64)], [np.asarray(edge_col, dtype=np.int64)]
+        if skipped:
+            new_name = {ori_trial_name: trial_name for trial_name, ori_trial_name in renames.items()}
+            kept_row, kept_col = [], []
+            for name in skipped:
+                for component in self.sample_dict[renames.get(name, name)][1].composite:
+                    component = new_name.get(component, component)
+                    if component in node:
+                        kept_row.append(node[name])
+                        kept_col.append(node[component])
+            edge_row.append(np.asarray(kept_row, dtype=np.int64))
+            edge_col.append(np.asarray(kept_col, dtype=np.int64))
+        path = topo_order.cycle_path(len(names), np.concatenate(edge_row), np.concatenate(edge_col))
+        if path is not None:
+            raise topo_order.CycleError([names[i] for i in path])
+
+    @timed_stage("recipes_from_2d_array")
+    def recipes_from_2d_array(self, stacked_chem_op_2D_array, id_array: List[str] = None,
+                              check_inventory: bool = True) -> Dict[str, int]:
+        """
+        按行新增试样或覆盖已有试样的组分关系，用于批量导入（见 table_import.py）
+        与 new_exp_from_2d_array 不同，输入只需包含要导入的行，表中没有的试样保持不变（不删除、不改名）
 
-                try:
-                    subject_trial = self.get_trial(trial_id=trial_id)
-                except KeyError:
-                    raise ValueError(f"试样 {trial_id}:{trial_name} 未成功注册到sample_dict") from None
+        Args:
+            stacked_chem_op_2D_array: {试样名: {组分名: 用量}}，组分须为已有的试样或本输入中更早的行
+            id_array: 新增试样的ID，与输入同长度；None 时自动生成
+            check_inventory: 为 True 时先检查有限量试样的总用量，超量时抛出 inventory.InventoryError，不做任何修改
+        Returns:
+            {"added": , "modified": , "unchanged": }
+        """
+        summary = {"added": 0, "modified": 0, "unchanged": 0}
+        # 先检查组分都存在（已有的试样或更早的行）与用量，再创建试样、一次更新全部组分关系
+        known = set()
+        for trial_name, composite_dict in stacked_chem_op_2D_array.items():
+            known.add(trial_name)
+            for composite_name, composite_num in composite_dict.items():
+                if composite_name not in self.sample_dict and composite_name not in known \
+                        and isinstance(composite_num, (int, float)):
+                    raise ValueError(f"组分 {composite_name} 未找到，请检查输入数据")
+        if check_inventory:
+            inventory.check_submission(self, stacked_chem_op_2D_array, full_table=False)
+        if id_array is None or len(id_array) != len(stacked_chem_op_2D_array):
+            fake_root = Experiment.generate_serial_number()
+            id_array = [fake_root + str(i) for i in range(len(stacked_chem_op_2D_array))]
+        existing = set()
+        for trial_name, trial_id in zip(stacked_chem_op_2D_array, id_array):
+            if trial_name in self.sample_dict:
+                existing.add(trial_name)
+                continue
+            if trial_id in self.id_trial_name:
+                trial_id = f"{trial_id}_{Experiment.generate_serial_number()}"
+            self.generate_trial(trial(name=trial_name, exp_name=self.name, id=trial_id, composite={}))
+            summary["added"] += 1
+        with self.transaction(check_inventory=False) as changes:
+            for trial_name, composite_dict in stacked_chem_op_2D_array.items():
+                changes.set_composite(trial_name, composite_dict)
+        summary["modified"] = len(existing.intersection(changes.changed))
+        summary["unchanged"] = len(existing) - summary["modified"]
+        return summary
+
+    def transaction(self, check_inventory=True) -> CompositeTransaction:
+        """
+        暂存多个组分关系的增删，commit 时一次应用，出错时整体回滚，见 transaction.CompositeTransaction：
+            with the_exp.transaction() as changes:
+                changes.set_composite("T1", {"S1": 10.0})
+                changes.remove("T2", "S1")
+        :param check_inventory: commit 前是否检查有限量试样的总用量（inventory.check_submission）
+        """
+        return CompositeTransaction(self.sample_dict, the_exp=self, check_inventory=check_inventory)
+
+    def _detach_trial(self, the_trial: trial):
+        """解除一个试样与上下游的全部组分关系（归还用量、清理master），其下游试样标记为dirty"""
+        self.transaction(check_inventory=False).detach(the_trial).commit()
+        the_trial.master = {}
+
+    def mark_dirty(self, *trial_names):
+        """标记trial已被修改，下次增量重算时会重算它及其所有下游"""
+        self.dirty_trials.update(trial_names)
+        self.bump_version()
+
+    @timed_stage("recompute_concentrations")
+    def recompute_concentrations(self):
+        """按 self.recompute_mode 重算浓度，每次提交（exp/conc update）结束时调用"""
+        if self.recompute_mode == "incremental":
+            return self.update_dirty_concentrations()
+        return self.update_all_concentrations()
+
+    def _record_recompute(self, num_dirty, num_recomputed):
+        self.recompute_stats["requests"] += 1
+        self.recompute_stats["last_dirty"] = num_dirty
+        self.recompute_stats["last_recomputed"] = num_recomputed
+        self.recompute_stats["total_recomputed"] += num_recomputed
+
+    def dirty_closure(self, trial_names):
+        """
+        沿 trial.master（谁使用了该trial）求给定trial的下游闭包
+        :return: 闭包中的trial名字集合（不含已不在sample_dict中的名字）
+        """
+        closure = set()
+        queue = deque(name for name in trial_names if name in self.sample_dict)
+        closure.update(queue)
+        while queue:
+            the_trial = self.sample_dict[queue.popleft()][1]
+            for master_name in the_trial.master:
+                if master_name not in closure and master_name in self.sample_dict:
+                    closure.add(master_name)
+                    queue.append(master_name)
+        return closure
+
+    def _trials_in_order(self, names=None):
+        """
+        按 composite_order 维护的拓扑顺序排列的普通试样（不含stock/solvent），不再每次排序；
+        先线性核对它们的组分都排在前面，有代码直接改写过 composite 而顺序不对时重建一次
+        :param names: 只排列这些trial（增量重算的下游闭包），None 为全部
+        :raises ValueError: 存在循环依赖
+        """
+        order = self.composite_order
+        sample_dict = self.sample_dict
 
-                for composite_name, composite_num in subject_trial.composite.items():
-                    subject_trial.remove_from_composite(composite_name, -1, self.sample_dict)
+        def regular_in_order():
+            if names is None:
+                ordered = order.ordered()
+            else:
+                position = order.positions()
+                ordered = sorted(names, key=lambda name: position.get(name, -1))
+            return [name for name in ordered if sample_dict[name][1].is_regular_sample()]
+
+        ordered = regular_in_order()
+        if not order.consistent(ordered):
+            cyclic = order.rebuild()
+            if cyclic:
+                raise ValueError(f"存在循环依赖: 涉及试样 {cyclic[0]}")
+            ordered = regular_in_order()
+        return [sample_dict[name][1] for name in ordered]
+
+    @timed_stage("update_dirty_concentrations")
+    def update_dirty_concentrations(self):
+        """
+        增量重算：只重算 dirty_trials 及其沿master的下游闭包，闭包内按拓扑顺序计算，开销与修改规模成正比
+        """
+        logger.debug("success getting into update_dirty_concentrations; dirty trials: %s", self.dirty_trials)
+        num_dirty = len(self.dirty_trials)
+        closure = self.dirty_closure(self.dirty_trials)
+        self.dirty_trials = set()
 
-                for composite_name, composite_num in composite_dict.items():
-                    # 跳过无效数值
-                    if not isinstance(composite_num, (int, float)):
-                        print(f"警告: {composite_name} 的用量 {composite_num} 不是数字，已跳过")
-                        continue
+        # 闭包内按 composite_order 维护的拓扑顺序计算
+        sorted_trials = self._trials_in_order(closure)
 
-                    # 检查组分是否存在
-                    composite_trial = self.sample_dict.get(composite_name)
-                    if composite_trial is None:
-                        raise ValueError(f"组分 {composite_name} 未找到，请检查输入数据")
-
-                    # 添加组分关系（假设add_to_composite处理双向关联）
-                    try:
-                        subject_trial.add_to_composite(
-                            trial_name=composite_name,
-                            amount=float(composite_num),
-                            all_trials = self.sample_dict,
-                            regardless_of_negative_amount =True  # 假设支持用量验证
-                        )
-                    except ValueError as e:
-                        raise ValueError(
-                            f"试样 {trial_name} 添加组分 {composite_name} 失败: {str(e)}"
-                        ) from e
+        for the_trial in sorted_trials:
+            self._calculate_trial_concentration(the_trial)
+        self._record_recompute(num_dirty, len(sorted_trials))
 
+    @timed_stage("update_all_concentrations")
     def update_all_concentrations(self):
-        print(f"success getting into update_all_concentrations;\nself_sample_dict: {self.sample_dict}")
-        """更新所有试样的浓度（适配 sample_dict 结构）"""
-        trials = []
-        stock = {}
-        for v in self.sample_dict.values():
-            if len(v) == 2:
-                if not v[1].stock and not v[1].solvent:
-                    trials.append(v[1])
-                else:
-                    stock[v[0]] = v[1].substance_conc
-        if not trials:
+        logger.debug("success getting into update_all_concentrations; %d trials", len(self.sample_dict))
+        """更新所有试样的浓度（适配 sample_dict 结构），按 self.conc_engine 选择计算引擎"""
+        num_dirty = len(self.dirty_trials)
+        self.dirty_trials = set()
+        if self.conc_engine in ("matrix", "parallel"):
+            num_recomputed = self._update_all_concentrations_matrix(parallel=self.conc_engine == "parallel")
+            self._record_recompute(num_dirty, num_recomputed)
+            return
+        sorted_trials = self._trials_in_order()
+        if not sorted_trials:
+            self._record_recompute(num_dirty, 0)
             return
-        print(f"\nall current stocks v.s. concs: update_all_concentrations says stock: {stock}")
-        # 构建依赖图
-        adj = defaultdict(list)
-        in_degree = defaultdict(int)
-        for trial in trials:
-            for comp_name in trial.composite:
-                comp_entry = self.sample_dict.get(comp_name)
-                if not comp_entry:
-                    print(f"composite {comp_name} not found")
-                    continue
-                comp_trial = comp_entry[1]
-                if comp_trial in trials:
-                    adj[comp_trial].append(trial)
-                    in_degree[trial] += 1
-
-        # 拓扑排序
-        queue = deque([t for t in trials if in_degree.get(t, 0) == 0])
-        sorted_trials = []
-        while queue:
-            current = queue.popleft()
-            sorted_trials.append(current)
-            for neighbor in adj[current]:
-                in_degree[neighbor] -= 1
-                if in_degree[neighbor] == 0:
-                    queue.append(neighbor)
-
-        remaining_nodes = [t for t in trials if t not in sorted_trials]
-        for node in remaining_nodes:
-            if in_degree.get(node, 0) > 0:
-                raise ValueError(f"存在循环依赖: 涉及试样 {node.name}")
 
         # 计算浓度
         for trial in sorted_trials:
             self._calculate_trial_concentration(trial)
+        self._record_recompute(num_dirty, len(sorted_trials))
+
+    def _update_all_concentrations_matrix(self, parallel=False):
+        """
+        矩阵引擎：由 trial.composite 构建 trial×trial 混合矩阵，由stock的 substance_conc 构建 stock×substance 矩阵，
+        一次性求出所有浓度，结果与逐个 _calculate_trial_concentration 得到的 substance_conc 字典一致
+        :param parallel: 为 True 且试样数达到 parallel_min_trials 时，按弱连通分量拆分，大分量在进程池中求解
+        """
+        arrays = conc_matrix.collect_mixing_arrays(self.sample_dict)
+        if arrays["fixed"].all():
+            return 0
+        if parallel and (~arrays["fixed"]).sum() >= self.parallel_min_trials:
+            conc, mask, num_components, num_parallel = conc_matrix.solve_concentrations_by_component(
+                arrays, max_workers=self.parallel_workers, min_component=self.parallel_min_component)
+            logger.debug("parallel recompute: %d components, %d solved in the process pool", num_components, num_parallel)
+        else:
+            conc, mask = conc_matrix.solve_concentrations(arrays)
+        new_concs = conc_matrix.concentration_dicts(arrays, conc, mask)
+        for trial_name, substance_conc in new_concs.items():
+            self.set_substance_conc(self.sample_dict[trial_name][1], substance_conc)
+        return len(new_concs)
 
     def _calculate_trial_concentration(self, trial: trial):
-        print(f"success getting into _calculate_trial_concentration, trial: {trial.name}:{trial}")
+        logger.debug("success getting into _calculate_trial_concentration, trial: %s", trial.name)
         """浓度计算逻辑"""
         if trial.stock or trial.solvent:
             return
@@ -338,12 +740,15 @@ class Experiment:
         ##total_vol = trial.total_amount
         total_vol = sum(trial.composite.values())
         """if total_vol <= 0:
-            print(f"试样{trial.name}的 total_amount 无效")
+            logger.warning("试样%s的 total_amount 无效", trial.name)
             raise ValueError(f" {trial.name} 的 total_amount 无效")"""
 
         substance_amounts = defaultdict(float)
+        # 逐组分的调试输出在最内层循环里，先判断一次级别，关闭时循环内不再调用 logger
+        debug = logger.isEnabledFor(logging.DEBUG)
         for comp_name, vol_used in trial.composite.items():
-            print(f"_calculate_trial_concentration:{trial.name}","comp_name & vol_used:",comp_name," ", vol_used)
+            if debug:
+                logger.debug("_calculate_trial_concentration:%s comp_name & vol_used: %s %s", trial.name, comp_name, vol_used)
             comp_entry = self.sample_dict.get(comp_name)
             if not comp_entry:
                 continue
@@ -351,11 +756,11 @@ class Experiment:
             for sub, conc in comp_trial.substance_conc.items():
                 substance_amounts[sub] += conc * vol_used
 
-        trial.substance_conc = {
+        self.set_substance_conc(trial, {
             sub: amount / total_vol
             for sub, amount in substance_amounts.items()
-        }
-        print(f"{trial.name}'s substance_conc:{trial.substance_conc}")
+        })
+        logger.debug("%s's substance_conc:%s", trial.name, trial.substance_conc)
     """
     def generate_trial(self, name="", exp_name = "", composite=None, master=None, substance_conc=None, total_amount = None, id = "", existing_amount = None, stock=False, solvent = False, info=None):
 
@@ -372,8 +777,9 @@ class Experiment:
             total_volume: float,
             min_volume: float = 1.0,
             max_volume: float = 100.0,
-            max_retries: int = 3
-    ) -> Tuple[str, Dict[str, float]]:
+            max_retries: int = 3,
+            solver: str = "recursive"
+    ):
         """
         高级浓度设计算法（按物质约束优先+动态回退）
 
@@ -383,18 +789,31 @@ class Experiment:
             min_volume: 单试样最小使用体积
             max_volume: 单试样最大使用体积
             max_retries: 最大回退次数
+            solver: "recursive" 为逐物质贪心递归搜索；"lsq" 为在stock浓度矩阵上求有界最小二乘
+                    （需要残差时直接调用 design_concentration_lsq）
 
         Returns:
-            (试样名, {试样名: 使用体积})
+            (试样名, {试样名: 使用体积})，两种 solver 相同
         """
-        # 生成物质-试样映射
-        substance_trial_map = self.gen_substance_trial_dict()
+        if solver == "lsq":
+            final_name, final_volumes, _ = self.design_concentration_lsq(target_conc, total_volume, min_volume, max_volume)
+            return (final_name, final_volumes)
 
         # 确定必须处理的物质（排除溶剂）
         target_substances = [k for k in target_conc if k != "solvent"]
         if not target_substances:
             raise ValueError("必须指定至少一个非溶剂物质")
 
+        # 生成物质-试样映射：由倒排索引的浓度排序视图直接取出浓度足够高（所需体积不超过max_volume）的候选，浓度高者优先
+        # 上次以同一目标生成的最终试样及其下游不作为候选，否则最终试样会用到它自己
+        final_name = f"MIX_ADV_{hash(tuple(sorted(target_conc)))}"
+        excluded = self.dirty_closure([final_name])
+        substance_trial_map = {
+            sub: [name for name, _ in self.trials_by_concentration(
+                sub, min_conc=target_conc[sub] * total_volume / (max_volume + 0.005)) if name not in excluded]
+            for sub in target_substances
+        }
+
         # 按物质的可选试样数量排序（最少优先）
         sorted_substances = sorted(
             target_substances,
@@ -422,13 +841,228 @@ class Experiment:
             raise ValueError("无法找到可行方案")
 
         # 处理溶剂体积
-        final_volumes = self._handle_solvent(result, total_volume)
+        final_volumes = self._handle_solvent(result, total_volume, exclude=excluded)
 
         # 创建最终试样
-        final_name = f"MIX_ADV_{hash(tuple(sorted(target_conc)))}"
         self._create_final_trial(final_name, final_volumes, target_conc)
         return (final_name, final_volumes)
 
+    def stock_concentration_matrix(self, target_substances: List[str], exclude=()):
+        """
+        构建配方求解用的 物质×候选试样 浓度矩阵
+        候选试样由 substance_index 直接取出（含有任一目标物质的试样），行包括目标物质以及候选试样中出现的所有其他物质（用于计入交叉污染）
+        :param exclude: 不作为候选的试样名（即将写入的试样），连同它们的下游一起排除，否则写入后会用到自己
+        :return: (候选试样名列表, 物质名列表, 矩阵 A (物质数, 候选数))
+        """
+        candidate_names = []
+        seen = self.dirty_closure(exclude)
+        for sub in target_substances:
+            for trial_name in self.substance_index.get(sub, {}):
+                if trial_name not in seen:
+                    seen.add(trial_name)
+                    candidate_names.append(trial_name)
+
+        substance_names = list(target_substances)
+        substance_row = {sub: i for i, sub in enumerate(substance_names)}
+        rows, cols, values = [], [], []
+        for j, trial_name in enumerate(candidate_names):
+            for sub, conc in self.sample_dict[trial_name][1].substance_conc.items():
+                if conc == 0:
+                    continue
+                if sub not in substance_row:
+                    substance_row[sub] = len(substance_names)
+                    substance_names.append(sub)
+                rows.append(substance_row[sub])
+                cols.append(j)
+                values.append(conc)
+        A = np.zeros((len(substance_names), len(candidate_names)))
+        A[rows, cols] = values
+        return candidate_names, substance_names, A
+
+    def design_concentration_lsq(
+            self,
+            target_conc: Dict[str, float],
+            total_volume: float,
+            min_volume: float = 1.0,
+            max_volume: float = 100.0
+    ) -> Tuple[str, Dict[str, float], float]:
+        """
+        矩阵形式的浓度设计：在 物质×试样 浓度矩阵上求有界最小二乘（formulation.solve_formulation），
+        同时考虑所有候选试样（包括多物质stock带来的交叉污染），满足 min_volume/max_volume 与总体积约束，剩余体积由溶剂补足
+
+        Args:
+            target_conc: 目标浓度 {物质: 浓度}，未列出的物质目标为0
+            total_volume: 总体积要求
+            min_volume: 单试样最小使用体积（用到的试样体积要么为0要么不小于它）
+            max_volume: 单试样最大使用体积
+
+        Returns:
+            (试样名, {试样名: 使用体积}, 残差) 残差为实际浓度与目标浓度之差的2范数
+        """
+        target_substances = [k for k in target_conc if k != "solvent"]
+        if not target_substances:
+            raise ValueError("必须指定至少一个非溶剂物质")
+
+        final_name = f"MIX_ADV_{hash(tuple(sorted(target_conc)))}"
+        excluded = self.dirty_closure([final_name])
+        candidate_names, substance_names, A = self.stock_concentration_matrix(target_substances, exclude=excluded)
+        c = np.array([target_conc.get(sub, 0.0) for sub in substance_names])
+        volumes_array, residual = formulation.solve_formulation(A, c, total_volume, min_volume, max_volume)
+
+        volumes = {name: float(vol) for name, vol in zip(candidate_names, volumes_array) if vol > 0}
+        achieved = A @ volumes_array / total_volume
+        achieved_conc = {sub: float(conc) for sub, conc in zip(substance_names, achieved) if conc != 0}
+
+        final_volumes = self._handle_solvent(volumes, total_volume, exclude=excluded)
+        self._create_final_trial(final_name, final_volumes, achieved_conc)
+        return (final_name, final_volumes, residual)
+
+    @timed_stage("design_plate")
+    def design_plate(
+            self,
+            plate_targets: Dict[str, Dict[str, float]],
+            total_volume: float,
+            min_volume: float = 1.0,
+            max_volume: float = 100.0,
+            check_inventory: bool = True
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        批量配方设计：一次求解整板（如96/384孔）的目标浓度，并一次性登记所有生成的试样
+        所有孔位共用同一个 stock 浓度矩阵（formulation.solve_formulation_batch），重复的目标只求解一次
+
+        Args:
+            plate_targets: {孔位名: {物质: 目标浓度}}，孔位名即生成的试样名
+            total_volume: 每个孔位的总体积
+            min_volume: 单试样最小使用体积
+            max_volume: 单试样最大使用体积
+            check_inventory: 为 True 时登记之前检查整板对有限量试样的总用量，超量时抛出 inventory.InventoryError
+
+        Returns:
+            {孔位名: {"volumes": {试样名: 使用体积}, "conc": 实际浓度, "residual": 残差}}
+        """
+        well_names = list(plate_targets.keys())
+        target_substances = []
+        for target in plate_targets.values():
+            for sub in target:
+                if sub != "solvent" and sub not in target_substances:
+                    target_substances.append(sub)
+        if not target_substances:
+            raise ValueError("必须指定至少一个非溶剂物质")
+
+        # 要写入的孔位（重复提交时已在实验中）及其下游不作为候选，否则孔位会用到它自己
+        excluded = self.dirty_closure(well_names)
+        candidate_names, substance_names, A = self.stock_concentration_matrix(target_substances, exclude=excluded)
+        C = np.array([[plate_targets[well].get(sub, 0.0) for sub in substance_names] for well in well_names])
+        X, residuals = formulation.solve_formulation_batch(A, C, total_volume, min_volume, max_volume)
+        # 登记之前确认每个孔位的stock体积之和不超过孔的体积（solve_formulation 已保证，这里不让越界的解写入master/composite）
+        stock_totals = X.sum(axis=1)
+        over = np.flatnonzero(stock_totals > total_volume)
+        if over.size:
+            raise ValueError("孔位 " + ", ".join(f"{well_names[i]}（{stock_totals[i]:g}）" for i in over.tolist())
+                             + f" 的stock总体积超过了孔的体积 {total_volume:g}")
+        # 实际浓度按写入的总体积（stock + 补足的溶剂）计算
+        written_totals = np.maximum(stock_totals, total_volume)
+        achieved = X @ A.T / written_totals[:, None]
+
+        solvent = self._find_solvent(excluded)
+        candidate_array = np.asarray(candidate_names, dtype=object)
+        substance_array = np.asarray(substance_names, dtype=object)
+        new_trials = []
+        result = {}
+        for i, well in enumerate(well_names):
+            used = np.flatnonzero(X[i])
+            volumes = dict(zip(candidate_array[used].tolist(), X[i, used].tolist()))
+            solvent_vol = total_volume - float(X[i].sum())
+            if solvent_vol > 0:
+                volumes[solvent] = volumes.get(solvent, 0.0) + solvent_vol
+            present = np.flatnonzero(achieved[i])
+            conc = dict(zip(substance_array[present].tolist(), achieved[i, present].tolist()))
+            new_trials.append(trial(name=well, exp_name=self.name, id=well, composite=volumes,
+                                    total_amount=float(written_totals[i]), substance_conc=conc))
+            result[well] = {"volumes": volumes, "conc": conc, "residual": float(residuals[i])}
+
+        if check_inventory:
+            inventory.check_submission(self, {the_trial.name: the_trial.composite for the_trial in new_trials},
+                                       full_table=False)
+        self.generate_trials_bulk(new_trials)
+        return result
+
+    @timed_stage("generate_trials_bulk")
+    def generate_trials_bulk(self, new_trials: List[trial]):
+        """
+        一次性登记一批新试样（如 design_plate 生成的整板），组分关系在同一个 CompositeTransaction 中建立：
+        commit 先检查组分存在、不形成循环（composite_order.insert_edge），通过后才改动 master / existing_amount 与 sample_dict，
+        检查不通过时实验不变。同名的原试样被替换：新试样接过它的下游引用，有限量组分按新旧用量之差记账；
+        只是id相同的原试样先解除全部组分关系再移除。既不在实验中也不在这批试样中的组分（如没有溶剂试样时的虚拟溶剂 Solvent）
+        只写入 composite，不建立 master。新试样全部标记为dirty
+        :raises topo_order.CycleError: 新的组分关系会形成循环依赖
+        """
+        logger.debug("generate_trials_bulk: Adding %d trials into Experiment %s", len(new_trials), self.name)
+        batch = {the_trial.name: the_trial for the_trial in new_trials}
+        replaced, displaced = {}, {}
+        for the_trial in new_trials:
+            occupied = self.id_trial_name.get(the_trial.id)
+            if occupied is not None and occupied not in batch:
+                displaced[occupied] = self.sample_dict[occupied][1]
+            if the_trial.name in self.sample_dict:
+                replaced[the_trial.name] = self.sample_dict[the_trial.name][1]
+
+        originals = [(the_trial, the_trial.composite, the_trial.master) for the_trial in new_trials]
+        changes = self.transaction(check_inventory=False)
+        for name in displaced:
+            changes.detach(name)
+        virtual = {}
+        for the_trial in new_trials:
+            known = {}
+            for component, amount in the_trial.composite.items():
+                if component in batch or (component in self.sample_dict and component not in displaced):
+                    known[component] = amount
+                else:
+                    virtual.setdefault(the_trial.name, {})[component] = amount
+            ori_trial = replaced.get(the_trial.name)
+            if ori_trial is not None:
+                # 从原试样的组分出发，commit 只按新旧之差更新组分的 master 与 existing_amount
+                the_trial.composite = dict(ori_trial.composite.items())
+                the_trial.master = {**the_trial.master, **dict(ori_trial.master.items())}
+            else:
+                the_trial.composite = {}
+            changes.set_composite(the_trial, known)
+        try:
+            changes.commit()
+        except BaseException:
+            for the_trial, composite, master in originals:
+                the_trial.composite, the_trial.master = composite, master
+            # 检查时 insert_edge 可能已给尚未登记的试样分配了位置
+            self.composite_order.invalidate()
+            raise
+
+        for ori_trial in displaced.values():
+            self.remove_trial(ori_trial)
+        for the_trial in new_trials:
+            for component, amount in virtual.get(the_trial.name, {}).items():
+                the_trial.composite[component] = amount
+            ori_trial = replaced.get(the_trial.name)
+            if ori_trial is not None:
+                self._unindex_substance_conc(the_trial.name, ori_trial.substance_conc)
+                if self.id_trial_name.get(ori_trial.id) == the_trial.name:
+                    del self.id_trial_name[ori_trial.id]
+                del self.sample_dict[the_trial.name]
+            else:
+                self.trial_rows.add(the_trial.name)
+            the_trial.bind_name_tables(self.trial_name_table, self.substance_name_table)
+            self.sample_dict[the_trial.name] = [the_trial.id, the_trial]
+            self.id_trial_name[the_trial.id] = the_trial.name
+            self._index_substance_conc(the_trial.name, the_trial.substance_conc)
+            self.composite_order.add(the_trial.name)
+            for sub in the_trial.substance_conc:
+                if sub not in self.substance_dict:
+                    self.substance_dict[sub] = []
+        for ori_trial in replaced.values():
+            for sub in ori_trial.substance_conc:
+                if sub not in self.substance_index:
+                    self.substance_dict.pop(sub, None)
+        self.mark_dirty(*batch)
+
     def _allocate_volumes_recursive(
             self,
             substances: List[str],
@@ -442,8 +1076,7 @@ class Experiment:
             retry_count: int,
             max_retries: int
     ) -> Optional[Dict[str, float]]:
-        print(substances)
-        print(used_trials)
+        logger.debug("_allocate_volumes_recursive: substances %s, used_trials %s", substances, used_trials)
         # 终止条件：所有物质处理完成
         if not substances:
             return dict(used_trials)
@@ -460,9 +1093,7 @@ class Experiment:
             required_vol = (target_conc[current_sub] * total_volume) / conc
             required_vol = round(required_vol, 2)
 
-            print(required_vol)
-            print(min_volume)
-            print(max_volume)
+            logger.debug("_allocate_volumes_recursive: required_vol %s, range [%s, %s]", required_vol, min_volume, max_volume)
 
             # 体积约束检查
             if not (min_volume <= required_vol <= max_volume):
@@ -474,7 +1105,7 @@ class Experiment:
             used_copy[trial_name] += required_vol
             new_remaining = remaining_volume - required_vol
 
-            print(used_copy)
+            logger.debug("_allocate_volumes_recursive: used_copy %s", used_copy)
 
             # 递归处理下一个物质
             result = self._allocate_volumes_recursive(
@@ -520,26 +1151,28 @@ class Experiment:
     def _handle_solvent(
             self,
             volumes: Dict[str, float],
-            total_volume: float
+            total_volume: float,
+            exclude=()
     ) -> Dict[str, float]:
-        """处理溶剂体积"""
+        """处理溶剂体积，exclude 同 _find_solvent"""
         current_total = sum(volumes.values())
         solvent_vol = total_volume - current_total
         if solvent_vol < 0:
             raise ValueError("体积超限")
 
-        # 自动寻找溶剂（浓度全为0的试样）
-        solvent_candidates = [
-            name for name, (_, t) in self.sample_dict.items()
-            if all(c == 0 for c in t.substance_conc.values())
-        ]
-        if solvent_candidates:
-            solvent = solvent_candidates[0]
-            volumes[solvent] = solvent_vol
-        else:
-            volumes["Solvent"] = solvent_vol  # 虚拟溶剂记录
+        volumes[self._find_solvent(exclude)] = solvent_vol
         return volumes
 
+    def _find_solvent(self, exclude=()) -> str:
+        """
+        自动寻找溶剂（浓度全为0的试样），找不到时返回虚拟溶剂名 Solvent
+        :param exclude: 不能用作溶剂的试样名（即将写入的试样及其下游）
+        """
+        for name, (_, t) in self.sample_dict.items():
+            if name not in exclude and all(c == 0 for c in t.substance_conc.values()):
+                return name
+        return "Solvent"  # 虚拟溶剂记录
+
     def _create_final_trial(
             self,
             name: str,
@@ -556,12 +1189,82 @@ class Experiment:
         )
         self.generate_trial(final_trial)
 
+    def inventory_report(self):
+        """
+        按整个依赖树计算有限量试样（total_amount 大于0 且不为无限量）的总用量，列出超量的试样，见 inventory.tree_report
+        :return: [{"trial", "available", "draw", "shortage", "first_trial"}]，没有超量时为空列表
+        """
+        return inventory.tree_report(self)
+
     def save_to_txt(self, filename):
         """将对象的属性数据保存为 JSON 文件"""
         data = self.__dict__.copy()
         with open(filename, 'w') as f:
             json.dump(data, f, indent=2)
 
+    def save_snapshot(self, path):
+        """
+        保存为单个二进制快照文件（见 snapshot.py）：浓度矩阵、composite/master 的COO边、名字与id表都以numpy数组存储
+        :param path: 文件路径，建议以 .npy 结尾
+        :return: 文件字节数
+        """
+        return snapshot.write_snapshot(self, path)
+
+    @classmethod
+    def load_snapshot(cls, path):
+        """
+        从 save_snapshot 写出的快照重建实验，文件以 np.load(mmap_mode="r") 映射，不解析JSON（extra_info 与 trial.info 除外）
+        名字驻留表按快照中的顺序重建，因此快照里的下标直接就是 CompactMap 的键id
+        """
+        fields = snapshot.read_snapshot(path)
+        name, table_id, date, conc_engine, recompute_mode = snapshot.split_names(fields["meta"])
+        n = fields["stock"].size
+        trial_names = snapshot.split_names(fields["trial_names"], n)
+        trial_ids = snapshot.split_names(fields["trial_ids"], n)
+        conc_row, conc_col, conc_val = fields["conc_row"], fields["conc_col"], fields["conc_val"]
+        substance_names = snapshot.split_names(fields["substance_names"], int(conc_col.max()) + 1 if conc_col.size else 0)
+        extra = json.loads(fields["json_extra"].tobytes().decode("utf-8"))
+
+        exp = cls(name, sample_dict={}, substance_dict={}, id_trial_name={}, table_id=table_id or None,
+                  extra_info=extra["extra_info"], date=date or None, conc_engine=conc_engine, recompute_mode=recompute_mode)
+        trial_table, substance_table = exp.trial_name_table, exp.substance_name_table
+        for trial_name in trial_names:
+            trial_table.intern(trial_name)
+        for substance_name in substance_names:
+            substance_table.intern(substance_name)
+
+        composites = snapshot.grouped_raw_arrays(n, fields["composite_row"], fields["composite_col"], fields["composite_vol"])
+        masters = snapshot.grouped_raw_arrays(n, fields["master_row"], fields["master_col"], fields["master_vol"])
+        concs = snapshot.grouped_raw_arrays(n, conc_row, conc_col, conc_val)
+        stock, solvent = fields["stock"].tolist(), fields["solvent"].tolist()
+        total_amount, existing_amount = fields["total_amount"].tolist(), fields["existing_amount"].tolist()
+        infos = extra["info"]
+        from_raw = CompactMap.from_raw
+        sample_dict = exp.sample_dict
+        for i, (trial_name, trial_id) in enumerate(zip(trial_names, trial_ids)):
+            the_trial = trial(name=trial_name, exp_name=name, id=trial_id, total_amount=total_amount[i],
+                              existing_amount=existing_amount[i], stock=stock[i], solvent=solvent[i], info=infos.get(str(i)))
+            the_trial.set_compact_maps(from_raw(trial_table, composites[i]), from_raw(trial_table, masters[i]),
+                                       from_raw(substance_table, concs[i]))
+            sample_dict[trial_name] = [trial_id, the_trial]
+        exp.id_trial_name = dict(zip(trial_ids, trial_names))
+        exp.trial_rows = SortedKeys(dict.fromkeys(trial_names, 1))
+        column_counts = np.bincount(conc_col, minlength=len(substance_names)).tolist() if conc_col.size else []
+        exp.substance_columns = SortedKeys({substance_name: count for substance_name, count in zip(substance_names, column_counts) if count})
+
+        exp.substance_dict = {sub: [] for sub in snapshot.split_names(fields["substance_dict_names"])}
+        exp.dirty_trials = {trial_names[i] for i in np.flatnonzero(fields["dirty"]).tolist()}
+        # 倒排索引按物质分组一次性构建
+        positive = np.flatnonzero(conc_val > 0)
+        order = positive[np.argsort(conc_col[positive], kind="stable")]
+        bounds = np.searchsorted(conc_col[order], np.arange(len(substance_names) + 1))
+        names_array = np.asarray(trial_names, dtype=object)
+        for k, substance_name in enumerate(substance_names):
+            part = order[bounds[k]:bounds[k + 1]]
+            if part.size:
+                exp.substance_index[substance_name] = dict(zip(names_array[conc_row[part]].tolist(), conc_val[part].tolist()))
+        return exp
+
     @classmethod
     def load_from_txt(cls, filename):
         """从 JSON 文件中加载数据并创建新的 trial 对象"""
@@ -0,0 +1,1217 @@
+"""
+性能基准脚本：用随机生成的实验比较不同实现的耗时
+用法: python benchmark.py --trials 3000 --stocks 200 --substances 300
+      python benchmark.py --suite stages,flask --json after.json --compare before.json
+每个基准把主要数值记录到 RESULTS（--json 保存为JSON），--compare 与之前保存的结果逐项对比
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+from Experiment import Experiment
+from compact import CompactMap, NameTable
+import inventory
+import snapshot
+import table_export
+import table_ingest
+import table_wire
+from trial import trial
+
+
+# 本次运行的结果 {基准名: {指标名: 数值}}；指标名以 _ms/_bytes 结尾的越小越好，以 _per_s 结尾的越大越好
+RESULTS = {}
+
+
+def record(section, **values):
+    RESULTS.setdefault(section, {}).update(values)
+
+
+def build_workload(n_trials, n_stocks, n_substances, fan_in=4, substances_per_stock=3, seed=0, depth=None, families=1):
+    """
+    生成一个随机实验：n_stocks 个stock，每个含若干物质；n_trials 个普通trial，每个从之前的stock/trial中取 fan_in 个组分
+    直接写入 composite/master，不经过 add_to_composite
+    :param depth: 给定时把trial平均分为 depth 层，每个trial至少有一个组分来自上一层（第一层来自stock），
+                  其余组分从之前所有的stock/trial中任取，DAG 的最长路径即为 depth；None 时不分层
+    :param families: 把stock与trial轮流分到 families 个互不相关的家族，组分只从同一家族中选取，
+                     composite 图至少有 families 个弱连通分量
+    """
+    rng = random.Random(seed)
+    substances = [f"S{i}" for i in range(n_substances)]
+    exp = Experiment("benchmark", sample_dict={}, substance_dict={}, id_trial_name={}, table_id="benchmark")
+    names = [[] for _ in range(families)]
+    layers = [[[]] for _ in range(families)]
+    per_family = -(-n_trials // families)
+    for i in range(n_stocks):
+        name = f"stock_{i}"
+        conc = {sub: rng.uniform(0.1, 10.0) for sub in rng.sample(substances, min(substances_per_stock, n_substances))}
+        the_stock = trial(name=name, exp_name=exp.name, id=name, substance_conc=conc, stock=True)
+        exp.sample_dict[name] = [name, the_stock]
+        exp.id_trial_name[name] = name
+        names[i % families].append(name)
+        layers[i % families][0].append(name)
+    for i in range(n_trials):
+        name = f"trial_{i}"
+        family = i % families
+        the_trial = trial(name=name, exp_name=exp.name, id=name)
+        components = rng.sample(names[family], min(fan_in, len(names[family])))
+        if depth:
+            layer = 1 + (i // families) * depth // per_family
+            if layer == len(layers[family]):
+                layers[family].append([])
+            layers[family][layer].append(name)
+            previous = rng.choice(layers[family][layer - 1])
+            if previous not in components:
+                components[0] = previous
+        for comp_name in components:
+            amount = rng.uniform(1.0, 50.0)
+            the_trial.composite[comp_name] = amount
+            exp.sample_dict[comp_name][1].master[name] = amount
+        exp.sample_dict[name] = [name, the_trial]
+        exp.id_trial_name[name] = name
+        names[family].append(name)
+    exp.rebuild_substance_index()
+    return exp
+
+
+def snapshot_concentrations(exp):
+    return {name: dict(entry[1].substance_conc) for name, entry in exp.sample_dict.items()}
+
+
+def same_concentrations(a, b, rel_tol=1e-9):
+    if a.keys() != b.keys():
+        return False
+    for name in a:
+        if a[name].keys() != b[name].keys():
+            return False
+        for sub, value in a[name].items():
+            if abs(value - b[name][sub]) > rel_tol * max(1.0, abs(value)):
+                return False
+    return True
+
+
+def time_call(func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_concentration_engines(args):
+    """对比 update_all_concentrations 的 dict 引擎与 matrix 引擎"""
+    exp = build_workload(args.trials, args.stocks, args.substances, args.fan_in, seed=args.seed)
+
+    exp.conc_engine = "dict"
+    dict_time = time_call(exp.update_all_concentrations, args.repeat)
+    dict_result = snapshot_concentrations(exp)
+
+    exp.conc_engine = "matrix"
+    matrix_time = time_call(exp.update_all_concentrations, args.repeat)
+    matrix_result = snapshot_concentrations(exp)
+
+    print(f"update_all_concentrations: trials={args.trials} stocks={args.stocks} substances={args.substances} fan_in={args.fan_in}")
+    print(f"  dict engine:   {dict_time * 1000:10.2f} ms")
+    print(f"  matrix engine: {matrix_time * 1000:10.2f} ms  (x{dict_time / matrix_time:.1f})")
+    print(f"  results identical: {same_concentrations(dict_result, matrix_result)}")
+    record("engines", dict_ms=dict_time * 1000, matrix_ms=matrix_time * 1000)
+
+
+def bench_incremental_recompute(args):
+    """对比修改一个单元格（某个trial的一个composite用量）后，全量重算与沿master的增量重算"""
+    exp = build_workload(args.trials, args.stocks, args.substances, args.fan_in, seed=args.seed)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        exp.update_all_concentrations()
+    edited = exp.sample_dict[f"trial_{args.trials * 9 // 10}"][1]
+    comp_name = next(iter(edited.composite))
+
+    def edit_and_recompute():
+        edited.composite[comp_name] *= 1.01
+        exp.mark_dirty(edited.name)
+        exp.update_dirty_concentrations()
+
+    incremental_time = time_call(edit_and_recompute, args.repeat)
+    recomputed = exp.recompute_stats["last_recomputed"]
+    incremental_result = snapshot_concentrations(exp)
+    full_time = time_call(exp.update_all_concentrations, args.repeat)
+
+    print(f"recompute after editing one cell: trials={args.trials}")
+    print(f"  full:        {full_time * 1000:10.2f} ms  ({args.trials} trials)")
+    print(f"  incremental: {incremental_time * 1000:10.2f} ms  ({recomputed} trials)")
+    print(f"  results identical: {same_concentrations(incremental_result, snapshot_concentrations(exp))}")
+    record("incremental", full_ms=full_time * 1000, incremental_ms=incremental_time * 1000, recomputed=recomputed)
+
+
+def formulation_residual(exp, target, volumes, total_volume):
+    """按实际用量重新计算配方浓度（包括交叉污染物质），返回与目标浓度之差的2范数"""
+    achieved = {}
+    for name, vol in volumes.items():
+        if name not in exp.sample_dict:
+            continue
+        for sub, conc in exp.sample_dict[name][1].substance_conc.items():
+            achieved[sub] = achieved.get(sub, 0.0) + conc * vol / total_volume
+    subs = set(achieved) | set(target)
+    return sum((achieved.get(sub, 0.0) - target.get(sub, 0.0)) ** 2 for sub in subs) ** 0.5
+
+
+def bench_formulation(args):
+    """对比 design_concentration_advanced 的递归搜索与矩阵最小二乘求解（随机多物质stock库，随机目标）"""
+    rng = random.Random(args.seed)
+    targets = []
+    for _ in range(args.formulation_targets):
+        subs = rng.sample([f"S{i}" for i in range(args.formulation_substances)], 3)
+        targets.append({sub: rng.uniform(0.05, 0.5) for sub in subs})
+
+    for solver in ("recursive", "lsq"):
+        exp = build_workload(0, args.stocks, args.formulation_substances, substances_per_stock=3, seed=args.seed)
+        solved, residuals = 0, []
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            for target in targets:
+                try:
+                    result = exp.design_concentration_advanced(target, 100.0, min_volume=1.0, max_volume=50.0, solver=solver)
+                except ValueError:
+                    continue
+                solved += 1
+                residuals.append(formulation_residual(exp, target, result[1], 100.0))
+        elapsed = time.perf_counter() - start
+        line = f"  {solver:9s}: {elapsed * 1000 / len(targets):8.2f} ms/target  solved {solved}/{len(targets)}"
+        if residuals:
+            line += f"  median residual {sorted(residuals)[len(residuals) // 2]:.2e}"
+        print(line)
+        record("formulation", **{f"{solver}_ms_per_target": elapsed * 1000 / len(targets), f"{solver}_solved": solved})
+
+
+def bench_plate(args):
+    """对比整板配方设计：逐孔调用 design_concentration_advanced(solver="lsq") 与一次 design_plate"""
+    rng = random.Random(args.seed)
+    plate_substances = rng.sample([f"S{i}" for i in range(args.formulation_substances)], 3)
+    levels = [0.02 * (i + 1) for i in range(8)]
+    plate = {}
+    for i in range(args.plate_wells):
+        # 按行列扫描两种物质的浓度，第三种物质固定，模拟剂量矩阵板
+        plate[f"well_{i}"] = {plate_substances[0]: levels[i % 8], plate_substances[1]: levels[(i // 8) % 8],
+                              plate_substances[2]: 0.1}
+
+    exp = build_workload(0, args.stocks, args.formulation_substances, substances_per_stock=3, seed=args.seed)
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for target in plate.values():
+            exp.design_concentration_advanced(target, 100.0, min_volume=1.0, max_volume=50.0, solver="lsq")
+    loop_time = time.perf_counter() - start
+
+    exp = build_workload(0, args.stocks, args.formulation_substances, substances_per_stock=3, seed=args.seed)
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        result = exp.design_plate(plate, 100.0, min_volume=1.0, max_volume=50.0)
+    plate_time = time.perf_counter() - start
+    residuals = sorted(info["residual"] for info in result.values())
+
+    print(f"plate formulation: wells={args.plate_wells} stocks={args.stocks} substances={args.formulation_substances}")
+    print(f"  per-well lsq: {loop_time * 1000:10.2f} ms")
+    print(f"  design_plate: {plate_time * 1000:10.2f} ms  (x{loop_time / plate_time:.1f}), median residual {residuals[len(residuals) // 2]:.2e}")
+    record("plate", per_well_ms=loop_time * 1000, design_plate_ms=plate_time * 1000)
+
+
+class DictTrial:
+    """改为 __slots__/CompactMap 之前 trial 的存储方式：实例 __dict__ 加四个普通 dict，用于对比内存"""
+
+    def __init__(self, the_trial):
+        self.name = the_trial.name
+        self.info = {}
+        self.composite = dict(the_trial.composite.items())
+        self.master = dict(the_trial.master.items())
+        self.substance_conc = dict(the_trial.substance_conc.items())
+        self.existing_amount = float(the_trial.existing_amount)
+        self.total_amount = float(the_trial.total_amount)
+        self.stock = the_trial.stock
+        self.solvent = the_trial.solvent
+        self.id = the_trial.id
+        self.exp_name = the_trial.exp_name
+
+
+def traced_bytes(build):
+    """build() 新分配并仍然持有的内存（tracemalloc 统计）"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return after - before
+
+
+def bench_parallel_recompute(args):
+    """
+    "parallel" 引擎：--parallel-trials 个trial分为 --parallel-families 个互不相关的家族（弱连通分量），
+    对比本进程的 matrix 引擎与进程池 1, 2, 4, ... 直到 CPU 核数个进程的耗时（dict 引擎在这个规模上太慢，不参与）
+    """
+    exp = build_workload(args.parallel_trials, args.stocks, args.substances, args.fan_in, seed=args.seed,
+                         depth=args.depth, families=args.parallel_families)
+    exp.parallel_min_trials = 0
+    exp.parallel_min_component = 1
+    cores = os.cpu_count() or 1
+
+    exp.conc_engine = "matrix"
+    matrix_time = time_call(exp.update_all_concentrations, args.repeat)
+    expected = snapshot_concentrations(exp)
+
+    exp.conc_engine = "parallel"
+    workers_list = sorted({1, cores} | {2 ** k for k in range(1, 8) if 2 ** k < cores})
+    parallel_times = {}
+    for workers in workers_list:
+        exp.parallel_workers = workers
+        exp.update_all_concentrations()  # 预先启动进程池，不计入耗时
+        parallel_times[workers] = time_call(exp.update_all_concentrations, args.repeat)
+    identical = same_concentrations(expected, snapshot_concentrations(exp))
+
+    print(f"parallel recompute: trials={args.parallel_trials} families={args.parallel_families} cores={cores}")
+    print(f"  matrix engine:           {matrix_time * 1000:10.2f} ms")
+    for workers, elapsed in parallel_times.items():
+        print(f"  parallel, {workers:3d} processes: {elapsed * 1000:10.2f} ms  (x{matrix_time / elapsed:.2f} vs matrix)")
+    print(f"  results identical: {identical}")
+    record("parallel", matrix_ms=matrix_time * 1000, cores=cores, identical=identical,
+           **{f"workers_{workers}_ms": elapsed * 1000 for workers, elapsed in parallel_times.items()})
+
+
+def bench_trial_memory(args):
+    """每个trial占用的内存：紧凑存储（含名字驻留表）与原来的 __dict__ + dict 存储"""
+    exp = build_workload(args.trials, args.stocks, args.substances, args.fan_in, seed=args.seed)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        exp.update_all_concentrations()
+    trials = [entry[1] for entry in exp.sample_dict.values()]
+
+    def build_compact():
+        trial_names, substance_names = NameTable(), NameTable()
+        copies = []
+        for the_trial in trials:
+            the_copy = trial(**the_trial.to_dict())
+            the_copy.bind_name_tables(trial_names, substance_names)
+            copies.append(the_copy)
+        return copies, trial_names, substance_names
+
+    compact_bytes = traced_bytes(build_compact)
+    dict_bytes = traced_bytes(lambda: [DictTrial(the_trial) for the_trial in trials])
+    print(f"memory per trial: trials={len(trials)} fan_in={args.fan_in}")
+    print(f"  dict storage:    {dict_bytes / len(trials):8.0f} bytes")
+    print(f"  compact storage: {compact_bytes / len(trials):8.0f} bytes  (x{dict_bytes / compact_bytes:.1f} smaller)")
+    record("trial_memory", dict_per_trial_bytes=dict_bytes / len(trials), compact_per_trial_bytes=compact_bytes / len(trials))
+
+
+def bench_compact_map(args):
+    """
+    高扇出的 CompactMap（被 --fanout-keys 个trial使用的 stock 的 master）：逐个写入、随机查找与改名，
+    以及删除其中十分之一，与普通 dict 对比；超过 INDEX_MIN_SIZE 的映射带索引，写入、查找、改名不应随条目数平方增长，
+    删除与数组的删除一样为 O(n)
+    """
+    rng = random.Random(args.seed)
+    names = [f"trial_{i}" for i in range(args.fanout_keys)]
+    sample = rng.sample(names, min(args.fanout_lookups, len(names)))
+    timings = {}
+    for kind in ("dict", "compact"):
+        the_map = {} if kind == "dict" else CompactMap(NameTable())
+        start = time.perf_counter()
+        for name in names:
+            the_map[name] = 1.0
+        fill = time.perf_counter() - start
+        start = time.perf_counter()
+        for name in sample:
+            the_map[name]
+        lookup = time.perf_counter() - start
+        start = time.perf_counter()
+        for name in sample:
+            if kind == "dict":
+                the_map[name + "_renamed"] = the_map.pop(name)
+            else:
+                the_map.rename(name, name + "_renamed")
+        rename = time.perf_counter() - start
+        start = time.perf_counter()
+        for name in sample[:len(sample) // 10]:
+            del the_map[name + "_renamed"]
+        delete = time.perf_counter() - start
+        timings[kind] = (fill, lookup, rename, delete)
+    print(f"compact map: keys={args.fanout_keys} lookups/renames={len(sample)} deletes={len(sample) // 10}")
+    for kind, (fill, lookup, rename, delete) in timings.items():
+        print(f"  {kind:8s} fill {fill * 1000:9.2f} ms  lookup {lookup * 1000:9.2f} ms  rename {rename * 1000:9.2f} ms"
+              f"  delete {delete * 1000:9.2f} ms")
+    record("compact_map", **{f"{kind}_{step}_ms": value * 1000 for kind, values in timings.items()
+                             for step, value in zip(("fill", "lookup", "rename", "delete"), values)})
+
+
+def bench_snapshot(args):
+    """二进制快照：保存、以内存映射打开（只读目录）、完整重建 Experiment 的耗时"""
+    exp = build_workload(args.snapshot_trials, args.stocks, args.substances, args.fan_in, seed=args.seed)
+    path = os.path.join(tempfile.mkdtemp(), "benchmark_snapshot.npy")
+    start = time.perf_counter()
+    size = exp.save_snapshot(path)
+    save_time = time.perf_counter() - start
+    open_time = time_call(lambda: snapshot.read_snapshot(path), args.repeat)
+    load_time = time_call(lambda: Experiment.load_snapshot(path), 1)
+    edges = snapshot.read_snapshot(path)["composite_row"].size
+    os.remove(path)
+
+    print(f"snapshot: trials={args.snapshot_trials} composite edges={edges} file={size / 1e6:.1f} MB")
+    print(f"  save:             {save_time * 1000:10.2f} ms")
+    print(f"  open (mmap):      {open_time * 1000:10.2f} ms")
+    print(f"  load Experiment:  {load_time * 1000:10.2f} ms")
+    record("snapshot", save_ms=save_time * 1000, open_ms=open_time * 1000, load_ms=load_time * 1000, file_bytes=size)
+
+
+def bench_export(args):
+    """
+    表格导出：浓度表逐行生成 CSV（table_export.iter_csv）的耗时与内存峰值，对比先构造 dict_to_table 二维数组的峰值；
+    以及 openpyxl write-only 模式写 XLSX（--export-xlsx-trials 个trial）
+    """
+    chem_interface = import_interface().chem_interface
+
+    def drain(chunks):
+        return sum(len(chunk) for chunk in chunks)
+
+    exp = build_workload(args.export_trials, args.flask_stocks, args.flask_substances, args.fan_in, seed=args.seed)
+    exp.conc_engine = "matrix"
+    exp.update_all_concentrations()
+    start = time.perf_counter()
+    csv_bytes = drain(table_export.iter_csv(table_export.conc_rows(exp)))
+    csv_time = time.perf_counter() - start
+    csv_peak = peak_bytes(lambda: drain(table_export.iter_csv(table_export.conc_rows(exp))))
+    table_peak = peak_bytes(lambda: chem_interface.dict_to_table(
+        {name: entry[1].substance_conc for name, entry in exp.sample_dict.items()}))
+
+    xlsx_exp = build_workload(args.export_xlsx_trials, args.flask_stocks, args.flask_substances, args.fan_in, seed=args.seed)
+    xlsx_exp.conc_engine = "matrix"
+    xlsx_exp.update_all_concentrations()
+
+    def write_xlsx():
+        path = table_export.write_xlsx(table_export.conc_rows(xlsx_exp), "conc")
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+
+    start = time.perf_counter()
+    xlsx_bytes = write_xlsx()
+    xlsx_time = time.perf_counter() - start
+    xlsx_peak = peak_bytes(write_xlsx)
+
+    print(f"export: conc table, csv trials={args.export_trials}, xlsx trials={args.export_xlsx_trials}, "
+          f"substances={args.flask_substances}")
+    print(f"  csv:                  {csv_time * 1000:10.2f} ms  ({csv_bytes / 1e6:.1f} MB, peak {csv_peak / 1e6:.1f} MB)")
+    print(f"  dict_to_table peak:   {table_peak / 1e6:10.1f} MB")
+    print(f"  xlsx (write-only):    {xlsx_time * 1000:10.2f} ms  ({xlsx_bytes / 1e6:.1f} MB, peak {xlsx_peak / 1e6:.1f} MB)")
+    record("export", csv_ms=csv_time * 1000, csv_peak_bytes=csv_peak, dict_to_table_peak_bytes=table_peak,
+           xlsx_ms=xlsx_time * 1000, xlsx_peak_bytes=xlsx_peak)
+
+
+def bench_window(args):
+    """
+    大实验的窗口读取（chem_interface.Get_table_window）：首次请求（含生成整表行列名）、之后翻页、按物质浓度排序并筛选的窗口，
+    对比渲染整张浓度表（Get_conc_table）的耗时
+    """
+    interface = import_interface()
+    exp = build_workload(args.window_trials, args.flask_stocks, args.flask_substances, args.fan_in, seed=args.seed)
+    exp.conc_engine = "matrix"
+    exp.update_all_concentrations()
+    the_interface = interface.chem_interface(cache_size=64)
+    the_interface.add_experiment("window", "window", exp)
+    page = {"rows": [0, 100], "columns": [0, 50]}
+
+    def fetch(window):
+        start = time.perf_counter()
+        table, info = the_interface.Get_table_window("window", "window", "conc", window)
+        return time.perf_counter() - start, info
+
+    first, info = fetch(page)
+    pages = [fetch({"rows": [k * 1000, k * 1000 + 100], "columns": [0, 50]})[0] for k in range(1, args.repeat + 4)]
+    substance = max(exp.substance_index, key=lambda name: len(exp.substance_index[name]))
+    sorted_window = {"rows": [0, 100], "columns": [0, 50], "sort": {"column": substance, "descending": True},
+                     "filter": {"column": substance, "min": 0.0001}}
+    sorted_first, sorted_info = fetch(sorted_window)
+    sorted_page = fetch({**sorted_window, "rows": [100, 200]})[0]
+    start = time.perf_counter()
+    full = the_interface.Get_conc_table("window", "window")
+    full_time = time.perf_counter() - start
+    assert info["total_rows"] == len(full) - 1 and info["total_columns"] == len(full[0]) - 1
+
+    print(f"window: conc table, trials={args.window_trials}, substances={info['total_columns']}, window 100x50")
+    print(f"  full Get_conc_table:       {full_time * 1000:10.2f} ms")
+    print(f"  first window:              {first * 1000:10.2f} ms  (builds the row/column name index)")
+    print(f"  later window (page flip):  {min(pages) * 1000:10.2f} ms")
+    print(f"  sorted+filtered window:    {sorted_first * 1000:10.2f} ms  ({sorted_info['total_rows']} rows), next page {sorted_page * 1000:.2f} ms")
+    record("window", full_ms=full_time * 1000, first_window_ms=first * 1000, page_ms=min(pages) * 1000,
+           sorted_window_ms=sorted_first * 1000, sorted_page_ms=sorted_page * 1000)
+
+
+def bench_render(args):
+    """
+    整表渲染（dict_to_table）：浓度表的行、列顺序取自实验维护的有序索引（Experiment.trial_rows / substance_columns），
+    每行预先填满空字符串后只按实际存在的键填值；对比每次收集全部键并排序的方式，以及原来逐个单元格 .get 的方式
+    exp 表格为 trial×trial 的对称表格，试样数另由 --render-exp-trials 指定
+    """
+    chem_interface = import_interface().chem_interface
+    exp = build_workload(args.render_trials, args.stocks, args.substances, args.fan_in, seed=args.seed)
+    exp.conc_engine = "matrix"
+    exp.update_all_concentrations()
+    conc_dict = {name: entry[1].substance_conc for name, entry in exp.sample_dict.items()}
+    indexed = lambda: chem_interface.dict_to_table(conc_dict, columns=exp.substance_columns.ordered(), rows=exp.trial_rows.ordered())
+    indexed_time = time_call(indexed, args.repeat)
+    sorted_time = time_call(lambda: chem_interface.dict_to_table(conc_dict), args.repeat)
+    per_cell_time = time_call(lambda: per_cell_dict_to_table(conc_dict), 1)
+    assert indexed() == per_cell_dict_to_table(conc_dict)
+    print(f"render: conc table, trials={args.render_trials}, substances={len(exp.substance_columns)}")
+    print(f"  order index + sparse fill: {indexed_time * 1000:10.2f} ms")
+    print(f"  collect/sort + sparse fill:{sorted_time * 1000:10.2f} ms")
+    print(f"  per-cell .get:             {per_cell_time * 1000:10.2f} ms")
+    record("render", conc_indexed_ms=indexed_time * 1000, conc_sorted_ms=sorted_time * 1000, conc_per_cell_ms=per_cell_time * 1000)
+
+    exp = build_workload(args.render_exp_trials, args.stocks, args.substances, args.fan_in, seed=args.seed)
+    composite_dict = {name: entry[1].composite for name, entry in exp.sample_dict.items()}
+    sparse_time = time_call(lambda: chem_interface.dict_to_table(composite_dict, symmetric=True), args.repeat)
+    per_cell_time = time_call(lambda: per_cell_dict_to_table(composite_dict, symmetric=True), 1)
+    print(f"render: exp table, trials={args.render_exp_trials}")
+    print(f"  sparse fill:               {sparse_time * 1000:10.2f} ms")
+    print(f"  per-cell .get:             {per_cell_time * 1000:10.2f} ms")
+    record("render", exp_sparse_ms=sparse_time * 1000, exp_per_cell_ms=per_cell_time * 1000)
+
+
+def per_cell_dict_to_table(nested_dict, symmetric=False):
+    """原 dict_to_table 的做法（对比用）：收集并排序表头，每个单元格 .get 一次"""
+    if symmetric:
+        headers = list(nested_dict)
+        names = headers
+    else:
+        headers = sorted({key for element_data in nested_dict.values() for key in element_data.keys()})
+        names = sorted(nested_dict)
+    table = [[""] + headers]
+    for name in names:
+        element_data = nested_dict[name]
+        table.append([name] + [element_data.get(header, "") for header in headers])
+    return table
+
+
+def bench_wire(args):
+    """
+    表格传输格式：当前的二维数组 JSON 与列式（JSON 列表、base64、二进制帧，见 table_wire.py）的编码耗时与大小（及 gzip 后的大小），
+    以及接收提交的表格的耗时：逐个单元格 float() 的解析、table_ingest 的批量解析（二维数组与列式）；exp 表格稀疏，浓度表稠密
+    """
+    import gzip
+
+    chem_interface = import_interface().chem_interface
+    exp = build_workload(args.wire_trials, args.flask_stocks, args.flask_substances, args.fan_in, seed=args.seed)
+    exp.conc_engine = "matrix"
+    exp.update_all_concentrations()
+    tables = {
+        "exp": chem_interface.dict_to_table({name: entry[1].composite for name, entry in exp.sample_dict.items()}, symmetric=True),
+        "conc": chem_interface.dict_to_table({name: entry[1].substance_conc for name, entry in exp.sample_dict.items()}),
+    }
+    print(f"wire: trials={args.wire_trials}, substances={len(tables['conc'][0]) - 1}")
+    for kind, table in tables.items():
+        response = {"config": {"tableArray": table}}
+
+        def encode(media_type):
+            if media_type == "application/json":
+                return json.dumps(response).encode("utf-8")
+            payload, _ = table_wire.encode_response(response, media_type)
+            return payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+
+        print(f"  {kind} table ({len(table) - 1} x {len(table[0]) - 1}, {table_wire.to_columnar(table)['layout']}):")
+        for name, label, media_type in (("json", "json 2D array", "application/json"),
+                                        ("columnar_json", "columnar json", table_wire.COLUMNAR_JSON),
+                                        ("columnar_base64", "columnar base64", table_wire.COLUMNAR_BASE64),
+                                        ("columnar_binary", "columnar binary", table_wire.COLUMNAR_BINARY)):
+            elapsed = time_call(lambda: encode(media_type), args.repeat)
+            data = encode(media_type)
+            gzipped = len(gzip.compress(data, compresslevel=6))
+            print(f"    {label:16s} encode {elapsed * 1000:9.2f} ms  {len(data) / 1e3:10.1f} KB  gzip {gzipped / 1e3:9.1f} KB")
+            record("wire", **{f"{kind}_{name}_ms": elapsed * 1000, f"{kind}_{name}_bytes": len(data),
+                              f"{kind}_{name}_gzip_bytes": gzipped})
+        # 接收：前端提交的表格单元格为字符串
+        submitted = [table[0]] + [[row[0]] + [str(value) if value != "" else "" for value in row[1:]] for row in table[1:]]
+        columnar = json.loads(json.dumps(table_wire.encode_columnar(table_wire.to_columnar(submitted), table_wire.COLUMNAR_BASE64)))
+        per_cell_time = time_call(lambda: per_cell_table_to_dict(submitted), args.repeat)
+        array_time = time_call(lambda: chem_interface.table_to_dict(submitted), args.repeat)
+        ingest_time = time_call(lambda: table_ingest.ingest_table(submitted), args.repeat)
+        columnar_time = time_call(lambda: chem_interface.table_to_dict(columnar), args.repeat)
+        assert per_cell_table_to_dict(submitted) == chem_interface.table_to_dict(submitted)
+        print(f"    ingest: per-cell float() {per_cell_time * 1000:.2f} ms, table_to_dict {array_time * 1000:.2f} ms, "
+              f"ingest_table (matrix only) {ingest_time * 1000:.2f} ms, columnar base64 {columnar_time * 1000:.2f} ms")
+        record("wire", **{f"{kind}_per_cell_ms": per_cell_time * 1000, f"{kind}_table_to_dict_array_ms": array_time * 1000,
+                          f"{kind}_ingest_table_ms": ingest_time * 1000, f"{kind}_table_to_dict_columnar_ms": columnar_time * 1000})
+
+
+def per_cell_table_to_dict(table_content):
+    """原 table_to_dict 的逐个单元格解析（对比用）"""
+    header = table_content[0]
+    result = {}
+    for row in table_content[1:]:
+        if not row:
+            continue
+        row_dict = {}
+        for key, value in zip(header[1:], row[1:]):
+            if value == "":
+                continue
+            try:
+                row_dict[key] = float(value)
+            except (TypeError, ValueError):
+                row_dict[key] = value
+        result[row[0]] = row_dict
+    return result
+
+
+def bench_inventory(args):
+    """
+    有限量试样的用量检查（inventory.py）：一次提交 --inventory-trials 行配方（每 4 个stock中有一个不够用），
+    对比一次向量化的累加与逐条边扣减剩余量的检查；dict 输入为完整的配方，IngestedTable 只含stock列（整张 exp 表格过大）；
+    另计整个依赖树的 tree_report
+    """
+    exp = build_workload(args.inventory_trials, args.stocks, args.substances, args.fan_in, seed=args.seed)
+    stocks = [name for name, entry in exp.sample_dict.items() if entry[1].stock]
+    stock_set = set(stocks)
+    for i, name in enumerate(stocks):
+        the_stock = exp.sample_dict[name][1]
+        used = sum(the_stock.master.values())
+        the_stock.total_amount = the_stock.existing_amount = used * (0.9 if i % 4 == 0 else 1.1)
+    recipes = {name: dict(entry[1].composite) for name, entry in exp.sample_dict.items() if name not in stock_set}
+    table = [[""] + stocks] + [[name] + [str(composite.get(stock, "")) for stock in stocks]
+                               for name, composite in recipes.items()]
+    ingested = table_ingest.ingest_table(table)
+
+    check = lambda submission: inventory.check_submission(exp, submission, full_table=False, raise_error=False)
+    matrix_time = time_call(lambda: check(ingested), args.repeat)
+    dict_time = time_call(lambda: check(recipes), args.repeat)
+    per_edge_time = time_call(lambda: per_edge_inventory_check(exp, recipes), args.repeat)
+    report = check(ingested)
+    assert report == check(recipes)
+    assert {item["trial"]: item["first_trial"] for item in report} == per_edge_inventory_check(exp, recipes)
+    tree_time = time_call(lambda: inventory.tree_report(exp), args.repeat)
+    print(f"inventory: rows={len(recipes)}, finite stocks={len(stocks)}, over-drawn={len(report)}")
+    print(f"  IngestedTable (stocks):    {matrix_time * 1000:10.2f} ms")
+    print(f"  dict rows:                 {dict_time * 1000:10.2f} ms")
+    print(f"  per-edge decrement:        {per_edge_time * 1000:10.2f} ms")
+    print(f"  whole tree (tree_report):  {tree_time * 1000:10.2f} ms")
+    record("inventory", matrix_ms=matrix_time * 1000, dict_ms=dict_time * 1000, per_edge_ms=per_edge_time * 1000,
+           tree_ms=tree_time * 1000)
+
+
+def per_edge_inventory_check(exp, recipes):
+    """add_to_composite 的做法（对比用）：逐条边扣减剩余量，记录每个有限量试样第一次不够时的使用者"""
+    remaining, first = {}, {}
+    for name, composite in recipes.items():
+        for component, amount in composite.items():
+            the_trial = exp.sample_dict[component][1]
+            if not inventory.is_finite(the_trial):
+                continue
+            if component not in remaining:
+                remaining[component] = the_trial.total_amount - sum(
+                    value for consumer, value in the_trial.master.items() if consumer not in recipes)
+            remaining[component] -= amount
+            if remaining[component] < 0 and component not in first:
+                first[component] = name
+    return first
+
+
+def bench_transaction(args):
+    """
+    批量修改组分关系：给 --transaction-trials 个trial的每个组分换一个用量，
+    对比一次 CompositeTransaction（每个 composite / master 只重建一次）与逐条边的 remove_from_composite / add_to_composite
+    （stock 被上千个trial使用时，逐条修改其 master 的 CompactMap 每次都要线性查找）
+    """
+    rng = random.Random(args.seed)
+    exp = build_workload(args.transaction_trials, args.stocks, args.substances, args.fan_in, seed=args.seed)
+    recipes = {name: {component: round(rng.uniform(1.0, 50.0), 3) for component in entry[1].composite}
+               for name, entry in exp.sample_dict.items() if entry[1].composite}
+
+    def batched():
+        the_exp = build_workload(args.transaction_trials, args.stocks, args.substances, args.fan_in, seed=args.seed)
+        start = time.perf_counter()
+        with the_exp.transaction(check_inventory=False) as changes:
+            for name, composite in recipes.items():
+                changes.set_composite(name, composite)
+        return time.perf_counter() - start, the_exp
+
+    def per_edge():
+        the_exp = build_workload(args.transaction_trials, args.stocks, args.substances, args.fan_in, seed=args.seed)
+        start = time.perf_counter()
+        for name, composite in recipes.items():
+            per_edge_set_composite(the_exp, name, composite)
+        return time.perf_counter() - start, the_exp
+
+    batched_time, batched_exp = min((batched() for _ in range(args.repeat)), key=lambda item: item[0])
+    per_edge_time, per_edge_exp = per_edge()
+    for name, entry in per_edge_exp.sample_dict.items():
+        other = batched_exp.sample_dict[name][1]
+        assert dict(other.composite.items()) == dict(entry[1].composite.items())
+        assert dict(other.master.items()) == dict(entry[1].master.items())
+        assert abs(other.existing_amount - entry[1].existing_amount) < 1e-6
+    edges = sum(len(composite) for composite in recipes.values())
+    print(f"transaction: trials={len(recipes)}, edges={edges}")
+    print(f"  CompositeTransaction:      {batched_time * 1000:10.2f} ms")
+    print(f"  per-edge add/remove:       {per_edge_time * 1000:10.2f} ms")
+    record("transaction", batched_ms=batched_time * 1000, per_edge_ms=per_edge_time * 1000)
+
+
+def per_edge_set_composite(exp, trial_name, composite_dict):
+    """原 Experiment._set_composite 的做法（对比用）：变化的组分逐条 remove_from_composite，再逐条 add_to_composite"""
+    subject_trial = exp.sample_dict[trial_name][1]
+    for composite_name in list(subject_trial.composite):
+        if composite_dict.get(composite_name) != subject_trial.composite[composite_name]:
+            subject_trial.remove_from_composite(composite_name, -1, exp.sample_dict)
+    for composite_name, composite_num in composite_dict.items():
+        if composite_name not in subject_trial.composite:
+            subject_trial.add_to_composite(composite_name, composite_num, exp.sample_dict, regardless_of_negative_amount=True,
+                                           order=exp.composite_order)
+    exp.mark_dirty(trial_name)
+
+
+def bench_topo_order(args):
+    """
+    拓扑顺序（topo_order.py）：
+    1. dict 引擎重算前的排序：原先每次的 Kahn 排序（列表成员判断）对比直接取 composite_order 维护的顺序（含线性核对）；
+    2. 逐条加入 --topo-edges 条随机的组分关系并拒绝成环的：Pearce–Kelly 在线调整对比每加一条边就整体重新排序一次
+    """
+    exp = build_workload(args.topo_trials, args.stocks, args.substances, args.fan_in, seed=args.seed, depth=args.depth)
+    kahn_time = time_call(lambda: kahn_list_order(exp), args.repeat)
+    exp.composite_order.invalidate()
+    rebuild_time = time_call(lambda: exp.composite_order.rebuild(), args.repeat)
+    maintained_time = time_call(exp._trials_in_order, args.repeat)
+    assert exp.composite_order.consistent([t.name for t in kahn_list_order(exp)])
+
+    rng = random.Random(args.seed)
+    names = [name for name, entry in exp.sample_dict.items() if not entry[1].stock]
+    edges = [(rng.choice(names), rng.choice(names)) for _ in range(args.topo_edges)]
+
+    def online():
+        the_exp = build_workload(args.topo_trials, args.stocks, args.substances, args.fan_in, seed=args.seed, depth=args.depth)
+        the_exp.composite_order.positions()
+        accepted = []
+        start = time.perf_counter()
+        for component, consumer in edges:
+            the_trial = the_exp.sample_dict[consumer][1]
+            if component in the_trial.composite:
+                continue
+            try:
+                the_trial.add_to_composite(component, 1.0, the_exp.sample_dict, regardless_of_negative_amount=True,
+                                           order=the_exp.composite_order)
+                accepted.append((component, consumer))
+            except ValueError:
+                pass
+        return time.perf_counter() - start, accepted
+
+    def full_sort():
+        the_exp = build_workload(args.topo_trials, args.stocks, args.substances, args.fan_in, seed=args.seed, depth=args.depth)
+        accepted = []
+        start = time.perf_counter()
+        for component, consumer in edges:
+            the_trial = the_exp.sample_dict[consumer][1]
+            if component in the_trial.composite:
+                continue
+            the_trial.composite[component] = 1.0
+            the_exp.sample_dict[component][1].master[consumer] = 1.0
+            if the_exp.composite_order.rebuild():
+                del the_trial.composite[component]
+                del the_exp.sample_dict[component][1].master[consumer]
+            else:
+                accepted.append((component, consumer))
+        return time.perf_counter() - start, accepted
+
+    online_time, online_accepted = online()
+    full_time, full_accepted = full_sort()
+    assert online_accepted == full_accepted
+    print(f"topo_order: trials={len(names)}, inserted edges={len(edges)} (rejected {len(edges) - len(online_accepted)})")
+    print(f"  Kahn sort (list membership): {kahn_time * 1000:10.2f} ms")
+    print(f"  Kahn rebuild (dicts):        {rebuild_time * 1000:10.2f} ms")
+    print(f"  maintained order + check:    {maintained_time * 1000:10.2f} ms")
+    print(f"  insert, Pearce-Kelly:        {online_time * 1000:10.2f} ms")
+    print(f"  insert, full re-sort:        {full_time * 1000:10.2f} ms")
+    record("topo_order", kahn_ms=kahn_time * 1000, rebuild_ms=rebuild_time * 1000, maintained_ms=maintained_time * 1000,
+           insert_online_ms=online_time * 1000, insert_full_sort_ms=full_time * 1000)
+
+
+def kahn_list_order(exp):
+    """原 update_all_concentrations 的排序（对比用）：普通试样放在列表中，依赖与剩余节点都用列表成员判断"""
+    trials = [entry[1] for entry in exp.sample_dict.values() if not entry[1].stock and not entry[1].solvent]
+    adj, in_degree = {}, {}
+    for the_trial in trials:
+        for comp_name in the_trial.composite:
+            comp_trial = exp.sample_dict[comp_name][1]
+            if comp_trial in trials:
+                adj.setdefault(comp_trial, []).append(the_trial)
+                in_degree[the_trial] = in_degree.get(the_trial, 0) + 1
+    queue = [t for t in trials if in_degree.get(t, 0) == 0]
+    sorted_trials = []
+    while queue:
+        current = queue.pop(0)
+        sorted_trials.append(current)
+        for neighbor in adj.get(current, ()):
+            in_degree[neighbor] -= 1
+            if in_degree[neighbor] == 0:
+                queue.append(neighbor)
+    if [t for t in trials if t not in sorted_trials]:
+        raise ValueError("存在循环依赖")
+    return sorted_trials
+
+
+def bench_journal_recovery(args):
+    """操作日志：重启恢复耗时，比较不压缩（重放全部日志）与每 compact_every 条压缩一次（快照 + 最多 compact_every 条）"""
+    chem_interface = import_interface().chem_interface
+    rng = random.Random(args.seed)
+    substances = [f"S{k}" for k in range(20)]
+    stock_names = [f"stock_{k}" for k in range(args.stocks)]
+    results = []
+    for compact_every in (args.journal_ops + 2, args.journal_compact_every):
+        directory = tempfile.mkdtemp()
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            the_interface = chem_interface(journal_dir=directory, compact_every=compact_every)
+            the_interface.journal.fsync = False
+            the_interface.create_exp("E", "exp_0")
+            for _ in range(args.journal_ops):
+                table = [[""] + substances]
+                for name in stock_names:
+                    table.append([name] + [str(round(rng.uniform(0.1, 5), 3)) if rng.random() < 0.15 else "" for _ in substances])
+                the_interface.update_stock("E", "exp_0", table, {"Stocks of Experiment name": "E"}, {})
+            the_interface.journal.close()
+            start = time.perf_counter()
+            recovered = chem_interface(journal_dir=directory, compact_every=compact_every)
+            elapsed = time.perf_counter() - start
+            replayed = recovered.journal.entries_since_snapshot
+            recovered.journal.close()
+        shutil.rmtree(directory)
+        results.append((compact_every, replayed, elapsed))
+
+    print(f"journal recovery: ops={args.journal_ops + 1} stocks={args.stocks}")
+    for compact_every, replayed, elapsed in results:
+        print(f"  compact_every={compact_every:<6} replayed={replayed:<6} {elapsed * 1000:10.2f} ms")
+    record("journal", replay_all_ms=results[0][2] * 1000, snapshot_and_tail_ms=results[1][2] * 1000)
+
+
+def import_interface():
+    """导入 interface（Flask 应用）；导入时会创建模块级的 chem_interface，这里不让它打开默认的 journal 目录"""
+    os.environ["CHEM_TABLE_JOURNAL"] = ""
+    import interface
+    return interface
+
+
+def time_with_setup(setup, func, repeat):
+    """每次计时前调用 setup() 准备新的输入（不计入耗时），返回 func(输入) 的最短耗时与最后一次的返回值"""
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        prepared = setup()
+        start = time.perf_counter()
+        result = func(prepared)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def peak_bytes(func):
+    """func() 执行期间 tracemalloc 统计到的内存峰值（相对开始时）"""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak - base
+
+
+def exp_table_of(exp):
+    """把实验的 composite 关系写成前端 exp 表格（对称二维数组，数值为字符串，与前端提交的一致）"""
+    names = list(exp.sample_dict)
+    column = {name: j for j, name in enumerate(names, start=1)}
+    table = [[""] + names]
+    for name in names:
+        row = [name] + [""] * len(names)
+        for comp_name, amount in exp.sample_dict[name][1].composite.items():
+            row[column[comp_name]] = str(round(amount, 4))
+        table.append(row)
+    return table
+
+
+def stock_table_of(exp):
+    """stock 的浓度表（前端 conc 表格）"""
+    substances = sorted({sub for entry in exp.sample_dict.values() if entry[1].stock for sub in entry[1].substance_conc})
+    table = [[""] + substances]
+    for name, entry in exp.sample_dict.items():
+        if entry[1].stock:
+            conc = entry[1].substance_conc
+            table.append([name] + [str(round(conc[sub], 4)) if sub in conc else "" for sub in substances])
+    return table
+
+
+def fresh_stock_experiment(exp):
+    """只含 exp 中stock的新实验，用于计时 new_exp_from_2d_array 的首次提交"""
+    the_exp = Experiment("benchmark", table_id="benchmark")
+    for name, entry in exp.sample_dict.items():
+        if entry[1].stock:
+            the_exp.generate_trial(trial(name=name, exp_name="benchmark", id=name,
+                                         substance_conc=dict(entry[1].substance_conc.items()), stock=True))
+    return the_exp
+
+
+def bench_stages(args):
+    """
+    分阶段计时：按 --stage-trials/--depth/--fan-in 生成分层 DAG，
+    计时 update_all_concentrations、dict_to_table、table_to_dict、new_exp_from_2d_array（首次提交与改一个单元格后的再次提交）
+    """
+    chem_interface = import_interface().chem_interface
+    exp = build_workload(args.stage_trials, args.stocks, args.substances, args.fan_in, seed=args.seed, depth=args.depth)
+    trial_ids = [f"benchmark_trial_{i}" for i in range(len(exp.sample_dict))]
+
+    update_all_time = time_call(exp.update_all_concentrations, args.repeat)
+    composite_dict = {name: entry[1].composite for name, entry in exp.sample_dict.items()}
+    dict_to_table_time = time_call(lambda: chem_interface.dict_to_table(composite_dict, symmetric=True), args.repeat)
+    table = exp_table_of(exp)
+    table_to_dict_time = time_call(lambda: chem_interface.table_to_dict(table), args.repeat)
+    table_dict = chem_interface.table_to_dict(table)
+
+    first_submit_time, _ = time_with_setup(
+        lambda: fresh_stock_experiment(exp),
+        lambda the_exp: the_exp.new_exp_from_2d_array(table_dict, trial_ids), args.repeat)
+
+    submitted = fresh_stock_experiment(exp)
+    submitted.new_exp_from_2d_array(table_dict, trial_ids)
+    submitted.update_all_concentrations()
+    edited_name = f"trial_{args.stage_trials // 2}"
+
+    def edit_one_cell(_):
+        edited = {name: dict(row) for name, row in table_dict.items()}
+        comp_name = next(iter(edited[edited_name]))
+        edited[edited_name][comp_name] *= 1.01
+        table_dict[edited_name][comp_name] = edited[edited_name][comp_name]
+        return submitted.new_exp_from_2d_array(edited, trial_ids)
+
+    resubmit_time, _ = time_with_setup(lambda: None, edit_one_cell, args.repeat)
+
+    def full_pipeline():
+        the_exp = fresh_stock_experiment(exp)
+        the_exp.new_exp_from_2d_array(chem_interface.table_to_dict(table), trial_ids)
+        the_exp.update_all_concentrations()
+
+    pipeline_peak = peak_bytes(full_pipeline)
+    edges = sum(len(entry[1].composite) for entry in exp.sample_dict.values())
+
+    print(f"stages: trials={args.stage_trials} stocks={args.stocks} depth={args.depth} fan_in={args.fan_in} edges={edges}")
+    print(f"  update_all_concentrations:      {update_all_time * 1000:10.2f} ms")
+    print(f"  dict_to_table (exp table):      {dict_to_table_time * 1000:10.2f} ms")
+    print(f"  table_to_dict (exp table):      {table_to_dict_time * 1000:10.2f} ms")
+    print(f"  new_exp_from_2d_array (first):  {first_submit_time * 1000:10.2f} ms")
+    print(f"  new_exp_from_2d_array (1 cell): {resubmit_time * 1000:10.2f} ms")
+    print(f"  peak memory of table_to_dict + new_exp_from_2d_array + update_all: {pipeline_peak / 1e6:.1f} MB")
+    record("stages", update_all_ms=update_all_time * 1000, dict_to_table_ms=dict_to_table_time * 1000,
+           table_to_dict_ms=table_to_dict_time * 1000, first_submit_ms=first_submit_time * 1000,
+           resubmit_one_cell_ms=resubmit_time * 1000, pipeline_peak_bytes=pipeline_peak, edges=edges)
+
+
+def bench_flask(args):
+    """
+    通过 Flask 测试客户端的完整 /config_acceptor 往返：提交stock表、首次提交exp表、逐次修改一个单元格再提交、
+    请求浓度表与exp表（首次、实验未变时再次请求命中缓存、带 If-None-Match 得到 304）、
+    修改一个单元格后提交stock表时带上客户端exp表格的版本（delta 响应）与不带（整表）；
+    报告每种请求的耗时与响应大小、修改提交的吞吐量以及整个流程的内存峰值
+    """
+    interface = import_interface()
+    exp = build_workload(args.flask_trials, args.flask_stocks, args.flask_substances, args.fan_in,
+                         seed=args.seed, depth=args.depth)
+    stock_table = stock_table_of(exp)
+    table = exp_table_of(exp)
+    edit_rows = [i for i, row in enumerate(table) if i > 0 and any(row[1:])]
+    client = interface.app.test_client()
+
+    def post(exp_name, root_id, table_type, instruction, content, header, if_none_match=None, table_versions=None):
+        start = time.perf_counter()
+        response = client.post('/config_acceptor', json={
+            "exp_name": exp_name, "rootId": root_id, "config": {"table_type": table_type, "instruction": instruction},
+            "table_content": content, "header_cell_content": header, "table_versions": table_versions},
+            headers={"If-None-Match": if_none_match} if if_none_match else None)
+        elapsed = time.perf_counter() - start
+        if response.status_code != (304 if if_none_match else 200):
+            raise RuntimeError(f"{table_type}/{instruction} 失败: {response.status_code} {response.get_data()[:200]}")
+        last_response[0] = response
+        return elapsed, len(response.get_data())
+
+    last_response = [None]
+
+    def scenario(k):
+        exp_name, root_id = f"bench_{k}", f"bench_exp_{k}"
+        client.post('/create_exp', json={"exp_name": exp_name, "exp_id": root_id})
+        timings = {}
+        timings["conc_update_ms"] = post(exp_name, root_id, "conc", "update", stock_table,
+                                         {"Stocks of Experiment name": exp_name})[0] * 1000
+        timings["exp_first_update_ms"] = post(exp_name, root_id, "exp", "update", table,
+                                              {"Experiment name": exp_name})[0] * 1000
+        rng = random.Random(args.seed)
+        edited = [row[:] for row in table]
+        edit_total = 0.0
+        for _ in range(args.flask_requests):
+            row = edited[rng.choice(edit_rows)]
+            col = next(j for j in range(1, len(row)) if row[j])
+            row[col] = str(round(float(row[col]) * 1.01, 4))
+            edit_total += post(exp_name, root_id, "exp", "update", edited, {"Experiment name": exp_name})[0]
+        timings["exp_edit_update_ms"] = edit_total * 1000 / args.flask_requests
+        timings["exp_edit_update_per_s"] = args.flask_requests / edit_total
+        elapsed, nbytes = post(exp_name, root_id, "exp", "conc_table", edited, {"Experiment name": exp_name})
+        timings["conc_table_ms"], timings["conc_table_response_bytes"] = elapsed * 1000, nbytes
+        timings["conc_table_cached_ms"] = post(exp_name, root_id, "exp", "conc_table", edited,
+                                               {"Experiment name": exp_name})[0] * 1000
+        timings["conc_table_304_ms"] = post(exp_name, root_id, "exp", "conc_table", edited,
+                                            {"Experiment name": exp_name}, last_response[0].headers["ETag"])[0] * 1000
+        elapsed, nbytes = post(exp_name, root_id, "exp", "exp_table", edited, {"Experiment name": exp_name})
+        timings["exp_table_ms"], timings["exp_table_response_bytes"] = elapsed * 1000, nbytes
+        exp_table_version = last_response[0].get_json()["config"]["table_version"]
+        timings["exp_table_304_ms"] = post(exp_name, root_id, "exp", "exp_table", edited,
+                                           {"Experiment name": exp_name}, last_response[0].headers["ETag"])[0] * 1000
+        row = edited[edit_rows[0]]
+        col = next(j for j in range(1, len(row)) if row[j])
+        row[col] = str(round(float(row[col]) * 1.01, 4))
+        post(exp_name, root_id, "exp", "update", edited, {"Experiment name": exp_name})
+        elapsed, nbytes = post(exp_name, root_id, "conc", "update", stock_table, {"Stocks of Experiment name": exp_name},
+                               table_versions={"exp": exp_table_version})
+        if "delta" not in last_response[0].get_json()["config"]:
+            raise RuntimeError("conc/update 没有返回 delta")
+        timings["conc_update_delta_ms"], timings["conc_update_delta_bytes"] = elapsed * 1000, nbytes
+        elapsed, nbytes = post(exp_name, root_id, "conc", "update", stock_table, {"Stocks of Experiment name": exp_name})
+        timings["conc_update_full_ms"], timings["conc_update_full_bytes"] = elapsed * 1000, nbytes
+        interface.this_interface.remove_experiment(exp_name=exp_name)
+        return timings
+
+    timings = scenario(0)
+    timings["scenario_peak_bytes"] = peak_bytes(lambda: scenario(1))
+
+    print(f"flask round trips: trials={args.flask_trials} stocks={args.flask_stocks} substances={args.flask_substances} "
+          f"table={len(table)}x{len(table[0])}")
+    print(f"  conc update:              {timings['conc_update_ms']:10.2f} ms")
+    print(f"  exp update (first):       {timings['exp_first_update_ms']:10.2f} ms")
+    print(f"  exp update (1 cell):      {timings['exp_edit_update_ms']:10.2f} ms  ({timings['exp_edit_update_per_s']:.1f} req/s)")
+    print(f"  exp conc_table:           {timings['conc_table_ms']:10.2f} ms  ({timings['conc_table_response_bytes'] / 1e3:.0f} KB)")
+    print(f"  exp conc_table (cached):  {timings['conc_table_cached_ms']:10.2f} ms")
+    print(f"  exp conc_table (304):     {timings['conc_table_304_ms']:10.2f} ms")
+    print(f"  exp exp_table:            {timings['exp_table_ms']:10.2f} ms  ({timings['exp_table_response_bytes'] / 1e3:.0f} KB)")
+    print(f"  exp exp_table (304):      {timings['exp_table_304_ms']:10.2f} ms")
+    print(f"  conc update, exp delta:   {timings['conc_update_delta_ms']:10.2f} ms  ({timings['conc_update_delta_bytes'] / 1e3:.1f} KB)")
+    print(f"  conc update, full exp:    {timings['conc_update_full_ms']:10.2f} ms  ({timings['conc_update_full_bytes'] / 1e3:.1f} KB)")
+    print(f"  peak memory of the whole scenario: {timings['scenario_peak_bytes'] / 1e6:.1f} MB")
+    record("flask", **timings)
+
+
+def bench_concurrency(args):
+    """
+    并发压力测试：--stress-threads 个线程各用一个 Flask 测试客户端，随机对 --stress-exps 个实验提交修改（exp update）
+    或请求表格（conc_table/exp_table），日志每 10 条压缩一次；结束后检查没有出错的请求、每个实验的浓度与全量重算一致，
+    以及从日志恢复出的状态与内存中的状态一致
+    """
+    interface = import_interface()
+    directory = tempfile.mkdtemp()
+    stress_interface = interface.chem_interface(journal_dir=directory, compact_every=10)
+    stress_interface.journal.fsync = False
+    previous_interface, interface.this_interface = interface.this_interface, stress_interface
+
+    exp = build_workload(args.stress_trials, args.flask_stocks, args.flask_substances, args.fan_in,
+                         seed=args.seed, depth=args.depth)
+    stock_table, table = stock_table_of(exp), exp_table_of(exp)
+    edit_rows = [i for i, row in enumerate(table) if i > 0 and any(row[1:])]
+    exp_names = [(f"stress_{k}", f"stress_exp_{k}") for k in range(args.stress_exps)]
+
+    def post(client, exp_name, root_id, table_type, instruction, content, header):
+        return client.post('/config_acceptor', json={
+            "exp_name": exp_name, "rootId": root_id, "config": {"table_type": table_type, "instruction": instruction},
+            "table_content": content, "header_cell_content": header})
+
+    client = interface.app.test_client()
+    for exp_name, root_id in exp_names:
+        client.post('/create_exp', json={"exp_name": exp_name, "exp_id": root_id})
+        post(client, exp_name, root_id, "conc", "update", stock_table, {"Stocks of Experiment name": exp_name})
+        post(client, exp_name, root_id, "exp", "update", table, {"Experiment name": exp_name})
+
+    errors, counts = [], {"read": 0, "write": 0}
+    counts_lock = threading.Lock()
+
+    def worker(k):
+        rng = random.Random(args.seed + k)
+        worker_client = interface.app.test_client()
+        tables = {root_id: [row[:] for row in table] for _, root_id in exp_names}
+        for _ in range(args.stress_ops):
+            exp_name, root_id = rng.choice(exp_names)
+            edited = tables[root_id]
+            if rng.random() < 0.6:
+                row = edited[rng.choice(edit_rows)]
+                col = next(j for j in range(1, len(row)) if row[j])
+                row[col] = str(round(float(row[col]) * rng.uniform(0.9, 1.1), 4))
+                kind, response = "write", post(worker_client, exp_name, root_id, "exp", "update", edited,
+                                               {"Experiment name": exp_name})
+            else:
+                instruction = rng.choice(["conc_table", "exp_table"])
+                kind, response = "read", post(worker_client, exp_name, root_id, "exp", instruction, edited,
+                                              {"Experiment name": exp_name})
+            with counts_lock:
+                counts[kind] += 1
+                if response.status_code != 200:
+                    errors.append(response.get_json())
+
+    threads = [threading.Thread(target=worker, args=(k,)) for k in range(args.stress_threads)]
+    # 缩短线程切换间隔，让请求在更多位置交错（没有锁时很快会出现错误结果或“存在循环依赖”之类的异常）
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5)
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    sys.setswitchinterval(switch_interval)
+    interface.this_interface = previous_interface
+
+    consistent = True
+    for exp_name, _ in exp_names:
+        the_exp = stress_interface.get_experiment(exp_name=exp_name)
+        before = snapshot_concentrations(the_exp)
+        the_exp.update_all_concentrations()
+        consistent = consistent and same_concentrations(before, snapshot_concentrations(the_exp))
+
+    def state(the_interface):
+        return {exp_name: (entry[0], {name: (dict(item[1].composite.items()), dict(item[1].substance_conc.items()))
+                                      for name, item in entry[1].sample_dict.items()})
+                for exp_name, entry in the_interface.dict_of_experiment.items()}
+
+    stress_interface.journal.close()
+    recovered = interface.chem_interface(journal_dir=directory, compact_every=10)
+    recovered.journal.close()
+    recovered_same = state(recovered) == state(stress_interface)
+    shutil.rmtree(directory)
+
+    total = counts["read"] + counts["write"]
+    print(f"concurrency stress: threads={args.stress_threads} experiments={args.stress_exps} "
+          f"trials={args.stress_trials} requests={total} (read {counts['read']}, write {counts['write']})")
+    print(f"  throughput:                 {total / elapsed:10.1f} req/s")
+    print(f"  failed requests:            {len(errors):10d}  {errors[:1] if errors else ''}")
+    print(f"  concentrations consistent:  {consistent}")
+    print(f"  journal recovery identical: {recovered_same}")
+    record("concurrency", requests_per_s=total / elapsed, failed=len(errors),
+           consistent=consistent, recovered_identical=recovered_same)
+
+
+def compare_results(baseline, current, tolerance):
+    """
+    逐项对比两次的结果，只比较方向明确的指标（_ms/_bytes 越小越好，_per_s 越大越好）
+    :return: 变差超过 tolerance（相对值）的指标列表，非空时脚本以返回码1退出
+    """
+    regressions = []
+    print(f"compare with baseline (tolerance {tolerance:.0%}):")
+    for section, values in current.items():
+        for metric, value in values.items():
+            old = baseline.get(section, {}).get(metric)
+            if old is None or not old:
+                continue
+            if metric.endswith("_per_s"):
+                change = old / value - 1 if value else float("inf")
+            elif "_ms" in metric or metric.endswith("_bytes"):
+                change = value / old - 1
+            else:
+                continue
+            flag = "worse" if change > tolerance else "better" if change < -tolerance else ""
+            if flag == "worse":
+                regressions.append(f"{section}.{metric}")
+            print(f"  {section + '.' + metric:45s} {old:14.3f} -> {value:14.3f}  {change:+7.1%} {flag}")
+    return regressions
+
+
+def bench_formulation_suite(args):
+    print(f"design_concentration_advanced: stocks={args.stocks} substances={args.formulation_substances}")
+    bench_formulation(args)
+
+
+SUITES = {
+    "engines": bench_concentration_engines,
+    "incremental": bench_incremental_recompute,
+    "parallel": bench_parallel_recompute,
+    "stages": bench_stages,
+    "flask": bench_flask,
+    "trial_memory": bench_trial_memory,
+    "compact_map": bench_compact_map,
+    "formulation": bench_formulation_suite,
+    "plate": bench_plate,
+    "snapshot": bench_snapshot,
+    "journal": bench_journal_recovery,
+    "concurrency": bench_concurrency,
+    "export": bench_export,
+    "window": bench_window,
+    "wire": bench_wire,
+    "render": bench_render,
+    "inventory": bench_inventory,
+    "transaction": bench_transaction,
+    "topo_order": bench_topo_order,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="chemical_table benchmarks")
+    parser.add_argument("--trials", type=int, default=3000)
+    parser.add_argument("--stocks", type=int, default=200)
+    parser.add_argument("--substances", type=int, default=300)
+    parser.add_argument("--fan-in", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fanout-keys", type=int, default=50000)
+    parser.add_argument("--fanout-lookups", type=int, default=5000)
+    parser.add_argument("--formulation-substances", type=int, default=50)
+    parser.add_argument("--formulation-targets", type=int, default=20)
+    parser.add_argument("--plate-wells", type=int, default=96)
+    parser.add_argument("--snapshot-trials", type=int, default=50000)
+    parser.add_argument("--journal-ops", type=int, default=500)
+    parser.add_argument("--journal-compact-every", type=int, default=50)
+    parser.add_argument("--stage-trials", type=int, default=1000)
+    parser.add_argument("--depth", type=int, default=8, help="分层 DAG 的层数（stages 与 flask 基准）")
+    parser.add_argument("--flask-trials", type=int, default=300)
+    parser.add_argument("--flask-stocks", type=int, default=30)
+    parser.add_argument("--flask-substances", type=int, default=20)
+    parser.add_argument("--flask-requests", type=int, default=20)
+    parser.add_argument("--export-trials", type=int, default=100000)
+    parser.add_argument("--export-xlsx-trials", type=int, default=20000)
+    parser.add_argument("--window-trials", type=int, default=100000)
+    parser.add_argument("--wire-trials", type=int, default=1000)
+    parser.add_argument("--render-trials", type=int, default=5000)
+    parser.add_argument("--render-exp-trials", type=int, default=1000)
+    parser.add_argument("--inventory-trials", type=int, default=20000)
+    parser.add_argument("--transaction-trials", type=int, default=20000)
+    parser.add_argument("--topo-trials", type=int, default=5000)
+    parser.add_argument("--topo-edges", type=int, default=300)
+    parser.add_argument("--parallel-trials", type=int, default=50000)
+    parser.add_argument("--parallel-families", type=int, default=16)
+    parser.add_argument("--stress-threads", type=int, default=8)
+    parser.add_argument("--stress-exps", type=int, default=4)
+    parser.add_argument("--stress-trials", type=int, default=60)
+    parser.add_argument("--stress-ops", type=int, default=40, help="每个线程的请求数")
+    parser.add_argument("--suite", default=",".join(SUITES), help=f"逗号分隔，可选: {','.join(SUITES)}")
+    parser.add_argument("--json", help="把结果保存为JSON文件")
+    parser.add_argument("--compare", help="与之前 --json 保存的结果对比")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="对比时视为变化的相对幅度")
+    args = parser.parse_args()
+
+    for name in args.suite.split(","):
+        if name not in SUITES:
+            parser.error(f"未知的基准 {name}")
+        SUITES[name](args)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"meta": {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "python": sys.version.split()[0],
+                                "numpy": np.__version__, "platform": platform.platform(), "args": vars(args)},
+                       "results": RESULTS}, f, ensure_ascii=False, indent=1)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        ignored = ("suite", "json", "compare", "tolerance")
+        differing = [key for key, value in vars(args).items()
+                     if key not in ignored and baseline["meta"]["args"].get(key) != value]
+        if differing:
+            print(f"warning: workload arguments differ from the baseline: {', '.join(differing)}")
+        if compare_results(baseline["results"], RESULTS, args.tolerance):
+            sys.exit(1)
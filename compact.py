@@ -0,0 +1,246 @@
+import threading
+from array import array
+from collections.abc import Mapping, MutableMapping
+from operator import itemgetter
+
+
+class NameTable:
+    """
+    名字驻留表：把名字（trial名、物质名）映射为从0开始的整数id，每个 Experiment 各有一张
+    id 只增不减，名字被删除或改名后旧 id 仍然保留，保证已有的 id 不会指向别的名字
+    """
+    __slots__ = ("_ids", "_names")
+
+    def __init__(self):
+        self._ids = {}
+        self._names = []
+
+    def intern(self, name):
+        """返回名字的id，没有则新分配一个"""
+        name_id = self._ids.get(name)
+        if name_id is None:
+            name_id = len(self._names)
+            self._ids[name] = name_id
+            self._names.append(name)
+        return name_id
+
+    def lookup(self, name):
+        """返回名字的id，没有则返回 None（不分配）"""
+        return self._ids.get(name)
+
+    def intern_many(self, names):
+        """批量返回名字的id列表，没有的名字新分配id"""
+        name_ids = list(map(self._ids.get, names))
+        if None in name_ids:
+            name_ids = [self.intern(name) for name in names]
+        return name_ids
+
+    def names_of(self, name_ids):
+        """批量把id还原为名字列表"""
+        if len(name_ids) == 1:
+            return [self._names[int(name_ids[0])]]
+        return list(itemgetter(*map(int, name_ids))(self._names))
+
+    def name(self, name_id):
+        return self._names[name_id]
+
+    def __len__(self):
+        return len(self._names)
+
+
+# CompactMap 在读取时建立索引所用的锁（见 CompactMap._build_index）
+_INDEX_LOCK = threading.Lock()
+
+
+class CompactMap(MutableMapping):
+    """
+    以 array('d') 存储的 {名字: 数值} 映射，用于 trial 的 composite / master / substance_conc
+    数组前半段为键在 NameTable 中的 id，后半段为对应的值：[k0, k1, ..., v0, v1, ...]，
+    每个条目只占16字节（dict 每个条目约需 100 字节以上，包括单独的 float 对象）；空映射不分配数组
+    条目数超过 INDEX_MIN_SIZE 后（如被上千个trial使用的 stock 的 master）键、值改存为两个数组（_data、_values），
+    另建 {id: 下标} 的索引：查找、新增为 O(1)，不再线性扫描、也不再为新增的键整体移动后半段；
+    删除时更新其后各键的下标（与数组的删除一样为 O(n)；trial 改名用 rename，只改一项）
+    拆分只在构建和写入时进行（_split）；索引在第一次查找时建立（多数大的 substance_conc 只被遍历，不必为它们建索引），
+    建好后整体赋给 _index：多个线程在实验的读锁下同时读取同一个映射时不会看到一半的状态
+    对外提供与 dict 相同的接口，items()/keys()/values() 返回列表快照，遍历时可以安全地修改映射
+    """
+    __slots__ = ("_table", "_data", "_values", "_index")
+    INDEX_MIN_SIZE = 64
+
+    def __init__(self, table, data=None):
+        self._table = table
+        self._data = None
+        self._values = None
+        self._index = None
+        if not data:
+            return
+        if isinstance(data, CompactMap) and data._table is table:
+            self._data = array("d", data.raw())
+        elif isinstance(data, Mapping):
+            # 映射的键互不相同，直接一次性构建数组
+            self._data = array("d", table.intern_many(list(data.keys())))
+            self._data.extend(data.values())
+        else:
+            for key, value in data:
+                self[key] = value
+            return
+        self._split()
+
+    def _split(self):
+        """条目数超过 INDEX_MIN_SIZE 的映射改为键、值分开存放（_data 只存键）；只在构建与写入时调用，读取时不改变存放方式"""
+        size = len(self._data) // 2
+        if self._values is None and size > self.INDEX_MIN_SIZE:
+            values = self._data[size:]
+            del self._data[size:]
+            self._values = values
+
+    def _build_index(self):
+        """建立 {id: 下标} 的索引；可能在读锁下被多个线程同时调用，由模块锁保证只建一次，建好后才赋给 _index"""
+        with _INDEX_LOCK:
+            index = self._index
+            if index is None:
+                index = self._index = dict(zip(self._data, range(len(self._data))))
+            return index
+
+    def _value_slot(self):
+        """(值所在的数组, 值的起始下标)"""
+        if self._values is not None:
+            return self._values, 0
+        return self._data, len(self._data) // 2
+
+    def _position(self, key):
+        """键在键数组中的下标，不存在时返回 -1"""
+        if self._data is None:
+            return -1
+        name_id = self._table.lookup(key)
+        if name_id is None:
+            return -1
+        if self._values is not None:
+            index = self._index
+            if index is None:
+                index = self._build_index()
+            return index.get(name_id, -1)
+        try:
+            return self._data.index(name_id, 0, len(self._data) // 2)
+        except ValueError:
+            return -1
+
+    def __getitem__(self, key):
+        pos = self._position(key)
+        if pos < 0:
+            raise KeyError(key)
+        values, offset = self._value_slot()
+        return values[offset + pos]
+
+    def __setitem__(self, key, value):
+        pos = self._position(key)
+        if pos >= 0:
+            values, offset = self._value_slot()
+            values[offset + pos] = value
+            return
+        name_id = self._table.intern(key)
+        if self._values is not None:
+            if self._index is not None:
+                self._index[name_id] = len(self._data)
+            self._data.append(name_id)
+            self._values.append(value)
+            return
+        if self._data is None:
+            self._data = array("d")
+        size = len(self._data) // 2
+        self._data.insert(size, name_id)
+        self._data.append(value)
+        self._split()
+
+    def __delitem__(self, key):
+        pos = self._position(key)
+        if pos < 0:
+            raise KeyError(key)
+        if len(self) == 1:
+            self.clear()
+            return
+        values, offset = self._value_slot()
+        del values[offset + pos]
+        name_id = self._data.pop(pos)
+        if self._index is not None:
+            # 其后的键前移一位，只更新这一段的下标
+            del self._index[name_id]
+            self._index.update(zip(self._data[pos:], range(pos, len(self._data))))
+
+    def rename(self, old_key, new_key):
+        """
+        把键 old_key 改为 new_key，值与位置不变；trial 改名时更新引用它的映射，
+        与 pop 后再赋值不同，不需重建大映射的索引（new_key 已存在时仍按 pop 后再赋值处理）
+        """
+        pos = self._position(old_key)
+        if pos < 0:
+            raise KeyError(old_key)
+        if new_key != old_key and self._position(new_key) >= 0:
+            self[new_key] = self.pop(old_key)
+            return
+        name_id = self._table.intern(new_key)
+        if self._index is not None:
+            del self._index[self._data[pos]]
+            self._index[name_id] = pos
+        self._data[pos] = name_id
+
+    def __contains__(self, key):
+        return self._position(key) >= 0
+
+    def __len__(self):
+        if self._data is None:
+            return 0
+        return len(self._data) if self._values is not None else len(self._data) // 2
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        if self._data is None:
+            return []
+        return self._table.names_of(self._data[:len(self)])
+
+    def values(self):
+        if self._data is None:
+            return []
+        values, offset = self._value_slot()
+        return values[offset:].tolist()
+
+    def items(self):
+        return list(zip(self.keys(), self.values()))
+
+    @classmethod
+    def from_raw(cls, table, data):
+        """直接用已按 [k0, k1, ..., v0, v1, ...] 排好的 array('d') 构建（如快照加载），不做检查与复制"""
+        the_map = cls.__new__(cls)
+        the_map._table = table
+        the_map._data = data if data else None
+        the_map._values = None
+        the_map._index = None
+        if the_map._data is not None:
+            the_map._split()
+        return the_map
+
+    def raw(self):
+        """
+        [k0, k1, ..., v0, v1, ...] 排列的 array('d')（空映射为 None），供快照等批量读取，调用方不应修改；
+        键、值分开存放的大映射返回拼接后的新数组
+        """
+        if self._values is not None:
+            return self._data + self._values
+        return self._data
+
+    @property
+    def table(self):
+        return self._table
+
+    def copy(self):
+        return dict(self.items())
+
+    def clear(self):
+        self._data = None
+        self._values = None
+        self._index = None
+
+    def __repr__(self):
+        return repr(self.copy())
@@ -0,0 +1,314 @@
+import atexit
+import threading
+
+import numpy as np
+from typing import Dict, List, Any
+
+
+def collect_mixing_arrays(sample_dict: Dict[str, List[Any]]):
+    """
+    从 sample_dict 构建矩阵浓度引擎需要的紧凑数组
+    :param sample_dict: Experiment.sample_dict，键为trial名字，值为列表[id，路由]
+    :return: 字典，包含：
+        trial_names: 按 sample_dict 顺序的trial名字列表，其下标即矩阵的行号
+        fixed: bool数组，True表示stock/solvent，其浓度保持不变
+        edge_row, edge_col, edge_vol: trial×trial 混合矩阵的COO形式，edge_row 的试样使用了 edge_col 的试样 edge_vol 的量
+        totals: 每个trial的composite总用量（包含找不到的组分，与 _calculate_trial_concentration 一致）
+        substance_names: 所有stock中出现的物质名，其下标即矩阵的列号
+        base_conc, base_mask: stock×substance 的浓度矩阵及"该物质是否出现"的掩码（非stock行全为0/False）
+    """
+    trial_names = list(sample_dict.keys())
+    trial_index = {name: i for i, name in enumerate(trial_names)}
+    n = len(trial_names)
+
+    fixed = np.zeros(n, dtype=bool)
+    totals = np.zeros(n, dtype=np.float64)
+    edge_row, edge_col, edge_vol = [], [], []
+    substance_index = {}
+    stock_row, stock_col, stock_val = [], [], []
+
+    for i, name in enumerate(trial_names):
+        the_trial = sample_dict[name][1]
+        if the_trial.stock or the_trial.solvent:
+            fixed[i] = True
+            for sub, conc in the_trial.substance_conc.items():
+                if sub not in substance_index:
+                    substance_index[sub] = len(substance_index)
+                stock_row.append(i)
+                stock_col.append(substance_index[sub])
+                stock_val.append(conc)
+            continue
+        total = 0.0
+        for comp_name, vol_used in the_trial.composite.items():
+            total += vol_used
+            j = trial_index.get(comp_name)
+            if j is None:
+                continue
+            edge_row.append(i)
+            edge_col.append(j)
+            edge_vol.append(vol_used)
+        totals[i] = total
+
+    substance_names = list(substance_index.keys())
+    base_conc = np.zeros((n, len(substance_names)), dtype=np.float64)
+    base_mask = np.zeros((n, len(substance_names)), dtype=bool)
+    if stock_row:
+        base_conc[stock_row, stock_col] = stock_val
+        base_mask[stock_row, stock_col] = True
+
+    return {
+        "trial_names": trial_names,
+        "fixed": fixed,
+        "edge_row": np.asarray(edge_row, dtype=np.int64),
+        "edge_col": np.asarray(edge_col, dtype=np.int64),
+        "edge_vol": np.asarray(edge_vol, dtype=np.float64),
+        "totals": totals,
+        "substance_names": substance_names,
+        "base_conc": base_conc,
+        "base_mask": base_mask,
+    }
+
+
+def topological_levels(n, edge_row, edge_col):
+    """
+    对 trial 图做分层的Kahn拓扑排序（向量化，每层一次numpy操作）
+    边 edge_col -> edge_row 表示 edge_row 依赖 edge_col
+    :return: (levels, remaining)，levels 为每层节点下标数组的列表；remaining 为因循环依赖未能排序的节点下标（升序）
+    """
+    in_degree = np.bincount(edge_row, minlength=n)
+    # 按来源节点分组的出边（CSR）
+    order = np.argsort(edge_col, kind="stable")
+    out_targets = edge_row[order]
+    out_ptr = np.searchsorted(edge_col[order], np.arange(n + 1))
+
+    levels = []
+    frontier = np.flatnonzero(in_degree == 0)
+    visited = 0
+    while frontier.size:
+        levels.append(frontier)
+        visited += frontier.size
+        starts = out_ptr[frontier]
+        counts = out_ptr[frontier + 1] - starts
+        if counts.sum() == 0:
+            break
+        # 把每个frontier节点的出边区间拼接为一个下标数组
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        targets = out_targets[offsets + np.arange(counts.sum())]
+        in_degree -= np.bincount(targets, minlength=n)
+        targets = np.unique(targets)
+        frontier = targets[in_degree[targets] == 0]
+
+    if visited == n:
+        return levels, np.empty(0, dtype=np.int64)
+    return levels, np.flatnonzero(in_degree > 0)
+
+
+def solve_concentrations(arrays):
+    """
+    按拓扑层次一次性求解所有trial的浓度：C = W·C + S，其中 W 为按总用量归一化的混合矩阵，S 为stock浓度矩阵
+    由于 W 为严格下三角（DAG），逐层前代即为精确解，每层只需一次稀疏gather+reduce
+    :param arrays: collect_mixing_arrays 的返回值
+    :return: (conc, mask) 两个 trial×substance 矩阵
+    :raises ValueError: 存在循环依赖，或某个trial的总用量为0
+    """
+    names = arrays["trial_names"]
+    n = len(names)
+    edge_row, edge_col = arrays["edge_row"], arrays["edge_col"]
+    totals = arrays["totals"]
+
+    levels, remaining = topological_levels(n, edge_row, edge_col)
+    if remaining.size:
+        raise ValueError(f"存在循环依赖: 涉及试样 {names[remaining[0]]}")
+
+    conc = arrays["base_conc"].copy()
+    mask = arrays["base_mask"].copy()
+    if edge_row.size == 0:
+        return conc, mask
+
+    level_of = np.empty(n, dtype=np.int64)
+    for k, nodes in enumerate(levels):
+        level_of[nodes] = k
+
+    # 边按 (所在层, 行) 排序，使每层的边连续、同一行的边相邻
+    edge_level = level_of[edge_row]
+    perm = np.lexsort((edge_row, edge_level))
+    rows = edge_row[perm]
+    cols = edge_col[perm]
+    vols = arrays["edge_vol"][perm]
+    edge_level = edge_level[perm]
+    bounds = np.searchsorted(edge_level, np.arange(len(levels) + 1))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weights = vols / totals[rows]
+
+    for k in range(1, len(levels)):
+        lo, hi = bounds[k], bounds[k + 1]
+        if lo == hi:
+            continue
+        r = rows[lo:hi]
+        c = cols[lo:hi]
+        starts = np.flatnonzero(np.r_[True, r[1:] != r[:-1]])
+        targets = r[starts]
+        level_mask = np.logical_or.reduceat(mask[c], starts, axis=0)
+        zero_total = (totals[targets] == 0) & level_mask.any(axis=1)
+        if zero_total.any():
+            raise ValueError(f"试样 {names[targets[np.argmax(zero_total)]]} 的 total_amount 无效")
+        conc[targets] = np.add.reduceat(conc[c] * weights[lo:hi, None], starts, axis=0)
+        mask[targets] = level_mask
+
+    return conc, mask
+
+
+def concentration_dicts(arrays, conc, mask):
+    """
+    把矩阵结果还原为每个非stock trial的 substance_conc 字典
+    :return: {trial名字: {物质: 浓度}}
+    """
+    names = arrays["trial_names"]
+    substance_names = np.asarray(arrays["substance_names"], dtype=object)
+    result = {}
+    for i in np.flatnonzero(~arrays["fixed"]):
+        cols = np.flatnonzero(mask[i])
+        result[names[i]] = dict(zip(substance_names[cols].tolist(), conc[i, cols].tolist()))
+    return result
+
+
+def weakly_connected_components(n, edge_row, edge_col):
+    """
+    trial 图（忽略边的方向）的弱连通分量：挂接（每条边把两端所在树的根挂到较小的标签上）+ 指针跳跃压缩，全部为numpy数组操作
+    :return: 每个节点的分量标签（即分量内最小的节点下标）
+    """
+    labels = np.arange(n)
+    if edge_row.size == 0:
+        return labels
+    while True:
+        low = np.minimum(labels[edge_row], labels[edge_col])
+        hooked = labels.copy()
+        np.minimum.at(hooked, labels[edge_row], low)
+        np.minimum.at(hooked, labels[edge_col], low)
+        while True:
+            jumped = hooked[hooked]
+            if np.array_equal(jumped, hooked):
+                break
+            hooked = jumped
+        if np.array_equal(hooked, labels):
+            return labels
+        labels = hooked
+
+
+def component_payload(arrays, nodes, edges):
+    """
+    截取若干分量（节点下标 nodes，升序；边下标 edges）作为独立的子问题，只含紧凑的numpy数组，可以发送给子进程
+    stock浓度只保留这些分量用到的物质列与stock行
+    """
+    local = np.full(len(arrays["fixed"]), -1, dtype=np.int64)
+    local[nodes] = np.arange(nodes.size)
+    fixed = arrays["fixed"][nodes]
+    fixed_nodes = nodes[fixed]
+    sub_cols = np.flatnonzero(arrays["base_mask"][fixed_nodes].any(axis=0))
+    return {
+        "trial_names": [arrays["trial_names"][i] for i in nodes.tolist()],
+        "fixed": fixed,
+        "edge_row": local[arrays["edge_row"][edges]],
+        "edge_col": local[arrays["edge_col"][edges]],
+        "edge_vol": arrays["edge_vol"][edges],
+        "totals": arrays["totals"][nodes],
+        "sub_cols": sub_cols,
+        "fixed_conc": arrays["base_conc"][np.ix_(fixed_nodes, sub_cols)],
+        "fixed_mask": arrays["base_mask"][np.ix_(fixed_nodes, sub_cols)],
+    }
+
+
+def solve_component(payload):
+    """
+    求解 component_payload 给出的子问题（在子进程中执行，也可直接调用）
+    :return: (conc, mask)，只含子问题中非stock节点的行、sub_cols 的列
+    """
+    n = len(payload["trial_names"])
+    fixed = payload["fixed"]
+    base_conc = np.zeros((n, payload["sub_cols"].size), dtype=np.float64)
+    base_mask = np.zeros(base_conc.shape, dtype=bool)
+    base_conc[fixed] = payload["fixed_conc"]
+    base_mask[fixed] = payload["fixed_mask"]
+    sub_arrays = dict(payload, base_conc=base_conc, base_mask=base_mask)
+    conc, mask = solve_concentrations(sub_arrays)
+    return conc[~fixed], mask[~fixed]
+
+
+_process_pools = {}  # {max_workers: ProcessPoolExecutor}
+_process_pools_lock = threading.Lock()
+
+
+def process_pool(max_workers=None):
+    """
+    按需创建并复用的进程池，进程退出时关闭；不同实验可能同时在写（各自持有自己的实验锁），
+    创建在模块锁下进行，每个 max_workers 各用一个池且不在运行中关闭：另一个线程可能正往它提交任务
+    """
+    with _process_pools_lock:
+        pool = _process_pools.get(max_workers)
+        if pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+            pool = _process_pools[max_workers] = ProcessPoolExecutor(max_workers=max_workers)
+        return pool
+
+
+@atexit.register
+def _shutdown_process_pool():
+    with _process_pools_lock:
+        pools = list(_process_pools.values())
+        _process_pools.clear()
+    for pool in pools:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def solve_concentrations_by_component(arrays, max_workers=None, min_component=2000):
+    """
+    按弱连通分量拆分后求解：不少于 min_component 个节点的分量各自作为一个子问题交给进程池，
+    其余小分量合并为一个子问题在本进程求解；只有一个大分量时不使用进程池（没有可并行的部分）
+    结果与 solve_concentrations 相同
+    :param max_workers: 进程池的进程数，None 为 CPU 核数
+    :return: (conc, mask, num_components, num_parallel) ，后两项为分量数与交给进程池的分量数
+    """
+    fixed = arrays["fixed"]
+    n = fixed.size
+    edge_row, edge_col = arrays["edge_row"], arrays["edge_col"]
+    labels = weakly_connected_components(n, edge_row, edge_col)
+    _, component = np.unique(labels, return_inverse=True)
+    sizes = np.bincount(component)
+    # 只含stock的分量不需要求解
+    has_regular = np.bincount(component, weights=~fixed, minlength=sizes.size) > 0
+
+    node_order = np.argsort(component, kind="stable")
+    node_bounds = np.searchsorted(component[node_order], np.arange(sizes.size + 1))
+    edge_component = component[edge_row]
+    edge_order = np.argsort(edge_component, kind="stable")
+    edge_bounds = np.searchsorted(edge_component[edge_order], np.arange(sizes.size + 1))
+
+    large = np.flatnonzero(has_regular & (sizes >= min_component))
+    if large.size < 2:
+        large = large[:0]
+    small_nodes = np.flatnonzero(has_regular[component] & ~np.isin(component, large))
+    small_edges = np.flatnonzero(~np.isin(edge_component, large))
+
+    conc = arrays["base_conc"].copy()
+    mask = arrays["base_mask"].copy()
+
+    def merge(nodes, sub_cols, result):
+        rows = nodes[~fixed[nodes]]
+        conc[np.ix_(rows, sub_cols)] = result[0]
+        mask[np.ix_(rows, sub_cols)] = result[1]
+
+    futures = []
+    if large.size:
+        pool = process_pool(max_workers)
+        for k in large.tolist():
+            nodes = np.sort(node_order[node_bounds[k]:node_bounds[k + 1]])
+            edges = edge_order[edge_bounds[k]:edge_bounds[k + 1]]
+            payload = component_payload(arrays, nodes, edges)
+            futures.append((nodes, payload["sub_cols"], pool.submit(solve_component, payload)))
+    if small_nodes.size:
+        payload = component_payload(arrays, small_nodes, small_edges)
+        merge(small_nodes, payload["sub_cols"], solve_component(payload))
+    for nodes, sub_cols, future in futures:
+        merge(nodes, sub_cols, future.result())
+    return conc, mask, int(has_regular.sum()), int(large.size)
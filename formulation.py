@@ -0,0 +1,216 @@
+import numpy as np
+
+
+def bounded_lsq_active_set(A, b, lower, upper, x0=None, tol=1e-10, max_iter=None, G=None):
+    """
+    单个目标的有界最小二乘（BVLS，Stark & Parker 的主动集法）：
+        min ||A x - b||^2  s.t.  lower <= x <= upper
+    每次把最违反KKT条件的变量放开，在放开的变量上求无约束最小二乘，越界时沿线段退回到边界
+    解是"基本解"，非零变量个数不超过行数，适合配方（用到的stock越少越好）
+    子问题在预先算好的 Gram 矩阵 A^T A 上求解，每步只是一个 |free|×|free| 的线性方程组
+    :param x0: 热启动的初始解（如上一轮的解），严格位于上下界之间的变量作为初始放开集合
+    :param G: 预先算好的 A^T A，批量求解同一矩阵的多个目标时共用
+    :return: x (n,)
+    """
+    A = np.asarray(A, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    n = A.shape[1]
+    if G is None:
+        G = A.T @ A
+    Atb = A.T @ b
+    lower = np.broadcast_to(np.asarray(lower, dtype=np.float64), (n,)).copy()
+    upper = np.broadcast_to(np.asarray(upper, dtype=np.float64), (n,)).copy()
+    fixed_var = upper <= lower
+    if x0 is None:
+        x = lower.copy()
+        free = np.zeros(n, dtype=bool)
+    else:
+        x = np.clip(np.asarray(x0, dtype=np.float64), lower, upper)
+        free = (x > lower) & (x < upper)
+    scale = max(1e-300, float(np.abs(Atb).max()), float(np.abs(G).max()) * float(np.abs(upper[~fixed_var]).max(initial=0.0)))
+    max_iter = max_iter if max_iter is not None else 3 * n + 10
+
+    for iteration in range(max_iter):
+        if iteration > 0 or not free.any():
+            grad = G @ x - Atb
+            # 在下界且梯度<0、在上界且梯度>0的变量违反KKT条件
+            violation = np.where(x <= lower, -grad, np.where(x >= upper, grad, 0.0))
+            violation[free | fixed_var] = 0.0
+            j = int(np.argmax(violation))
+            if violation[j] <= tol * scale:
+                break
+            free[j] = True
+
+        while True:
+            idx = np.flatnonzero(free)
+            rest = np.flatnonzero(~free)
+            rhs = Atb[idx] - G[np.ix_(idx, rest)] @ x[rest]
+            G_ff = G[np.ix_(idx, idx)]
+            try:
+                z = np.linalg.solve(G_ff, rhs)
+            except np.linalg.LinAlgError:
+                z = np.linalg.lstsq(G_ff, rhs, rcond=None)[0]
+            lo, up = lower[idx], upper[idx]
+            if np.all((z > lo) & (z < up)):
+                x[idx] = z
+                break
+            # 沿 x -> z 前进到第一个碰到边界的位置，碰到边界的变量重新固定
+            xf = x[idx]
+            d = z - xf
+            with np.errstate(divide="ignore", invalid="ignore"):
+                alpha = np.where(d < 0, (lo - xf) / d, np.where(d > 0, (up - xf) / d, np.inf))
+            alpha = float(np.clip(np.min(alpha), 0.0, 1.0))
+            x[idx] = np.clip(xf + alpha * d, lo, up)
+            hit = (x[idx] <= lo + 1e-14 * (1 + np.abs(lo))) | (x[idx] >= up - 1e-14 * (1 + np.abs(up)))
+            if not hit.any():
+                hit[np.argmin(np.minimum(x[idx] - lo, up - x[idx]))] = True
+            x[idx[hit]] = np.where(x[idx[hit]] - lo[hit] < up[hit] - x[idx[hit]], lo[hit], up[hit])
+            free[idx[hit]] = False
+            if not free.any():
+                break
+    return x
+
+
+def prepare_formulation(A, max_volume):
+    """
+    预先计算同一个 stock 矩阵上求配方所需的量（列归一化后的矩阵、Gram 矩阵、带总体积约束行的 Gram 矩阵），
+    批量求解时所有目标共用
+    :param A: (m, n) 物质×stock 浓度矩阵
+    :return: 字典，作为 solve_formulation 的 prepared 参数
+    """
+    A = np.asarray(A, dtype=np.float64)
+    # 列归一化：x = z / col_norm，使主动集按"与残差的相关性"选stock，收敛更快、极小体积更少
+    col_norm = np.linalg.norm(A, axis=0)
+    col_norm[col_norm == 0] = 1.0
+    As = A / col_norm
+    budget_weights = 1.0 / col_norm
+    weight = 1e2 * max(1.0, float(np.abs(As).max(initial=0.0)))
+    budget_row = weight * budget_weights
+    G = As.T @ As
+    return {
+        "A": A,
+        "As": As,
+        "col_norm": col_norm,
+        "budget_weights": budget_weights,
+        "budget_row": budget_row,
+        "budget_weight": weight,
+        "A_aug": np.vstack([As, budget_row]),
+        "G": G,
+        "G_aug": G + np.outer(budget_row, budget_row),
+        "max_volume": float(max_volume),
+    }
+
+
+def fit_budget(x, total_volume, min_volume):
+    """
+    总体积的硬约束：加权的体积行只能让 sum(x) 接近 V（可能略超），超出时把用到的stock体积按比例缩小到 V 之内
+    （留出几个 ulp 的余量，逐项相加的 sum 也不会超过 V）；缩小后低于 min_volume 的固定为 min_volume，其余再按比例缩小
+    :param x: (n,) stock 体积，用到的不小于 min_volume
+    :return: 满足 sum(x) <= V 的体积（不超出时原样返回）
+    :raises ValueError: 用到的stock都取 min_volume 时仍超过 V
+    """
+    limit = total_volume * (1.0 - 4 * np.finfo(np.float64).eps)
+    if x.sum() <= limit:
+        return x
+    x = x.copy()
+    used = x > 0
+    pinned = np.zeros_like(used)
+    while True:
+        free = used & ~pinned
+        room = limit - min_volume * np.count_nonzero(pinned)
+        free_sum = x[free].sum()
+        if room < 0:
+            raise ValueError(f"用到的 {np.count_nonzero(used)} 个stock按最小体积 {min_volume:g} 也超过总体积 {total_volume:g}")
+        if free_sum <= room:
+            break
+        x[free] *= room / free_sum
+        low = free & (x < min_volume)
+        if not low.any():
+            break
+        x[low] = min_volume
+        pinned |= low
+    return x
+
+
+def solve_formulation(A, c, total_volume, min_volume, max_volume, max_rounds=20, prepared=None, x0=None):
+    """
+    求一个配方：stock 体积 x 使 A x / V 尽量接近目标浓度 c
+    约束：每个用到的stock体积在 [min_volume, max_volume] 内（或不用，为0），sum(x) <= V（剩余由溶剂补足）；
+    总体积先以加权的约束行参与拟合，最后由 fit_budget 严格保证
+    多物质stock带来的交叉污染也计入（A中的每一行都参与拟合，非目标物质的目标为0）
+    半连续约束（要么0要么至少min_volume）的处理：每轮把低于 min_volume 的体积固定为0，热启动重解；
+    若干轮后仍有低于 min_volume 的，把它们的下界提高到 min_volume 再解一次，保证结果满足约束，代价体现在残差中
+    :param A: (m, n) 物质×stock 浓度矩阵
+    :param c: (m,) 目标浓度
+    :param total_volume: 总体积 V
+    :param prepared: prepare_formulation(A, max_volume) 的返回值，批量求解时传入以免重复计算
+    :param x0: 热启动的初始体积（如相邻孔位的解）
+    :return: (x (n,), residual) residual 为浓度空间中的残差范数 ||A x / V - c||
+    """
+    if prepared is None:
+        prepared = prepare_formulation(A, max_volume)
+    A = prepared["A"]
+    c = np.asarray(c, dtype=np.float64)
+    n = A.shape[1]
+    if n == 0:
+        return np.zeros(0), float(np.linalg.norm(c))
+
+    As, col_norm, budget_weights = prepared["As"], prepared["col_norm"], prepared["budget_weights"]
+    target = c * total_volume
+    lower = np.zeros(n)
+    upper = np.full(n, float(max_volume)) * col_norm
+
+    def solve(z0=None):
+        z = bounded_lsq_active_set(As, target, lower, upper, x0=z0, G=prepared["G"])
+        if z @ budget_weights <= total_volume * (1 + 1e-9):
+            return z
+        # 总体积约束起作用：在 sum(x) = V 下求解
+        b_aug = np.append(target, prepared["budget_weight"] * total_volume)
+        return bounded_lsq_active_set(prepared["A_aug"], b_aug, lower, upper, x0=z, G=prepared["G_aug"])
+
+    z = solve(None if x0 is None else np.asarray(x0, dtype=np.float64) * col_norm)
+    eps = 1e-9 * max(1.0, float(max_volume))
+    for round_index in range(max_rounds + 1):
+        x = z / col_norm
+        too_small = (x > eps) & (x < min_volume - eps)
+        if not too_small.any():
+            break
+        if round_index < max_rounds:
+            upper[too_small] = 0.0
+        else:
+            lower[too_small] = min_volume * col_norm[too_small]
+        z = solve(z)
+    x = z / col_norm
+    x[x <= eps] = 0.0
+    x = fit_budget(x, total_volume, min_volume)
+    if x.sum() > total_volume:
+        raise ValueError(f"配方的总体积 {x.sum():g} 超过了 total_volume {total_volume:g}")
+
+    residual = float(np.linalg.norm(A @ x / total_volume - c))
+    return x, residual
+
+
+def solve_formulation_batch(A, C, total_volume, min_volume, max_volume, max_rounds=20):
+    """
+    批量求配方：对 C 的每一行（一个孔位的目标浓度）求 stock 体积，约束与 solve_formulation 相同
+    所有孔位共用一次 prepare_formulation（列归一化与 Gram 矩阵），目标完全相同的重复孔位只求解一次，
+    按行顺序用上一个不同目标的解热启动（板上相邻孔位的目标通常接近，主动集几乎相同）
+    :param A: (m, n) 物质×stock 浓度矩阵
+    :param C: (k, m) 每行一个孔位的目标浓度
+    :param total_volume: 每个孔位的总体积
+    :return: (X (k, n), residuals (k,))
+    """
+    A = np.asarray(A, dtype=np.float64)
+    C = np.atleast_2d(np.asarray(C, dtype=np.float64))
+    prepared = prepare_formulation(A, max_volume)
+    unique_targets, first_index, inverse = np.unique(C, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    X_unique = np.zeros((unique_targets.shape[0], A.shape[1]))
+    residual_unique = np.zeros(unique_targets.shape[0])
+    x_prev = None
+    for u in np.argsort(first_index):
+        X_unique[u], residual_unique[u] = solve_formulation(
+            A, unique_targets[u], total_volume, min_volume, max_volume, max_rounds, prepared=prepared, x0=x_prev)
+        x_prev = X_unique[u]
+    return X_unique[inverse], residual_unique[inverse]
@@ -1,19 +1,267 @@
 from flask import Flask, request, jsonify, render_template, send_from_directory
+import json
 import os
+import threading
+import time
+from urllib.parse import quote
+from contextlib import contextmanager
 from Experiment import Experiment
 from trial import trial
+from journal import Journal
+from inventory import InventoryError
+import metrics
+from metrics import logger, timed_stage
+from profiling import RequestProfiler
+from response_cache import ResponseCache
+import table_delta
+import table_export
+import table_import
+import table_ingest
+import table_window
+import table_wire
+from rwlock import RWLock
 
 class chem_interface:
 
     """dict_of 是json传来的信息全字典，含有 词条：list """
-    def __init__(self, dict_of_experiment={}, id_exp_name={}):
+    # 会修改实验的请求（table_type, instruction），对该实验加写锁；其余请求只读，加读锁，同一实验的读请求可以并发
+    WRITE_REQUESTS = {("conc", "update"), ("exp", "update"), ("substance", "update"), ("plate", "update")}
+    # 响应按实验版本缓存、支持 ETag/If-None-Match 的请求，值为缓存中的表格种类
+    CACHED_TABLE_REQUESTS = {("exp", "conc_table"): "conc", ("exp", "exp_table"): "exp"}
+    # delta 响应中变化的单元格超过整表的这一比例时改发整表
+    DELTA_MAX_FRACTION = 0.5
+    # 提交的数值表格中非数字的单元格跳过，响应的 input_errors 中最多列出这么多个
+    INPUT_ERRORS_SHOWN = 200
+    # 客户端接受 gzip 时，超过此大小的 /config_acceptor 响应压缩后发送
+    GZIP_MIN_BYTES = 1024
+    GZIP_LEVEL = 6
+
+    def __init__(self, dict_of_experiment=None, id_exp_name=None, journal_dir=None, compact_every=1000, cache_size=64,
+                 delta_history=4):
         """
         :param dict_of_experiment: Experiment，键为名字，值为列表[前端赋予exp的id，地址]
         :param id_exp_name: 指 id:experiment名字的字符串
+        :param journal_dir: 操作日志与快照的目录（见 journal.py），给定时先从中恢复全部实验，之后的修改都会写入日志
+        :param compact_every: 每多少条日志压缩为一次快照，即重启时最多重放的条数
+        :param cache_size: 渲染结果缓存（见 response_cache.py）最多保留的条目数，0 为不缓存
+        :param delta_history: 每个实验的每种表格保留最近几个版本，用于向停留在这些版本的客户端发送 delta
         """
-        self.dict_of_experiment = dict_of_experiment
-        self.id_exp_name = id_exp_name
+        self.dict_of_experiment = dict_of_experiment if dict_of_experiment is not None else {}
+        self.id_exp_name = id_exp_name if id_exp_name is not None else {}
         self.property_vocab_list = []
+        self.journal = None
+        self._replaying = False
+        # 线程安全：_registry_lock 保护 dict_of_experiment/id_exp_name 的查找与增删改名，每个实验（按 rootId）另有一把读写锁
+        # 加锁顺序固定为 先实验锁、后注册表锁；_held.depth 为当前线程持有的实验锁个数
+        self._registry_lock = threading.RLock()
+        self._exp_locks = {}
+        self._held = threading.local()
+        self.response_cache = ResponseCache(cache_size, keep_versions=delta_history)
+        if journal_dir:
+            self.recover_from_journal(journal_dir, compact_every)
+
+    # ===== 操作日志 =====
+    def recover_from_journal(self, journal_dir, compact_every=1000):
+        """加载最新快照，再按顺序重放其后的日志；重放出错的操作（当初执行时也出错）跳过"""
+        the_journal = Journal(journal_dir, compact_every=compact_every)
+        last_seq = 0
+        latest = the_journal.latest_snapshot()
+        if latest:
+            last_seq, manifest, snapshot_dir = latest
+            for entry in manifest["experiments"]:
+                the_exp = Experiment.load_snapshot(os.path.join(snapshot_dir, entry["file"]))
+                self.add_experiment(entry["name"], entry["rootId"], the_exp)
+        entries = the_journal.read_entries(after_seq=last_seq)
+        self._replaying = True
+        try:
+            for seq, op, args in entries:
+                try:
+                    self._replay(op, args)
+                except Exception as e:
+                    logger.warning("recover_from_journal: 第%s条操作 %s 重放失败，已跳过: %s", seq, op, e)
+                last_seq = seq
+        finally:
+            self._replaying = False
+        the_journal.open_for_append(last_seq)
+        the_journal.entries_since_snapshot = len(entries)
+        self.journal = the_journal
+        logger.info("recover_from_journal: 从快照恢复 %d 个实验，重放 %d 条操作", len(self.dict_of_experiment), len(entries))
+
+    def _replay(self, op, args):
+        if op == "create_exp":
+            self.create_exp(args["exp_name"], args["exp_id"])
+        elif op == "rename_exp":
+            self._update_experiment_info(args["name_of_exp"], args["rootId"])
+        elif op == "update_exp":
+            self.update_exp(args["name_of_exp"], args["rootId"], args["table_content"], args["header_cell_content"], args["request"])
+        elif op == "update_stock":
+            self.update_stock(args["name_of_exp"], args["rootId"], args["table_content"], args["header_cell_content"], args["request"])
+        elif op == "import_rows":
+            the_exp = self._update_experiment_info(args["name_of_exp"], args["rootId"])
+            table_import.apply_chunk(the_exp, args["kind"], args["rows"], args["ids"])
+            the_exp.recompute_concentrations()
+        elif op == "plate_update":
+            self._process_plate_update(args["name_of_exp"], args["rootId"], args["table_content"], args["header_cell_content"], {})
+        else:
+            raise ValueError(f"未知的日志操作 {op}")
+
+    def _journal(self, op, **args):
+        """修改状态之前先写日志（重放期间不写）"""
+        if self.journal is not None and not self._replaying:
+            with metrics.REGISTRY.stage("journal"):
+                self.journal.append(op, args)
+
+    def _maybe_compact(self):
+        """一次操作完成后，日志条数达到阈值则压缩为快照；当前线程还持有实验锁时推迟到释放之后（由 locked_processor 再调用）"""
+        if self.journal is not None and not self._replaying and not getattr(self._held, "depth", 0) \
+                and self.journal.entries_since_snapshot >= self.journal.compact_every:
+            self.compact_journal()
+
+    @timed_stage("compact_journal")
+    def compact_journal(self):
+        """
+        把当前全部实验写成快照并清空日志
+        先按 rootId 顺序拿到所有实验的写锁，再拿注册表锁：此时没有已写入日志但尚未执行完的操作，快照与日志序号一致
+        """
+        while True:
+            with self._registry_lock:
+                root_ids = sorted(self._exp_locks)
+                locks = [self._exp_locks[root_id] for root_id in root_ids]
+            for lock in locks:
+                lock.acquire_write()
+            try:
+                with self._registry_lock:
+                    if sorted(self._exp_locks) != root_ids:
+                        continue  # 期间有新的实验锁被创建，释放后重来
+                    experiments = [(exp_name, entry[0], entry[1]) for exp_name, entry in self.dict_of_experiment.items()]
+                    self.journal.write_snapshot(experiments)
+                    return
+            finally:
+                for lock in reversed(locks):
+                    lock.release_write()
+
+    # ===== 并发控制 =====
+    def experiment_lock(self, rootId):
+        """rootId 对应实验的读写锁，没有则创建（实验尚不存在时也可以先加锁，如首次 update_exp 创建实验）"""
+        with self._registry_lock:
+            lock = self._exp_locks.get(rootId)
+            if lock is None:
+                lock = self._exp_locks[rootId] = RWLock()
+            return lock
+
+    @contextmanager
+    def locked_experiment(self, rootId, write):
+        """在 rootId 实验的写锁（write=True）或读锁下执行"""
+        lock = self.experiment_lock(rootId)
+        if write:
+            lock.acquire_write()
+        else:
+            lock.acquire_read()
+        self._held.depth = getattr(self._held, "depth", 0) + 1
+        try:
+            yield
+        finally:
+            self._held.depth -= 1
+            if write:
+                lock.release_write()
+            else:
+                lock.release_read()
+
+    def locked_processor(self, table_type, instruction):
+        """
+        与 get_processor 相同，但返回的函数在请求的实验（rootId）的读锁或写锁下执行处理方法，写请求结束并释放锁后再检查是否需要压缩日志
+        多线程（Flask）调用时应使用它而不是直接调用 get_processor 返回的方法
+        """
+        processor = self.get_processor(table_type, instruction)
+        if processor is None:
+            return None
+        write = (table_type, instruction) in chem_interface.WRITE_REQUESTS
+
+        def run(name_of_exp, table_rootId, table_content, header_cell_content, the_request):
+            with self.locked_experiment(table_rootId, write):
+                result = processor(name_of_exp, table_rootId, table_content, header_cell_content, the_request)
+            if write:
+                self._maybe_compact()
+            return result
+        return run
+
+    def table_etag(self, table_type, instruction, rootId, header_cell_content, window=None):
+        """
+        conc_table/exp_table 请求此刻对应的 ETag，用于在处理请求之前判断 If-None-Match；其余请求或实验不存在时返回 None
+        :param window: 请求的 window（见 table_window.normalize_window），窗口不同则 ETag 不同
+        """
+        kind = chem_interface.CACHED_TABLE_REQUESTS.get((table_type, instruction))
+        if kind is None or not header_cell_content:
+            return None
+        name_of_exp = header_cell_content.get("Experiment name")
+        with self.locked_experiment(rootId, write=False):
+            try:
+                the_exp = self.get_experiment(name_of_exp, rootId)
+            except KeyError:
+                return None
+            if the_exp is None:
+                return None
+            if window:
+                return self.response_cache.etag(the_exp.uid, kind, the_exp.version, rootId, name_of_exp,
+                                                json.dumps(window, sort_keys=True, ensure_ascii=False))
+            return self.response_cache.etag(the_exp.uid, kind, the_exp.version, rootId, name_of_exp)
+
+    def _cached_table_config(self, table_rootId, table_type, name_of_exp, build, other_config=None, the_request=None):
+        """
+        json_config_composer 的输出按 (实验, 表格类型, 版本, rootId, 表头名字) 缓存，build 为未命中时生成配置的无参函数
+        返回浅拷贝（other_config 合并到拷贝的 config 中），调用方往其中加字段不影响缓存；"etag" 为本次内容的 ETag，由 method_segregator 取出放入响应头
+        """
+        the_exp = self.get_experiment(name_of_exp, table_rootId)
+        cached = self.response_cache.get_or_build((the_exp.uid, table_type, the_exp.version, table_rootId, name_of_exp), build)
+        result = dict(cached)
+        result['config'] = dict(cached['config'])
+        if other_config:
+            result['config'].update(other_config)
+        result['etag'] = self.response_cache.etag(the_exp.uid, table_type, the_exp.version, table_rootId, name_of_exp)
+        return self._versioned_table_config(result, the_exp, table_type, the_request)
+
+    def _versioned_table_config(self, result, the_exp, table_type, the_request=None):
+        """
+        给表格响应（json_config_composer 的输出，tableArray 为实验当前版本的表格）加上 config.table_version
+        请求的 table_versions（{表格类型: 客户端表格的 table_version}）带有该类型的版本、且该版本的表格还在缓存中时，
+        以 config.delta（见 table_delta.diff_tables，另含 base_version）代替 tableArray；版本已被淘汰或变化过多时仍发整表
+        delta 的内容取决于请求的 table_versions，同一个 ETag 不能代表它：delta 响应去掉 "etag"，不带 ETag、也不会被客户端缓存
+        """
+        config = result['config']
+        config['table_version'] = self.response_cache.version_token(the_exp.uid, the_exp.version)
+        base_version = ((the_request or {}).get('table_versions') or {}).get(table_type)
+        if not base_version:
+            return result
+        base_table = self.response_cache.get_version(base_version, the_exp.uid, f"{table_type}_table")
+        table = config.get('tableArray')
+        if base_table is None or not table:
+            return result
+        max_cells = int(len(table) * len(table[0]) * chem_interface.DELTA_MAX_FRACTION)
+        with metrics.REGISTRY.stage("table_delta"):
+            delta = table_delta.diff_tables(base_table, table, max_cells)
+        if delta is None:
+            return result
+        delta['base_version'] = base_version
+        del config['tableArray']
+        config.pop('table_content', None)  # 回显的请求表格，delta 响应不需要
+        config['delta'] = delta
+        result.pop('etag', None)
+        return result
+
+    def _window_table_config(self, table_rootId, table_type, name_of_exp, header_config, window):
+        """
+        conc_table/exp_table 请求带有 window 时只返回其中的行列（见 Get_table_window），config.window 中给出窗口范围与总行列数
+        窗口表格只用于浏览：不带 table_version（不参与 delta），除导出、关闭外的按钮都不可用（提交部分表格会被当作删除了其余的行）
+        """
+        table, window_info = self.Get_table_window(name_of_exp, table_rootId, table_type, window)
+        result = self.json_config_composer(table_rootId, table_type, table, header_config, {'window': window_info})
+        buttons = result['config']['buttons']
+        for button in buttons:
+            buttons[button] = button in ('cancel', 'export')
+        the_exp = self.get_experiment(name_of_exp, table_rootId)
+        result['etag'] = self.response_cache.etag(the_exp.uid, table_type, the_exp.version, table_rootId, name_of_exp,
+                                                  json.dumps(window, sort_keys=True, ensure_ascii=False))
+        return result
 
     def get_experiment(self, exp_name=None, exp_id=None):
         """
@@ -29,19 +277,20 @@ class chem_interface:
         Raises:
             ValueError: 如果未提供exp_name或exp_id，或找不到对应的实验
         """
-        if exp_name:
-            if exp_name not in self.dict_of_experiment:
-                print(f"实验名称 {exp_name} 不存在于dict_of_experiment中")
-            exp_entry = self.dict_of_experiment[exp_name]
-            return exp_entry[1]  # 返回实验对象（假设存储在列表的第二个位置）
-        elif exp_id:
-            if exp_id not in self.id_exp_name:
-                print(f"实验ID {exp_id} 不存在于id_exp_name中")
-            exp_name = self.id_exp_name[exp_id]
-            exp_entry = self.dict_of_experiment[exp_name]
-            return exp_entry[1]  # 返回实验对象
-        else:
-            print("必须提供exp_name或exp_id参数")
+        with self._registry_lock:
+            if exp_name:
+                if exp_name not in self.dict_of_experiment:
+                    logger.warning("实验名称 %s 不存在于dict_of_experiment中", exp_name)
+                exp_entry = self.dict_of_experiment[exp_name]
+                return exp_entry[1]  # 返回实验对象（假设存储在列表的第二个位置）
+            elif exp_id:
+                if exp_id not in self.id_exp_name:
+                    logger.warning("实验ID %s 不存在于id_exp_name中", exp_id)
+                exp_name = self.id_exp_name[exp_id]
+                exp_entry = self.dict_of_experiment[exp_name]
+                return exp_entry[1]  # 返回实验对象
+            else:
+                logger.warning("必须提供exp_name或exp_id参数")
 
     def add_experiment(self, exp_name, exp_id, exp_address):
         """
@@ -50,27 +299,30 @@ class chem_interface:
         :param exp_id: 前端赋予的实验ID
         :param exp_address: 实验地址
         """
-        self.dict_of_experiment[exp_name] = [exp_id, exp_address]
-        self.id_exp_name[exp_id] = exp_name
+        with self._registry_lock:
+            self.dict_of_experiment[exp_name] = [exp_id, exp_address]
+            self.id_exp_name[exp_id] = exp_name
 
     def remove_experiment(self, exp_id = None, exp_name = None):
         """
         从interface中删除实验
         :param identifier: 实验的ID或名称
         """
-        if exp_id:  # 如果传入的是ID
-            if exp_id in self.id_exp_name:
-                exp_name = self.id_exp_name[exp_id]
-                del self.dict_of_experiment[exp_name]
-                del self.id_exp_name[exp_id]
-        elif exp_name:  # 如果传入的是名称
-            if exp_name in self.dict_of_experiment:
-                exp_id = self.dict_of_experiment[exp_name][0]
-                del self.dict_of_experiment[exp_name]
-                del self.id_exp_name[exp_id]
+        with self._registry_lock:
+            if exp_id:  # 如果传入的是ID
+                if exp_id in self.id_exp_name:
+                    exp_name = self.id_exp_name[exp_id]
+                    del self.dict_of_experiment[exp_name]
+                    del self.id_exp_name[exp_id]
+            elif exp_name:  # 如果传入的是名称
+                if exp_name in self.dict_of_experiment:
+                    exp_id = self.dict_of_experiment[exp_name][0]
+                    del self.dict_of_experiment[exp_name]
+                    del self.id_exp_name[exp_id]
 
     @staticmethod
-    def dict_to_table(nested_dict, symmetric=False):
+    @timed_stage("dict_to_table")
+    def dict_to_table(nested_dict, symmetric=False, columns=None, rows=None):
         """
         将嵌套字典转换为带表头的二维数组。
 
@@ -84,6 +336,10 @@ class chem_interface:
         参数:
             nested_dict (dict): 嵌套字典数据
             symmetric (bool): 是否使用对称模式，即表头行和表头列使用相同的键
+            columns (list): 标准模式下已排好序的全部表头（如 Experiment.substance_columns.ordered()），省略时收集所有内层键再排序
+            rows (list): 标准模式下已排好序的全部元素名称（如 Experiment.trial_rows.ordered()），省略时按名称排序
+
+        每行先以空字符串预先填满，再只按内层字典中实际存在的键填入对应的列，耗时与有值的单元格数及输出大小成正比
 
         返回格式（标准模式）:
         [
@@ -107,58 +363,43 @@ class chem_interface:
             if not nested_dict:  # 空字典
                 return []
         except ValueError as e:
-            print(f"错误: {e}")
+            logger.warning("错误: %s", e)
             return []  # 返回空数组表示转换失败
 
         if symmetric:
             # 对称模式：使用相同的键作为表头行和表头列
             keys = list(nested_dict.keys())
-            if not keys:
-                return []
-
-            # 初始化结果数组，第一行为表头
-            result_array = [[""] + keys]
-
-            # 处理每个键对应的行
-            for key in keys:
-                row_data = [key]  # 行首为键名
-                row_dict = nested_dict.get(key, {})
-
-                # 按照表头顺序填充数据
-                for col_key in keys:
-                    value = row_dict.get(col_key, "")  # 默认值为空字符串
-                    row_data.append(value)
-
-                result_array.append(row_data)
-
-            return result_array
+            headers = keys
+            rows = keys
         else:
             # 标准模式：使用外层键作为表头列，内层键作为表头行
-            # 收集所有可能的表头（内层字典键）
-            all_headers = set()
-            for element_data in nested_dict.values():
-                all_headers.update(element_data.keys())
-
-            # 将表头排序并添加空字符串作为第一个元素（对应表头列的位置）
-            sorted_headers = [""] + sorted(all_headers)
-
-            # 初始化结果数组，第一行为表头
-            result_array = [sorted_headers]
-
-            # 处理每个元素
-            for element_name, element_data in sorted(nested_dict.items()):
-                row = [element_name]  # 初始化行，第一个元素为元素名称
-
-                # 按照表头顺序填充数据
-                for header in sorted_headers[1:]:  # 跳过第一个元素（空字符串）
-                    value = element_data.get(header, "")  # 默认值为空字符串
-                    row.append(value)
-
-                result_array.append(row)
-
-            return result_array
+            if columns is None:
+                # 收集所有可能的表头（内层字典键）
+                all_headers = set()
+                for element_data in nested_dict.values():
+                    all_headers.update(element_data.keys())
+                columns = sorted(all_headers)
+            headers = columns
+            if rows is None:
+                rows = sorted(nested_dict)
+
+        # 初始化结果数组，第一行为表头（空字符串对应表头列的位置）
+        result_array = [[""] + list(headers)]
+        position = {header: j for j, header in enumerate(headers, start=1)}
+        blank = [""] * len(headers)
+        for element_name in rows:
+            row = [element_name]  # 行首为元素名称
+            row += blank  # 默认值为空字符串
+            for header, value in nested_dict.get(element_name, {}).items():
+                j = position.get(header)
+                if j is not None:
+                    row[j] = value
+            result_array.append(row)
+
+        return result_array
 
     @staticmethod
+    @timed_stage("table_to_dict")
     def table_to_dict(chem_op_2D_array):
         """
         将包含表头的二维数组转换为嵌套字典结构。
@@ -167,6 +408,7 @@ class chem_interface:
         - 第一行为表头
         - 第一列为各元素的名字
         - 其余单元格为数值或空值
+        也可以是列式表格（见 table_wire.py）；单元格由 table_ingest.ingest_table 一次性转换为 float64，不再逐个调用 float()
 
         返回格式：
         {
@@ -174,41 +416,14 @@ class chem_interface:
             "元素名称2": {"表头1": 值3, "表头2": 值4, ...},
             ...
         }
+        非数字值保持原样（substance 表格的文字属性）；数值表格请直接使用 table_ingest.ingest_table，它另外给出出错单元格的位置
         """
         try:
-            if not isinstance(chem_op_2D_array[0], list):
-                raise ValueError("输入必须是二维数组")
+            return table_ingest.ingest_table(chem_op_2D_array).to_dict(keep_invalid=True)
         except ValueError as e:
-            print(f"错误: {e}")
+            logger.warning("错误: %s", e)
             return {}  # 返回空字典表示转换失败
 
-        header = chem_op_2D_array[0]  # 获取表头行
-        data_rows = chem_op_2D_array[1:]  # 获取数据行
-
-        result_dict = {}
-
-        for row in data_rows:
-            if not isinstance(row, list) or len(row) == 0:
-                continue  # 跳过空行或无效行
-
-            element_name = row[0]  # 第一列为元素名称
-            element_data = {}  # 存储当前元素的数据
-
-            # 遍历表头和对应的数据列
-            for col_idx in range(1, min(len(header), len(row))):
-                cell_value = row[col_idx]
-                if cell_value not in (None, ""):  # 跳过空值
-                    try:
-                        # 尝试将值转换为浮点数
-                        element_data[header[col_idx]] = float(cell_value)
-                    except (ValueError, TypeError):
-                        # 非数字值保持原样
-                        element_data[header[col_idx]] = cell_value
-
-            result_dict[element_name] = element_data
-
-        return result_dict
-
     def get_processor(self, table_type, instruction):
         processors = {
             "conc": {
@@ -219,9 +434,13 @@ class chem_interface:
                 "exp_table": self._process_exp_table,
                 "conc_table": self._process_conc_table,
                 "substance_table": self._process_substance_table,
+                "plate_table": self._process_plate_table,
             },
             "substance": {
                 "update": self._process_substance_update,
+            },
+            "plate": {
+                "update": self._process_plate_update,
             }
         }
         return processors.get(table_type, {}).get(instruction)  # 直接返回函数或 None
@@ -231,7 +450,7 @@ class chem_interface:
 
     # ===== Conc 表格处理方法 =====
     def _process_conc_update(self, name_of_exp, table_rootId, table_content, header_cell_content, the_request):
-        print("_process_conc_update")
+        logger.debug("_process_conc_update")
         name_of_exp = header_cell_content["Stocks of Experiment name"]
         self.update_stock(name_of_exp, table_rootId, table_content, header_cell_content, the_request)
 
@@ -241,33 +460,40 @@ class chem_interface:
                              'headerLabels': ["Experiment name"]}
         exp_json_config = self.json_config_composer(table_rootId, "exp", exp_table_content, exp_header_config,
                                                     the_request)
+        the_exp = self.get_experiment(exp_id=table_rootId)
+        exp_json_config = self._versioned_table_config(exp_json_config, the_exp, "exp", the_request)
+        exp_json_config['recompute_stats'] = dict(the_exp.recompute_stats)
         # 可以考虑返回 exp 表格的配置，或者同时返回 conc 和 exp 表格的配置
         return exp_json_config
 
     def _process_conc_table(self, name_of_exp, table_rootId, table_content, header_cell_content, the_request):
         """处理 conc 表格的特殊请求"""
-        print("in _process_conc_table")
+        logger.debug("in _process_conc_table")
         name_of_exp = header_cell_content["Experiment name"]
         conc_header_config = {'headerContents': [name_of_exp],'headerMutables': [False],'headerLabels':["Stocks of Experiment name"]}
-        conc_table_content = self.Get_conc_table(name_of_exp, rootId=table_rootId)
-        conc_json_config = self.json_config_composer(table_rootId, "conc", conc_table_content, conc_header_config)
-        return conc_json_config
+        if the_request.get('window'):
+            return self._window_table_config(table_rootId, "conc", name_of_exp, conc_header_config, the_request['window'])
+        return self._cached_table_config(table_rootId, "conc", name_of_exp, lambda: self.json_config_composer(
+            table_rootId, "conc", self.Get_conc_table(name_of_exp, rootId=table_rootId), conc_header_config),
+            the_request=the_request)
 
     # ===== Exp 表格处理方法 =====
     def _process_exp_update(self, name_of_exp, table_rootId, table_content, header_cell_content, the_request):
         """处理 exp 表格的更新请求"""
-        print("in _process_exp_update")
+        logger.debug("in _process_exp_update")
         name_of_exp = header_cell_content["Experiment name"]
         return self.update_exp(name_of_exp, table_rootId, table_content, header_cell_content, the_request)
 
     def _process_exp_table(self, name_of_exp, table_rootId, table_content, header_cell_content, the_request):
         """处理 exp 表格的特殊请求"""
-        print("in _process_exp_table", header_cell_content)
+        logger.debug("in _process_exp_table %s", header_cell_content)
         name_of_exp = header_cell_content["Experiment name"]
         conc_header_config = {'headerContents': [name_of_exp],'headerMutables': [True],'headerLabels':["Experiment name"]}
-        conc_table_content = self.Get_exp_table(name_of_exp, rootId=table_rootId)
-        conc_json_config = self.json_config_composer(table_rootId, "exp", conc_table_content, conc_header_config, the_request)
-        return conc_json_config
+        if the_request.get('window'):
+            return self._window_table_config(table_rootId, "exp", name_of_exp, conc_header_config, the_request['window'])
+        return self._cached_table_config(table_rootId, "exp", name_of_exp, lambda: self.json_config_composer(
+            table_rootId, "exp", self.Get_exp_table(name_of_exp, rootId=table_rootId), conc_header_config), the_request,
+            the_request)
 
     def _process_substance_update(self, name_of_exp, table_rootId, table_content, header_cell_content, the_request):
         """处理 substance 表格的更新请求"""
@@ -284,17 +510,60 @@ class chem_interface:
 
 
 
+    # ===== Plate 表格处理方法 =====
+    def _process_plate_table(self, name_of_exp, table_rootId, table_content, header_cell_content, the_request):
+        """生成整板配方设计的空白表格：每行一个孔位，每列一个物质的目标浓度，表头单元格为体积参数"""
+        name_of_exp = header_cell_content["Experiment name"]
+        the_exp = self.get_experiment(exp_name=name_of_exp, exp_id=table_rootId)
+        plate_table_content = [[""] + sorted(the_exp.substance_index.keys()), ["A1"] + [""] * len(the_exp.substance_index)]
+        plate_header_config = {'headerContents': [name_of_exp, 100, 1, 100], 'headerMutables': [False, True, True, True],
+                               'headerLabels': ["Plate of Experiment name", "Total volume", "Min volume", "Max volume"]}
+        return self.json_config_composer(table_rootId, "plate", plate_table_content, plate_header_config)
+
+    def _process_plate_update(self, name_of_exp, table_rootId, table_content, header_cell_content, the_request):
+        """提交整板配方设计：一次求解所有孔位并生成对应的试样，返回更新后的 exp 表格"""
+        name_of_exp = header_cell_content["Plate of Experiment name"]
+        self._journal("plate_update", name_of_exp=name_of_exp, rootId=table_rootId, table_content=table_content,
+                      header_cell_content=header_cell_content)
+        the_exp = self.get_experiment(exp_name=name_of_exp, exp_id=table_rootId)
+        plate_table = self._ingest(table_content)
+        plate_targets = {}
+        for well, targets in plate_table.items():
+            if well in (None, ""):
+                continue
+            plate_targets[well] = targets
+        try:
+            plate_result = the_exp.design_plate(plate_targets,
+                                                total_volume=float(header_cell_content["Total volume"]),
+                                                min_volume=float(header_cell_content["Min volume"]),
+                                                max_volume=float(header_cell_content["Max volume"]))
+        except InventoryError as e:
+            return self._inventory_response(e, plate_table)
+        the_exp.recompute_concentrations()
+        self._maybe_compact()
+
+        exp_table_content = self.Get_exp_table(name_of_exp, rootId=table_rootId)
+        exp_header_config = {'headerContents': [name_of_exp], 'headerMutables': [True],
+                             'headerLabels': ["Experiment name"]}
+        exp_json_config = self.json_config_composer(table_rootId, "exp", exp_table_content, exp_header_config)
+        exp_json_config = self._versioned_table_config(exp_json_config, the_exp, "exp", the_request)
+        exp_json_config['plate_residuals'] = {well: info["residual"] for well, info in plate_result.items()}
+        exp_json_config.update(self._input_errors(plate_table))
+        exp_json_config['recompute_stats'] = dict(the_exp.recompute_stats)
+        return exp_json_config
+
     def _common_processing(self, name_of_exp, table_rootId, table_content, header_cell_content, table_type, instruction):
-        print(f"Processing {instruction} for {table_type} table with exp name: {name_of_exp} and rootId: {table_rootId}")
+        logger.debug("Processing %s for %s table with exp name: %s and rootId: %s", instruction, table_type, name_of_exp, table_rootId)
         # 这里可以添加通用的处理逻辑
         return {"status": f"{instruction} {table_type} table success"}
 
+    @timed_stage("json_config_composer")
     def json_config_composer(self, rootId, table_type, table_data, header_config=None, other_config=None):
         """
         生成表格配置JSON
 
         参数:
-            table_type (str): 表格类型，可选值: 'exp', 'conc', 'substance'
+            table_type (str): 表格类型，可选值: 'exp', 'conc', 'substance', 'plate'
             table_data (list): 表格数据，二维数组
             header_config (dict, optional): 表头配置，包含headerContents, headerMutables, headerLabels
             other_config (dict, optional): 其他配置，将合并到最终配置中
@@ -316,7 +585,11 @@ class chem_interface:
                 'floatingWindow': False,
                 'exp_table': False,
                 'conc_table': True,
-                'substance_table': True
+                'substance_table': True,
+                'plate_table': True,
+                'export': True,
+                'import': True,
+                'window': True
             }
         else:  # conc和substance类型
             buttons_config = {
@@ -330,7 +603,11 @@ class chem_interface:
                 'floatingWindow': True,
                 'exp_table': False,
                 'conc_table': False,
-                'substance_table': False
+                'substance_table': False,
+                'plate_table': False,
+                'export': table_type in ('conc', 'substance'),  # 整板配方表只是输入，不导出
+                'import': False,
+                'window': False
             }
 
         # 构建完整配置
@@ -354,95 +631,121 @@ class chem_interface:
 
         return config
 
+    @staticmethod
+    def _journal_request(the_request):
+        """请求中重放时用得到的部分"""
+        return {key: the_request.get(key) for key in ("trial_ids", "row_changed") if the_request.get(key) is not None}
+
     @staticmethod
     def Chem_op_header_handler(chem_op_2D_array, row_id_table = None, row_changed = None):
-        print("Chem_op_header_handler")
+        logger.debug("Chem_op_header_handler")
         ##输入针对特别列表：第一行为表头，第一列为各元素的名字，且内部都是数字（主要是在掌握输入值为空的时候）
         ##further arrays 是2D_array的每一行
         ##返回值：stacked_chem_op_2D_array 是字典组成的字典，字典键为最左列内容，值为字典（即表头值：本行输入值），代表输入的一列中和表头对应的内容
-        ##返回值命名为：stacked_chem_op_2D_array
-        try:
-            if not isinstance(chem_op_2D_array, list):
-                raise ValueError("need to pass 2D array")
-            if len(chem_op_2D_array) == 0 or not isinstance(chem_op_2D_array[0], list):
-                raise ValueError("need to pass 2D array")
-        except ValueError as e:
-            print(f"出现错误: {e}")
-        header = chem_op_2D_array[0]
-        del chem_op_2D_array[0]
-
+        ##返回值命名为：stacked_chem_op_2D_array，为 table_ingest.IngestedTable（{行名: {列名: 数值}} 的映射，另有矩阵与掩码）
+        ##不修改传入的列表；row_id_table 去掉表头行后返回
+        stacked_chem_op_2D_array = table_ingest.ingest_table(chem_op_2D_array)
+        if stacked_chem_op_2D_array.errors:
+            error = stacked_chem_op_2D_array.errors[0]
+            raise ValueError(f"第 {error['row']} 行第 {error['column']} 列的 {error['value']!r} {error['error']}")
         if row_id_table:
-            del row_id_table[0]
+            row_id_table = row_id_table[1:]
         if row_changed is None:
-            row_changed = [1]*len(row_id_table)
-        stacked_chem_op_2D_array = {}
-        for further_arrays in chem_op_2D_array:
-            dict_in_return = {}
-            index_here = int(1)
-            while index_here < len(further_arrays):
-                if further_arrays[index_here] != "" and further_arrays[index_here] is not None:
-                    dict_in_return[header[index_here]] = float(further_arrays[index_here])
-                index_here += 1
-            stacked_chem_op_2D_array[further_arrays[0]] = dict_in_return
-        print(f"stacked_chem_op_2D_array: {stacked_chem_op_2D_array}, row_id_table: {row_id_table}, row_changed: {row_changed}")
+            row_changed = [1] * len(stacked_chem_op_2D_array.rows)
+        logger.debug("stacked_chem_op_2D_array: %s, row_id_table: %s, row_changed: %s", stacked_chem_op_2D_array, row_id_table, row_changed)
 
         return stacked_chem_op_2D_array, row_id_table, row_changed
 
     def _update_experiment_info(self, name_of_exp, rootId):
-        if rootId not in self.id_exp_name:
-            an_exp = Experiment(name=name_of_exp, table_id=rootId)
-            self.dict_of_experiment[name_of_exp] = [rootId, an_exp]
-            self.id_exp_name[rootId] = name_of_exp
-        else:
-            prior_name = self.id_exp_name[rootId]
-            prior_id_address = self.dict_of_experiment[prior_name]
-            del self.id_exp_name[rootId]
-            del self.dict_of_experiment[prior_name]
-            self.id_exp_name[rootId] = name_of_exp
-            self.dict_of_experiment[name_of_exp] = prior_id_address
-        return self.dict_of_experiment[name_of_exp][1]
+        with self._registry_lock:
+            if self.id_exp_name.get(rootId) != name_of_exp:
+                self._journal("rename_exp", name_of_exp=name_of_exp, rootId=rootId)
+            if rootId not in self.id_exp_name:
+                an_exp = Experiment(name=name_of_exp, table_id=rootId, recompute_mode="incremental")
+                self.dict_of_experiment[name_of_exp] = [rootId, an_exp]
+                self.id_exp_name[rootId] = name_of_exp
+            else:
+                prior_name = self.id_exp_name[rootId]
+                prior_id_address = self.dict_of_experiment[prior_name]
+                del self.id_exp_name[rootId]
+                del self.dict_of_experiment[prior_name]
+                self.id_exp_name[rootId] = name_of_exp
+                self.dict_of_experiment[name_of_exp] = prior_id_address
+            return self.dict_of_experiment[name_of_exp][1]
 
     def update_exp(self, name_of_exp, rootId, list_of_fetch, header_cell_content, the_request):
         #加入其他composite而构成的trial
-        print("success in getting into update_exp")
+        logger.debug("success in getting into update_exp")
+        self._journal("update_exp", name_of_exp=name_of_exp, rootId=rootId, table_content=list_of_fetch,
+                      header_cell_content=header_cell_content, request=chem_interface._journal_request(the_request))
         the_exp = self._update_experiment_info(name_of_exp, rootId)
-        print(f"update_exp: experiment in operation: {the_exp}\n")
+        logger.debug("update_exp: experiment in operation: %s", the_exp)
 
-        dict_of_create = chem_interface.table_to_dict(list_of_fetch)
-        the_exp.new_exp_from_2d_array(dict_of_create, the_request.get("trial_ids"))
-        the_exp.update_all_concentrations()
-        return {'status':'create_new_trial_success'}
+        table_of_create = self._ingest(list_of_fetch)
+        try:
+            diff_summary = the_exp.new_exp_from_2d_array(table_of_create, the_request.get("trial_ids"), the_request.get("row_changed"))
+        except InventoryError as e:
+            return self._inventory_response(e, table_of_create)
+        the_exp.recompute_concentrations()
+        self._maybe_compact()
+        return {'status':'create_new_trial_success', 'diff': diff_summary, 'recompute_stats': dict(the_exp.recompute_stats),
+                **self._input_errors(table_of_create)}
 
 
     def update_stock(self, name_of_exp, rootId, list_of_fetch, header_cell_content, the_request):
-        print("success in getting into update_stock")
-
+        logger.debug("success in getting into update_stock")
+        self._journal("update_stock", name_of_exp=name_of_exp, rootId=rootId, table_content=list_of_fetch,
+                      header_cell_content=header_cell_content, request=chem_interface._journal_request(the_request))
         the_exp = self._update_experiment_info(name_of_exp, rootId)
 
-        dict_of_create = chem_interface.table_to_dict(list_of_fetch)
+        table_of_create = self._ingest(list_of_fetch)
 
-        the_exp.stock_from_2d_array(dict_of_create, the_request.get("trial_ids"))
-        the_exp.update_all_concentrations()
-        return {'status': 'stock_update_success'}
+        the_exp.stock_from_2d_array(table_of_create, the_request.get("trial_ids"))
+        the_exp.recompute_concentrations()
+        self._maybe_compact()
+        return {'status': 'stock_update_success', **self._input_errors(table_of_create)}
+
+    @staticmethod
+    @timed_stage("ingest_table")
+    def _ingest(table_content):
+        """提交的数值表格（conc/exp/plate）转为 table_ingest.IngestedTable，非数字的单元格跳过并记录位置"""
+        table = table_ingest.ingest_table(table_content)
+        if table.errors:
+            logger.warning("提交的表格中有 %d 个单元格不是数字，已跳过，第一个: %s", len(table.errors), table.errors[0])
+        return table
+
+    @staticmethod
+    def _inventory_response(error, table):
+        """有限量试样被超量使用时的响应：没有做任何修改，列出全部超量的试样（见 inventory.check_submission）"""
+        logger.warning("提交的配方超量使用了 %d 个有限量试样，未做修改: %s", len(error.report), error)
+        return {'status': 'inventory_insufficient', 'message': str(error), 'inventory_errors': error.report,
+                **chem_interface._input_errors(table)}
+
+    @staticmethod
+    def _input_errors(table):
+        """响应中列出跳过的单元格（行号、列号为在提交的二维数组中的下标），没有时不加这一项"""
+        if not table.errors:
+            return {}
+        return {'input_errors': table.errors[:chem_interface.INPUT_ERRORS_SHOWN], 'input_error_count': len(table.errors)}
 
 
 
     def update_substance(self, name_of_exp, table_rootId, table_content, header_cell_content, the_request):
         """处理 substance 表格的更新请求"""
-        print("success in getting into update_substance")
+        logger.debug("success in getting into update_substance")
         the_exp = self._update_experiment_info(name_of_exp, table_rootId)
 
         dict_of_create = chem_interface.table_to_dict(table_content)
         the_exp.substance_from_2d_array(dict_of_create, the_request.get("trial_ids"))  # 假设 Experiment 类有 substance_from_2d_array 方法
-        the_exp.update_all_concentrations()
+        the_exp.recompute_concentrations()
         return {'status': 'substance_update_success'}
 
     def Get_substance_table(self, exp_name=None, rootId=None, table_header=None):
-        print("success getting into Get_substance_table")
+        logger.debug("success getting into Get_substance_table")
         # 解析目标实验
         target_exp=self.get_experiment(exp_name, rootId)
 
-        print(f"Get_substance_table: 找到实验 {target_exp.name} (rootId: {target_exp.table_id})")
+        logger.debug("Get_substance_table: 找到实验 %s (rootId: %s)", target_exp.name, target_exp.table_id)
 
         # 构建嵌套字典（适用于 dict_to_table 的对称模式）
         substance_dict = {}
@@ -458,12 +761,16 @@ class chem_interface:
         return self.dict_to_table(substance_dict, symmetric=True)
 
     def Get_conc_table(self, exp_name=None, rootId=None, table_header=None):
-        print("success in getting into GET_conc")
+        logger.debug("success in getting into GET_conc")
         # 解析目标实验
         target_exp=self.get_experiment(exp_name, rootId)
 
-        print(f"Get_conc: 找到实验 {target_exp.name} (rootId: {target_exp.table_id})")
+        logger.debug("Get_conc: 找到实验 %s (rootId: %s)", target_exp.name, target_exp.table_id)
+        # 同一版本的实验只渲染一次
+        return self.response_cache.get_or_build((target_exp.uid, "conc_table", target_exp.version),
+                                                lambda: self._render_conc_table(target_exp, table_header))
 
+    def _render_conc_table(self, target_exp, table_header=None):
         # 构建嵌套字典（适用于 dict_to_table 的对称模式）
         conc_dict = {}
         for trial_name, id_add_list in target_exp.sample_dict.items():
@@ -475,18 +782,23 @@ class chem_interface:
         if not table_header:
             table_header = list(conc_dict.keys()) if conc_dict else []
 
-        # 调用 dict_to_table 生成对称表格
-        return self.dict_to_table(conc_dict, symmetric=False)
+        # 行、列顺序取自实验维护的有序索引，不再每次排序
+        return self.dict_to_table(conc_dict, symmetric=False, columns=target_exp.substance_columns.ordered(),
+                                  rows=target_exp.trial_rows.ordered())
 
 
 
     def Get_exp_table(self, exp_name=None, rootId=None, table_header=None):
-        print("success getting into Get_exp_table")
+        logger.debug("success getting into Get_exp_table")
         # 解析目标实验
         target_exp=self.get_experiment(exp_name, rootId)
 
-        print(f"Get_exp_table: 找到实验 {target_exp.name} (rootId: {target_exp.table_id})")
+        logger.debug("Get_exp_table: 找到实验 %s (rootId: %s)", target_exp.name, target_exp.table_id)
+        # 同一版本的实验只渲染一次
+        return self.response_cache.get_or_build((target_exp.uid, "exp_table", target_exp.version),
+                                                lambda: self._render_exp_table(target_exp, table_header))
 
+    def _render_exp_table(self, target_exp, table_header=None):
         # 构建嵌套字典（适用于 dict_to_table 的对称模式）
         composite_dict = {}
         for trial_name, id_add_list in target_exp.sample_dict.items():
@@ -501,26 +813,90 @@ class chem_interface:
         # 调用 dict_to_table 生成对称表格
         return self.dict_to_table(composite_dict, symmetric=True)
 
+    def Get_table_window(self, exp_name=None, rootId=None, table_type="conc", window=None):
+        """
+        conc/exp 表格的一个窗口：先排序、筛选行（见 table_window.normalize_window），再取 [rows) x [columns) 范围内的单元格
+        只生成窗口内的行，不渲染整表；整表的行列名与排序筛选后的行顺序按实验版本缓存，翻页时不重新计算
+        :return: (窗口的二维表格, {"rows": 实际范围, "columns": 实际范围, "total_rows": 筛选后的行数,
+                  "total_columns": 列数, "unfiltered_rows": 筛选前的行数, "sort": ..., "filter": ...})
+        """
+        if table_type not in table_window.WINDOW_TABLES:
+            raise ValueError(f"{table_type} 表格不支持分窗口读取")
+        target_exp = self.get_experiment(exp_name, rootId)
+        window = table_window.normalize_window(window or {})
+        uid, version = target_exp.uid, target_exp.version
+        rows, columns = self.response_cache.get_or_build((uid, f"{table_type}_axes", version),
+                                                         lambda: table_window.table_axes(target_exp, table_type))
+        unfiltered_rows = len(rows)
+        if window["sort"] or window["filter"]:
+            base_rows = rows
+            rows = self.response_cache.get_or_build(
+                (uid, f"{table_type}_order", version, table_window.order_key(window)),
+                lambda: table_window.row_order(target_exp, table_type, base_rows, window["sort"], window["filter"]))
+        row_start, row_end = table_window.clip(window["rows"], len(rows))
+        column_start, column_end = table_window.clip(window["columns"], len(columns))
+        with metrics.REGISTRY.stage("table_window"):
+            table = table_window.window_table(target_exp, table_type, rows[row_start:row_end],
+                                              columns[column_start:column_end])
+        return table, {"rows": [row_start, row_end], "columns": [column_start, column_end], "total_rows": len(rows),
+                       "total_columns": len(columns), "unfiltered_rows": unfiltered_rows,
+                       "sort": window["sort"], "filter": window["filter"]}
+
+    def import_table(self, name_of_exp, rootId, kind, rows):
+        """
+        从文件批量导入 stock（kind="stock"）或配方（kind="recipe"），见 table_import.RowImporter；实验不存在时创建
+        有效行每 1000 行为一块，先写一条日志再交给 Experiment 的批量方法；出错的行跳过，不影响其他行，全部导入后重算一次浓度
+        调用方需持有该实验的写锁（见 import_route）
+        :param rows: 行的可迭代对象（第一行为表头），见 table_import.iter_rows
+        :return: 导入的行数、新增/修改/未变的行数、出错行数及明细（error_details）
+        """
+        the_exp = self._update_experiment_info(name_of_exp, rootId)
+
+        def journal_chunk(chunk_kind, chunk_rows, ids):
+            self._journal("import_rows", name_of_exp=name_of_exp, rootId=rootId, kind=chunk_kind, rows=chunk_rows, ids=ids)
+
+        importer = table_import.RowImporter(the_exp, kind, on_chunk=journal_chunk,
+                                            id_prefix=f"{rootId}_import_{Experiment.generate_serial_number()}_")
+        result = importer.feed(rows)
+        the_exp.recompute_concentrations()
+        result['status'] = 'import_success'
+        result['recompute_stats'] = dict(the_exp.recompute_stats)
+        return result
+
     def create_exp(self, exp_name, exp_id):
-        # 假设实验地址暂时使用 None 代替，后续可根据实际情况修改
-        exp_address = Experiment(exp_name,table_id=exp_id)
-        # 添加新实验到 interface
-        self.add_experiment(exp_name, exp_id, exp_address)
-        # 获取实验表格数据
-        exp_table_content = self.Get_exp_table(exp_name=exp_name, rootId=exp_id)
+        # 同一 rootId 上正在进行的写操作先完成，保证日志顺序与执行顺序一致
+        with self.locked_experiment(exp_id, write=True):
+            with self._registry_lock:
+                self._journal("create_exp", exp_name=exp_name, exp_id=exp_id)
+                # 假设实验地址暂时使用 None 代替，后续可根据实际情况修改
+                exp_address = Experiment(exp_name,table_id=exp_id, recompute_mode="incremental")
+                # 添加新实验到 interface
+                self.add_experiment(exp_name, exp_id, exp_address)
+            # 获取实验表格数据
+            exp_table_content = self.Get_exp_table(exp_name=exp_name, rootId=exp_id)
         # 表头配置
         header_config = {
             'headerContents': [exp_name],
             'headerMutables': [True],
             'headerLabels': ["Experiment name"]
         }
+        self._maybe_compact()
         # 生成表格配置 JSON
         return self.json_config_composer(exp_id, "exp", exp_table_content, header_config)
 
 
 
 app = Flask(__name__, template_folder=os.getcwd())
-this_interface = chem_interface()
+# 操作日志目录，设置环境变量 CHEM_TABLE_JOURNAL 为空字符串可关闭日志（重启后不恢复）
+this_interface = chem_interface(journal_dir=os.environ.get("CHEM_TABLE_JOURNAL", "journal"))
+# 按需的单请求 cProfile，结果写入环境变量 CHEM_TABLE_PROFILE_DIR 指定的目录
+this_profiler = RequestProfiler(os.environ.get("CHEM_TABLE_PROFILE_DIR", "profiles"))
+# 请求自带的 "profile" / X-Chem-Profile 默认只对本机请求有效，设置环境变量 CHEM_TABLE_PROFILE_REMOTE=1 后对所有客户端有效
+PROFILE_REMOTE = os.environ.get("CHEM_TABLE_PROFILE_REMOTE", "").lower() in ("1", "true", "yes")
+
+
+def _is_local_request():
+    return request.remote_addr in ("127.0.0.1", "::1", None)
 
 
 
@@ -533,9 +909,23 @@ def send_static(path):
     return send_from_directory('static', path)
 
 #发送前端数据时从这里补充
+def _gzip_response(response):
+    """客户端接受 gzip（Accept-Encoding）且响应不小于 GZIP_MIN_BYTES 时压缩响应体"""
+    response.vary.add("Accept-Encoding")
+    if "gzip" not in request.accept_encodings or response.direct_passthrough:
+        return response
+    data = response.get_data()
+    if len(data) < chem_interface.GZIP_MIN_BYTES:
+        return response
+    response.set_data(table_wire.gzip_body(data, chem_interface.GZIP_LEVEL))
+    response.headers["Content-Encoding"] = "gzip"
+    return response
+
+
 @app.route('/config_acceptor', methods = ['POST'])
 def method_segregator():
         if request.method == 'POST':
+            key = "invalid"
             try:
                 # 获取前端传递的数据
                 the_request = request.get_json()
@@ -544,37 +934,182 @@ def method_segregator():
                 config = the_request.get('config')
                 table_type = config["table_type"]
                 instruction = config["instruction"]
-                table_content = the_request.get('table_content') #二维数组
-                header_cell_content = the_request.get('header_cell_content') #字典，序号:内部数据
-                # 尚未实现每个trial分别管理，赋予id，以及记忆每行修改的情况，分别修改的功能，即每次更新都是全表全更新，而没有
-                # 生成trial_ids（改进逻辑，假设第一列是trial名称）
-                trial_ids = []
-                if table_content:
-                    # 跳过表头行，假设第一行是表头
-                    for row in table_content[1:]:
-                        if row and row[0]:
+                key = metrics.MetricsRegistry.request_key(table_type, instruction)
+                metrics.REGISTRY.observe_payload(key, "request", request.content_length or 0)
+                with metrics.REGISTRY.request(key):
+                    table_content = the_request.get('table_content') #二维数组，或列式表格（见 table_wire.py）
+                    header_cell_content = the_request.get('header_cell_content') #字典，序号:内部数据
+                    # 分析结果（含服务器上的绝对路径）只返回给可信的请求；arm() 触发的其他请求到 /admin/profile 查看
+                    profile_trusted = PROFILE_REMOTE or _is_local_request()
+                    profiling = this_profiler.wants(the_request, request.headers, trusted=profile_trusted)
+                    # 响应格式：Accept 中选择列式（JSON 列表 / base64 / 二进制），默认二维数组的 JSON
+                    media_type = request.accept_mimetypes.best_match(table_wire.MEDIA_TYPES, default="application/json")
+                    # 表格请求：实验自上次响应后没有变化（If-None-Match 与当前版本的 ETag 相同）则直接返回 304，不渲染也不编码JSON
+                    with metrics.REGISTRY.stage("etag"):
+                        current_etag = this_interface.table_etag(table_type, instruction, table_rootId, header_cell_content,
+                                                                 the_request.get('window'))
+                    if current_etag is not None and media_type in table_wire.ETAG_SUFFIX:
+                        current_etag = f"{current_etag}-{table_wire.ETAG_SUFFIX[media_type]}"
+                    if current_etag is not None and not profiling and request.if_none_match.contains_weak(current_etag):
+                        response = app.response_class(status=304)
+                        response.set_etag(current_etag, weak=True)
+                        response.vary.add("Accept")
+                        return response
+                    # 尚未实现每个trial分别管理，赋予id，以及记忆每行修改的情况，分别修改的功能，即每次更新都是全表全更新，而没有
+                    # 生成trial_ids（改进逻辑，假设第一列是trial名称）
+                    trial_ids = []
+                    if table_content:
+                        # 跳过表头行，假设第一行是表头
+                        for row_name in table_wire.row_names(table_content):
                             trial_ids.append(f"{table_rootId}_trial_{len(trial_ids)}")
+                    the_request["trial_ids"] = trial_ids
+
+                    # 根据 instruction 调用相应的处理方法
+                    logger.debug("request: %s", the_request)
+                    processor =this_interface.locked_processor(str(table_type), str(instruction))
+                    profile_info = None
+                    with metrics.REGISTRY.stage("processor"):
+                        if profiling:
+                            result, profile_info = this_profiler.run(key, processor, name_of_exp, table_rootId,
+                                                                     table_content, header_cell_content, the_request)
+                            if not profile_trusted:
+                                profile_info = None
+                            elif isinstance(result, dict):
+                                result['profile'] = profile_info
                         else:
-                            trial_ids.append(f"{table_rootId}_trial_{len(trial_ids)}")
-                the_request["trial_ids"] = trial_ids
-
-                #print(f"{instruction}\n{name_of_exp}\n{table_rootId}\n{two_d_array}\n{row_id_table}")
-
-                # 根据 instruction 调用相应的处理方法
-                print("request: ",the_request)
-                print(table_type, instruction)
-                processor =this_interface.get_processor(str(table_type), str(instruction))
-                print("table content and header contents",table_content, header_cell_content)
-                result = processor(name_of_exp, table_rootId, table_content, header_cell_content, the_request)
-                print(this_interface.id_exp_name)
-                print(f"\nmethod_segregator_result: result:{result}")
-                return jsonify(result)
+                            result = processor(name_of_exp, table_rootId, table_content, header_cell_content, the_request)
+                    logger.debug("method_segregator_result: result:%s", result)
+                    etag = result.pop('etag', None) if isinstance(result, dict) else None
+                    with metrics.REGISTRY.stage("jsonify"):
+                        content_type = "application/json"
+                        if media_type != "application/json":
+                            result, content_type = table_wire.encode_response(result, media_type)
+                        if isinstance(result, bytes):
+                            response = app.response_class(result, mimetype=content_type)
+                        else:
+                            response = jsonify(result)
+                            response.mimetype = content_type
+                    response.vary.add("Accept")
+                    if etag:
+                        response.set_etag(f"{etag}-{table_wire.ETAG_SUFFIX[media_type]}" if media_type in table_wire.ETAG_SUFFIX
+                                          else etag, weak=True)
+                    with metrics.REGISTRY.stage("gzip"):
+                        _gzip_response(response)
+                    if profile_info:
+                        response.headers[RequestProfiler.HEADER + "-File"] = profile_info["prof"]
+                metrics.REGISTRY.observe_payload(key, "response", response.calculate_content_length() or 0)
+                return response
             except Exception as e:
-                print (f"method_segregator found: {str(e)}")
+                logger.exception("method_segregator found: %s", e)
                 return jsonify({"error": str(e)}), 500
         return render_template('index.html')
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    """
+    本机访问的指标：各 table_type/instruction 的请求数、分阶段耗时直方图（毫秒）、请求/响应大小（字节），以及各实验的规模
+    ?reset=1 读取后清零
+    """
+    if not _is_local_request():
+        return jsonify({"error": "只允许本机访问"}), 403
+    result = metrics.REGISTRY.snapshot()
+    result["experiments"] = metrics.experiment_stats(this_interface.dict_of_experiment)
+    result["response_cache"] = this_interface.response_cache.stats()
+    if request.args.get("reset"):
+        metrics.REGISTRY.reset()
+    return jsonify(result)
+
+
+@app.route('/admin/profile', methods=['GET', 'POST'])
+def profile_route():
+    """
+    本机访问的性能分析开关：POST {"next": n, "top_n": k} 让接下来的 n 个 /config_acceptor 请求都做 cProfile（n 为 0 即取消）
+    GET 返回剩余次数、输出目录以及最近写出的分析文件
+    """
+    if not _is_local_request():
+        return jsonify({"error": "只允许本机访问"}), 403
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        this_profiler.arm(data.get("next", 1), data.get("top_n"))
+    return jsonify({"armed": this_profiler.armed, "directory": os.path.abspath(this_profiler.directory),
+                    "top_n": this_profiler.top_n, "recent": list(this_profiler.recent)})
+
+
+@app.route('/export/<table_type>', methods=['GET'])
+def export_route(table_type):
+    """
+    导出 conc/exp/substance 表格为文件：GET /export/conc?rootId=...&format=csv（或 xlsx；也可用 exp_name= 指定实验）
+    直接从实验状态逐行生成（见 table_export.py），不先构造 dict_to_table 的二维数组：CSV 逐块、XLSX 用 openpyxl 的
+    write-only 模式逐行写入临时文件。只在写文件期间持有该实验的读锁（导出的是同一时刻的内容），释放后再分块发送，
+    下载慢的客户端不会长时间占着读锁、挡住写请求与 compact_journal
+    """
+    file_format = request.args.get("format", "csv").lower()
+    if table_type not in table_export.TABLE_ROWS or file_format not in ("csv", "xlsx"):
+        return jsonify({"error": f"不支持导出 {table_type} 表格为 {file_format}"}), 400
+    exp_name, root_id = request.args.get("exp_name"), request.args.get("rootId")
+    if not exp_name and not root_id:
+        return jsonify({"error": "缺少必要参数"}), 400
+    try:
+        the_exp = this_interface.get_experiment(exp_name, root_id)
+    except KeyError:
+        return jsonify({"error": "实验不存在"}), 404
+    with this_interface._registry_lock:
+        if not root_id:
+            root_id = this_interface.dict_of_experiment[exp_name][0]
+        exp_name = this_interface.id_exp_name.get(root_id, the_exp.name)
+    rows_of = table_export.TABLE_ROWS[table_type]
+
+    def generate():
+        start = time.perf_counter()
+        with this_interface.locked_experiment(root_id, write=False):
+            if file_format == "csv":
+                path = table_export.write_csv(rows_of(the_exp))
+            else:
+                path = table_export.write_xlsx(rows_of(the_exp), title=f"{table_type} {exp_name}")
+        yield from table_export.iter_file(path)
+        logger.info("export_route: 导出 %s 的 %s 表格（%s）用时 %.2f s", exp_name, table_type, file_format,
+                    time.perf_counter() - start)
+
+    mimetype = "text/csv" if file_format == "csv" else \
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    response = app.response_class(generate(), mimetype=mimetype)
+    filename = f"{exp_name}_{table_type}.{file_format}"
+    response.headers["Content-Disposition"] = \
+        f"attachment; filename=\"{table_type}.{file_format}\"; filename*=UTF-8''{quote(filename)}"
+    return response
+
+
+@app.route('/import/<kind>', methods=['POST'])
+def import_route(kind):
+    """
+    上传 CSV/XLSX 文件批量导入：POST /import/stock 或 /import/recipe，multipart 表单字段 file、rootId、exp_name
+    文件格式按扩展名判断（也可用表单字段 format 指定）；文件边读边导入，返回每行的校验错误，导入期间持有该实验的写锁
+    """
+    if kind not in table_import.IMPORT_KINDS:
+        return jsonify({"error": f"未知的导入类型 {kind}"}), 400
+    upload = request.files.get("file")
+    exp_name, root_id = request.form.get("exp_name"), request.form.get("rootId")
+    if upload is None or not exp_name or not root_id:
+        return jsonify({"error": "缺少必要参数"}), 400
+    file_format = (request.form.get("format") or os.path.splitext(upload.filename or "")[1].lstrip(".")).lower()
+    if file_format not in ("csv", "xlsx"):
+        return jsonify({"error": f"不支持的文件格式 {file_format}"}), 400
+    key = metrics.MetricsRegistry.request_key("import", kind)
+    metrics.REGISTRY.observe_payload(key, "request", request.content_length or 0)
+    try:
+        with metrics.REGISTRY.request(key):
+            with this_interface.locked_experiment(root_id, write=True):
+                result = this_interface.import_table(exp_name, root_id, kind,
+                                                     table_import.iter_rows(upload.stream, file_format))
+            this_interface._maybe_compact()
+    except Exception as e:
+        logger.exception("import_route found: %s", e)
+        return jsonify({"error": str(e)}), 500
+    logger.info("import_route: %s 导入 %s 行（%s），出错 %s 行", exp_name, result["imported"], kind, result["errors"])
+    return jsonify(result)
+
+
 @app.route('/create_exp', methods=['POST'])
 def create_exp_route():
     data = request.get_json()
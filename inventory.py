@@ -0,0 +1,205 @@
+import numpy as np
+
+import conc_matrix
+import snapshot
+from table_ingest import IngestedTable
+
+# 累加用量时的相对误差容限，超出可用量不到 TOLERANCE * max(1, 可用量) 的不算超量
+TOLERANCE = 1e-9
+
+
+class InventoryError(ValueError):
+    """
+    提交的配方会超量使用有限量的试样；在修改任何状态之前抛出
+    report 为全部超量的试样（见 check_submission）
+    """
+
+    def __init__(self, report):
+        self.report = report
+        super().__init__("；".join(
+            f"试样 {item['trial']} 的可用量 {item['available']:g} 不足，需要 {item['draw']:g}（从 {item['first_trial']} 起超出）"
+            for item in report))
+
+
+def is_finite(the_trial):
+    """
+    是否为需要检查用量的有限量试样：existing_amount 不为 -1（无限量）且 total_amount 大于0
+    （total_amount 为 0 的是没有登记数量的试样，如由表格创建的 stock，不检查）
+    """
+    return the_trial.existing_amount != -1 and the_trial.total_amount > 0
+
+
+def _ranges(starts, counts):
+    """把若干 [start, start + count) 区间拼接为一个下标数组"""
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return offsets + np.arange(counts.sum())
+
+
+def _first_breaks(capacity, base, consumer, target, amount):
+    """
+    按提交的顺序累加每个有限量试样的用量，找出超量的试样及第一个使其超量的使用者
+    :param capacity: 各有限量试样的可用总量
+    :param base: 各有限量试样已被保留下来的（不在本次提交中的）使用者占用的量
+    :param consumer, target, amount: 本次提交的用量边（使用者的顺序号、有限量试样的下标、用量），按使用者的顺序排列
+    :return: (超量的试样下标, 对应的第一个超量的使用者顺序号, 各试样本次提交的总用量)
+    """
+    draw = np.bincount(target, weights=amount, minlength=len(capacity))
+    if not len(target):
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), draw
+    order = np.argsort(target, kind="stable")  # 同一试样内保持使用者的顺序
+    grouped, amounts = target[order], amount[order]
+    running = np.cumsum(amounts)
+    starts = np.flatnonzero(np.r_[True, grouped[1:] != grouped[:-1]])
+    running -= np.repeat(running[starts] - amounts[starts], np.diff(np.r_[starts, len(grouped)]))
+    limit = capacity[grouped] + TOLERANCE * np.maximum(1.0, np.abs(capacity[grouped]))
+    over = np.flatnonzero(base[grouped] + running > limit)
+    broken, first = np.unique(grouped[over], return_index=True)
+    return broken, consumer[order[over[first]]], draw
+
+
+def _report(names, capacity, base, broken, first_consumer, draw, consumer_names, row_of=None):
+    """:param row_of: row_of(使用者顺序号) 为其在提交中的行号，None 时报告中没有 row"""
+    report = []
+    for index, position in sorted(zip(broken.tolist(), first_consumer.tolist()), key=lambda item: item[1]):
+        available = float(capacity[index] - base[index])
+        item = {"trial": names[index], "available": available, "draw": float(draw[index]),
+                "shortage": float(draw[index]) - available, "first_trial": consumer_names[position]}
+        if row_of is not None:
+            item["row"] = row_of(position)
+        report.append(item)
+    return report
+
+
+def check_submission(the_exp, composites, full_table=True, aliases=None, skipped=None, raise_error=True):
+    """
+    在修改任何状态之前，一次算出提交的配方对每个有限量试样（见 is_finite）的总用量，找出全部超量的试样
+    可用量以 total_amount 减去保留下来的使用者的用量计算，不依赖逐次加减得到的 existing_amount；
+    IngestedTable 直接取矩阵中有限量试样的那几列，不逐行生成字典
+    :param the_exp: Experiment
+    :param composites: {试样名: {组分名: 用量}}（或 table_ingest.IngestedTable），按提交的顺序
+    :param full_table: True 为 new_exp_from_2d_array 的整表提交（表中没有的试样会被删除，有限量试样只能是表中的行）；
+                       False 为 recipes_from_2d_array / design_plate 的部分提交（只覆盖提交的行，其他试样的用量保留）
+    :param aliases: 整表提交时的改名 {新名字: 原试样名}
+    :param skipped: 整表提交时不更新的行名（row_changed 为 0 的已有行），保留其当前的组分
+    :param raise_error: 为 True 时有超量则抛出 InventoryError，否则只返回结果
+    :return: [{"trial": 超量的试样, "available": 可用于本次提交的量, "draw": 本次提交的总用量, "shortage": 缺少的量,
+               "first_trial": 累加到它时第一次超量的试样, "row": 它在提交中的行号（表头为第 0 行）}]，按 row 排序
+    """
+    sample_dict = the_exp.sample_dict
+    aliases = aliases or {}
+    skipped = skipped or ()
+    names = list(composites)
+    submitted = set(names)
+    is_table = isinstance(composites, IngestedTable) and len(set(composites.columns)) == len(composites.columns)
+
+    # 有限量试样：提交中的名字 -> 下标；current 为其当前的试样名
+    # 整表提交时只能是表中的行；部分提交时为提交中出现的组分
+    if full_table:
+        candidates = [(name, aliases.get(name, name)) for name in names]
+    else:
+        if is_table:
+            referenced = composites.columns
+        else:
+            referenced = set().union(*(composite.keys() for composite in composites.values()))
+        candidates = [(name, name) for name in referenced]
+    targets, current, capacity = {}, [], []
+    for name, current_name in candidates:
+        entry = sample_dict.get(current_name)
+        if entry is not None and is_finite(entry[1]):
+            targets[name] = len(current)
+            current.append(current_name)
+            capacity.append(entry[1].total_amount)
+    if not targets:
+        return []
+    capacity = np.asarray(capacity, dtype=np.float64)
+
+    # 保留下来的使用者占用的量
+    if full_table:
+        keep = {aliases.get(name, name) for name in skipped}
+        kept = (lambda consumer: consumer in keep) if keep else None
+    else:
+        kept = lambda consumer: consumer not in submitted
+    base = np.zeros(len(current))
+    if kept is not None:
+        for i, current_name in enumerate(current):
+            base[i] = sum(amount for consumer, amount in sample_dict[current_name][1].master.items() if kept(consumer))
+
+    # 本次提交的用量边
+    consumers = [k for k, name in enumerate(names) if name not in skipped] if skipped else list(range(len(names)))
+    if is_table:
+        columns = np.asarray([j for j, column in enumerate(composites.columns) if column in targets], dtype=np.int64)
+        if len(names) == len(composites.rows):
+            rows = np.asarray(consumers, dtype=np.int64)  # 没有重复的行名，第 k 个名字即第 k 行
+        else:
+            rows = np.asarray([composites.index_of(names[k]) for k in consumers], dtype=np.int64)
+        mask = composites.mask[:, columns]
+        r, c = np.nonzero(mask if len(rows) == len(mask) else mask[rows])
+        consumer = np.asarray(consumers, dtype=np.int64)[r]
+        target = np.asarray([targets[composites.columns[j]] for j in columns.tolist()], dtype=np.int64)[c]
+        amount = composites.values[rows[r], columns[c]]
+        row_of = lambda position: composites.positions[composites.index_of(names[position])]
+    else:
+        consumer, target, amount = [], [], []
+        for k in consumers:
+            composite = composites[names[k]]
+            for component in composite.keys() & targets.keys():
+                value = composite[component]
+                if isinstance(value, (int, float)):
+                    consumer.append(k)
+                    target.append(targets[component])
+                    amount.append(value)
+        consumer = np.asarray(consumer, dtype=np.int64)
+        target = np.asarray(target, dtype=np.int64)
+        amount = np.asarray(amount, dtype=np.float64)
+        row_of = lambda position: position + 1
+
+    broken, first_consumer, draw = _first_breaks(capacity, base, consumer, target, amount)
+    report = _report(list(targets), capacity, base, broken, first_consumer, draw, names, row_of)
+    if report and raise_error:
+        raise InventoryError(report)
+    return report
+
+
+def tree_report(the_exp):
+    """
+    整个依赖树对有限量试样的总用量：从最下游的试样往上，按各试样被使用的量放大其配方
+    （没有登记数量的中间试样需要多少就配制多少，即 max(配方总量, 下游用量)；有限量的中间试样按其配方配制，超量由它自己报告），
+    一次拓扑分层后每层一次 numpy 运算，不逐个试样递归
+    :return: 同 check_submission（没有 row，first_trial 按 sample_dict 的顺序累加得到）
+    :raises ValueError: 存在循环依赖
+    """
+    names = list(the_exp.sample_dict)
+    n = len(names)
+    trials = [entry[1] for entry in the_exp.sample_dict.values()]
+    finite = np.fromiter((is_finite(the_trial) for the_trial in trials), dtype=bool, count=n)
+    if not finite.any():
+        return []
+    row, col, vol = snapshot.composite_coo(the_exp)
+    levels, remaining = conc_matrix.topological_levels(n, row, col)
+    if remaining.size:
+        raise ValueError(f"存在循环依赖，无法计算用量：{', '.join(names[i] for i in remaining[:10].tolist())}")
+
+    batch = np.bincount(row, weights=vol, minlength=n)
+    demand = np.zeros(n)
+    scale = np.zeros(n)
+    ptr = np.searchsorted(row, np.arange(n + 1))  # composite_coo 按使用者排序
+    for level in reversed(levels):
+        # 这一层的使用者都在更下游的层中，需求已经累加完毕
+        made = np.where(finite[level], batch[level], np.maximum(batch[level], demand[level]))
+        scale[level] = np.divide(made, batch[level], out=np.zeros(len(level)), where=batch[level] > 0)
+        starts = ptr[level]
+        counts = ptr[level + 1] - starts
+        if counts.sum():
+            edges = _ranges(starts, counts)
+            np.add.at(demand, col[edges], vol[edges] * np.repeat(scale[level], counts))
+
+    finite_index = np.flatnonzero(finite)
+    target_of = np.full(n, -1, dtype=np.int64)
+    target_of[finite_index] = np.arange(len(finite_index))
+    keep = target_of[col] >= 0
+    capacity = np.fromiter((trials[i].total_amount for i in finite_index.tolist()), dtype=np.float64,
+                           count=len(finite_index))
+    base = np.zeros(len(finite_index))
+    broken, first_consumer, draw = _first_breaks(capacity, base, row[keep], target_of[col[keep]],
+                                                 vol[keep] * scale[row[keep]])
+    return _report([names[i] for i in finite_index.tolist()], capacity, base, broken, first_consumer, draw, names)
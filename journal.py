@@ -0,0 +1,136 @@
+import json
+import os
+import shutil
+import threading
+
+from metrics import logger
+
+
+class Journal:
+    """
+    只追加的操作日志（write-ahead journal）+ 快照，用于进程重启后恢复 chem_interface 的全部实验
+    目录结构：
+        journal.log          每行一个JSON：{"seq": 序号, "op": 操作名, "args": 参数}，写入后 flush（默认还 fsync）
+        snapshot_<seq>/      压缩时写出的快照：manifest.json 加每个实验一个 Experiment.save_snapshot 文件
+        CURRENT              最新一个完整快照的目录名，用 os.replace 原子更新
+    恢复 = 加载 CURRENT 指向的快照 + 只重放 journal.log 中序号大于快照序号的操作；
+    每追加 compact_every 条就压缩一次（写新快照并清空日志），所以重放的条数始终不超过 compact_every
+    """
+
+    def __init__(self, directory, compact_every=1000, fsync=True):
+        """
+        :param directory: 日志与快照所在目录，不存在则创建
+        :param compact_every: 每追加多少条操作压缩一次
+        :param fsync: 每条操作写入后是否 os.fsync，关闭后更快但断电时可能丢失最后几条
+        """
+        self.directory = directory
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self.path = os.path.join(directory, "journal.log")
+        os.makedirs(directory, exist_ok=True)
+        self.seq = 0
+        self.entries_since_snapshot = 0
+        self._file = None
+        self._valid_bytes = None
+        self._lock = threading.Lock()  # 多线程同时 append 时保证序号与写入顺序一致
+
+    def latest_snapshot(self):
+        """
+        :return: (快照序号, manifest, 快照目录) ，没有快照时返回 None
+        """
+        current_path = os.path.join(self.directory, "CURRENT")
+        if not os.path.exists(current_path):
+            return None
+        with open(current_path, "r", encoding="utf-8") as f:
+            snapshot_dir = os.path.join(self.directory, f.read().strip())
+        with open(os.path.join(snapshot_dir, "manifest.json"), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        return manifest["seq"], manifest, snapshot_dir
+
+    def read_entries(self, after_seq=0):
+        """
+        按顺序读出序号大于 after_seq 的操作；崩溃时写了一半的最后一行会被忽略，并在 open_for_append 时截掉
+        :return: [(seq, op, args)]
+        """
+        entries = []
+        self._valid_bytes = 0
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("缺少换行")
+                    entry = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    logger.warning("Journal: 忽略不完整的日志行: %r", line[:80])
+                    break
+                self._valid_bytes += len(line)
+                if entry["seq"] > after_seq:
+                    entries.append((entry["seq"], entry["op"], entry["args"]))
+        return entries
+
+    def open_for_append(self, last_seq):
+        """恢复完成后调用，之后的 append 从 last_seq + 1 开始编号"""
+        self.seq = last_seq
+        if self._valid_bytes is not None and os.path.exists(self.path) \
+                and os.path.getsize(self.path) > self._valid_bytes:
+            with open(self.path, "r+b") as f:
+                f.truncate(self._valid_bytes)
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def append(self, op, args):
+        """
+        追加一条操作并落盘
+        :return: 是否已到需要压缩的条数
+        """
+        line = json.dumps(args, ensure_ascii=False)
+        with self._lock:
+            self.seq += 1
+            self._file.write(f'{{"seq": {self.seq}, "op": {json.dumps(op)}, "args": {line}}}\n')
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self.entries_since_snapshot += 1
+            return self.entries_since_snapshot >= self.compact_every
+
+    def write_snapshot(self, experiments):
+        """
+        把当前全部实验写成序号为 self.seq 的快照，切换 CURRENT 后清空日志并删除旧快照
+        :param experiments: [(实验名, rootId, Experiment)]
+        """
+        dir_name = f"snapshot_{self.seq}"
+        snapshot_dir = os.path.join(self.directory, dir_name)
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+        os.makedirs(snapshot_dir)
+        manifest = {"seq": self.seq, "experiments": []}
+        for k, (exp_name, root_id, the_exp) in enumerate(experiments):
+            file_name = f"exp_{k}.npy"
+            the_exp.save_snapshot(os.path.join(snapshot_dir, file_name))
+            manifest["experiments"].append({"name": exp_name, "rootId": root_id, "file": file_name})
+        with open(os.path.join(snapshot_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+
+        tmp_path = os.path.join(self.directory, "CURRENT.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(dir_name)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.directory, "CURRENT"))
+
+        # 快照已生效：日志中的操作都不再需要（若在此之前崩溃，恢复时也会按序号跳过它们）
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self.path, "w", encoding="utf-8")
+            self.entries_since_snapshot = 0
+        for name in os.listdir(self.directory):
+            if name.startswith("snapshot_") and name != dir_name:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
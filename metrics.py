@@ -0,0 +1,216 @@
+import functools
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+
+# 全项目共用的日志器，级别由环境变量 CHEM_TABLE_LOG_LEVEL 控制（默认 WARNING）
+# 调试输出一律写成 logger.debug("... %s", 参数)，未开启 DEBUG 时只做一次级别判断，不格式化字符串
+logger = logging.getLogger("chemical_table")
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.addHandler(_handler)
+    logger.propagate = False
+logger.setLevel(os.environ.get("CHEM_TABLE_LOG_LEVEL", "WARNING").upper())
+
+# 直方图的桶上界：耗时单位为毫秒，大小单位为字节
+LATENCY_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+SIZE_BUCKETS_BYTES = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class Histogram:
+    """固定桶的直方图，记录次数、总和、最大值，分位数按桶上界估计"""
+    __slots__ = ("bounds", "counts", "count", "total", "max")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """不超过 q 分位数的最小桶上界（落在最后一个桶时返回最大值）"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        # 累计计数 [[上界, 不超过该上界的次数], ...]，用列表保持桶的顺序（jsonify 会对字典的键排序）
+        cumulative, seen = [], 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            cumulative.append([bound, seen])
+        cumulative.append(["+Inf", self.count])
+        return {"count": self.count, "sum": self.total, "max": self.max,
+                "p50": self.quantile(0.5), "p95": self.quantile(0.95), "p99": self.quantile(0.99),
+                "buckets": cumulative}
+
+
+class MetricsRegistry:
+    """
+    Flask 层的请求指标：以 "table_type/instruction" 为键，记录各阶段耗时、请求/响应大小、请求数与出错数
+    阶段耗时只在 request() 上下文内记录（同一线程），直接调用 Experiment 等（如 benchmark）时不记录、几乎没有开销
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.started = time.time()
+        self.stages = {}      # 键 -> {阶段名: Histogram(毫秒)}
+        self.payloads = {}    # 键 -> {"request"/"response": Histogram(字节)}
+        self.requests = {}    # 键 -> {"count": 次数, "errors": 出错次数}
+
+    @staticmethod
+    def request_key(table_type, instruction):
+        return f"{table_type}/{instruction}"
+
+    def current_key(self):
+        return getattr(self._local, "key", None)
+
+    def observe_stage(self, key, stage, elapsed_ms):
+        with self._lock:
+            by_stage = self.stages.setdefault(key, {})
+            histogram = by_stage.get(stage)
+            if histogram is None:
+                histogram = by_stage[stage] = Histogram(LATENCY_BUCKETS_MS)
+            histogram.observe(elapsed_ms)
+
+    def observe_payload(self, key, direction, nbytes):
+        with self._lock:
+            by_direction = self.payloads.setdefault(key, {})
+            histogram = by_direction.get(direction)
+            if histogram is None:
+                histogram = by_direction[direction] = Histogram(SIZE_BUCKETS_BYTES)
+            histogram.observe(nbytes)
+
+    def count_request(self, key, error=False):
+        with self._lock:
+            counter = self.requests.setdefault(key, {"count": 0, "errors": 0})
+            counter["count"] += 1
+            if error:
+                counter["errors"] += 1
+
+    def request(self, key):
+        """整个请求的上下文：期间 stage()/timed_stage 记录到 key 下，退出时记录 "total" 阶段"""
+        return _RequestScope(self, key)
+
+    def stage(self, stage):
+        """在当前请求内计时一个阶段：with metrics.stage("jsonify"): ..."""
+        return _StageScope(self, stage)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "uptime_s": time.time() - self.started,
+                "requests": {key: dict(counter) for key, counter in self.requests.items()},
+                "stages_ms": {key: {stage: h.to_dict() for stage, h in by_stage.items()}
+                              for key, by_stage in self.stages.items()},
+                "payload_bytes": {key: {direction: h.to_dict() for direction, h in by_direction.items()}
+                                  for key, by_direction in self.payloads.items()},
+            }
+
+    def reset(self):
+        with self._lock:
+            self.stages.clear()
+            self.payloads.clear()
+            self.requests.clear()
+            self.started = time.time()
+
+
+class _RequestScope:
+    __slots__ = ("registry", "key", "previous", "start")
+
+    def __init__(self, registry, key):
+        self.registry = registry
+        self.key = key
+
+    def __enter__(self):
+        self.previous = self.registry.current_key()
+        self.registry._local.key = self.key
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed_ms = (time.perf_counter() - self.start) * 1000
+        self.registry._local.key = self.previous
+        self.registry.observe_stage(self.key, "total", elapsed_ms)
+        self.registry.count_request(self.key, error=exc_type is not None)
+        return False
+
+
+class _StageScope:
+    __slots__ = ("registry", "stage", "key", "start")
+
+    def __init__(self, registry, stage):
+        self.registry = registry
+        self.stage = stage
+
+    def __enter__(self):
+        self.key = self.registry.current_key()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.key is not None:
+            self.registry.observe_stage(self.key, self.stage, (time.perf_counter() - self.start) * 1000)
+        return False
+
+
+REGISTRY = MetricsRegistry()
+
+
+def timed_stage(stage):
+    """
+    装饰器：在 Flask 请求内调用被装饰的函数时，把耗时记为该请求的一个阶段；请求之外直接调用原函数
+    :param stage: 阶段名，如 "table_to_dict"、"recompute_concentrations"
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = REGISTRY.current_key()
+            if key is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                REGISTRY.observe_stage(key, stage, (time.perf_counter() - start) * 1000)
+        return wrapper
+    return decorator
+
+
+def experiment_stats(dict_of_experiment):
+    """
+    各实验的规模：trial数、composite边数、出现过浓度的物质数、待重算的trial数
+    只在读取 /metrics 时遍历一次，不占用请求路径
+    :param dict_of_experiment: chem_interface.dict_of_experiment，{实验名: [rootId, Experiment]}
+    """
+    stats = {}
+    for exp_name, (root_id, the_exp) in list(dict_of_experiment.items()):
+        trials = [entry[1] for entry in list(the_exp.sample_dict.values())]
+        stats[exp_name] = {
+            "rootId": root_id,
+            "trials": len(trials),
+            "stocks": sum(1 for the_trial in trials if the_trial.stock),
+            "edges": sum(len(the_trial.composite) for the_trial in trials),
+            "substances": len(the_exp.substance_index),
+            "dirty_trials": len(the_exp.dirty_trials),
+            "recompute_stats": dict(the_exp.recompute_stats),
+        }
+    return stats
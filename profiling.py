@@ -0,0 +1,101 @@
+import cProfile
+import io
+import os
+import pstats
+import re
+import threading
+import time
+
+from metrics import logger
+
+
+class RequestProfiler:
+    """
+    按需对单个 /config_acceptor 请求做 cProfile：平时不开启，不影响其他请求
+    触发方式：请求JSON中 "profile": true、请求头 X-Chem-Profile: 1（只对可信的请求有效，见 wants），或用 arm(n) 让接下来的 n 个请求都被分析
+    每次分析在 directory 下写出 <时间>_<table_type>_<instruction>_<序号>.prof（可用 snakeviz / pstats 打开）
+    以及同名 .txt（按累计耗时排序的前 top_n 个函数）
+    """
+    HEADER = "X-Chem-Profile"
+
+    def __init__(self, directory="profiles", top_n=30):
+        """
+        :param directory: .prof 与摘要文件的目录，第一次写出时创建
+        :param top_n: 摘要中列出的函数个数
+        """
+        self.directory = directory
+        self.top_n = top_n
+        self._lock = threading.Lock()
+        self._armed = 0
+        self._counter = 0
+        self.recent = []  # 最近写出的分析 [{"prof", "summary", "key", "elapsed_ms"}]，最多保留 20 条
+
+    def arm(self, count, top_n=None):
+        """让接下来的 count 个请求都被分析（count 为 0 即取消）"""
+        with self._lock:
+            self._armed = max(0, int(count))
+            if top_n:
+                self.top_n = int(top_n)
+
+    @property
+    def armed(self):
+        return self._armed
+
+    def wants(self, the_request, headers, trusted=False):
+        """
+        本次请求是否需要分析；由 arm() 触发时消耗一次计数
+        :param the_request: 请求JSON
+        :param headers: 请求头（flask.request.headers）
+        :param trusted: 是否接受请求自带的 "profile" / X-Chem-Profile（本机请求或显式打开了远程分析）；
+            否则忽略它们，任意客户端都不能让服务器写出分析文件
+        """
+        if trusted and (the_request.get("profile") or headers.get(self.HEADER, "").lower() in ("1", "true", "yes")):
+            return True
+        with self._lock:
+            if self._armed > 0:
+                self._armed -= 1
+                return True
+        return False
+
+    def run(self, key, func, *args):
+        """
+        在 cProfile 下执行 func(*args)
+        :param key: 请求的 table_type/instruction，用于文件名
+        :return: (func 的返回值, {"prof": .prof 路径, "summary": 摘要路径, "top": 摘要前几行, "elapsed_ms": 耗时})
+        """
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            result = profiler.runcall(func, *args)
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            info = self._write(key, profiler, elapsed_ms)
+        return result, info
+
+    def _write(self, key, profiler, elapsed_ms):
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            self._counter += 1
+            counter = self._counter
+        safe_key = re.sub(r"[^0-9A-Za-z_-]+", "_", key)
+        base = os.path.join(self.directory, f"{time.strftime('%Y%m%d_%H%M%S')}_{safe_key}_{os.getpid()}_{counter}")
+        profiler.dump_stats(base + ".prof")
+
+        buffer = io.StringIO()
+        stats = pstats.Stats(profiler, stream=buffer)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top_n)
+        summary = buffer.getvalue()
+        with open(base + ".txt", "w", encoding="utf-8") as f:
+            f.write(f"{key}: {elapsed_ms:.2f} ms\n")
+            f.write(summary)
+
+        # 摘要中函数表的前几行随响应返回，便于不登录服务器也能快速查看
+        lines = summary.splitlines()
+        table_start = next((i for i, line in enumerate(lines) if line.lstrip().startswith("ncalls")), len(lines))
+        info = {"prof": os.path.abspath(base + ".prof"), "summary": os.path.abspath(base + ".txt"),
+                "elapsed_ms": elapsed_ms, "top": [line for line in lines[table_start:table_start + 11] if line.strip()]}
+        with self._lock:
+            self.recent.append({"key": key, "prof": info["prof"], "summary": info["summary"], "elapsed_ms": elapsed_ms})
+            del self.recent[:-20]
+        logger.info("profiled %s in %.2f ms: %s", key, elapsed_ms, info["prof"])
+        return info
@@ -0,0 +1,99 @@
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    渲染结果缓存：键为 (实验uid, 种类, 版本, 其余区分项)，值为渲染好的二维表格或 json_config_composer 的输出，按LRU淘汰
+    Experiment.version 在每次修改时递增，键中带版本即不会取到过期内容，不需要主动失效；
+    同一实验同一种类放入新版本时，只保留最近 keep_versions 个版本（旧版本只用于给还停留在该版本的客户端计算 delta，见 table_delta.py）
+    多线程读请求可同时访问，内部有一把锁；缓存的值由调用方当作只读使用
+    """
+
+    def __init__(self, maxsize=64, keep_versions=1):
+        """
+        :param maxsize: 最多保留的条目数，为 0 时不缓存
+        :param keep_versions: 同一实验同一种类最多保留的版本数（含最新版本）
+        """
+        self.maxsize = maxsize
+        self.keep_versions = max(1, keep_versions)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # 每次启动不同：重启后实验的 uid/版本 从头计数，旧进程发出的 ETag 不会被误认为有效
+        self.boot_token = uuid.uuid4().hex[:8]
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        uid, kind, version = key[:3]
+        with self._lock:
+            older = sorted({k[2] for k in self._entries if k[0] == uid and k[1] == kind and k[2] < version})
+            stale = set(older[:max(0, len(older) - self.keep_versions + 1)])
+            if stale:
+                for old_key in [k for k in self._entries if k[0] == uid and k[1] == kind and k[2] in stale]:
+                    del self._entries[old_key]
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_build(self, key, build):
+        """
+        命中则返回缓存值，否则调用 build() 生成并放入缓存（生成过程不持有缓存的锁，并发时可能重复生成，结果相同）
+        :param key: (实验uid, 种类, 版本, ...)
+        :param build: 无参函数
+        """
+        value = self.get(key)
+        if value is None:
+            value = build()
+            self.put(key, value)
+        return value
+
+    def etag(self, uid, kind, version, *extra):
+        """
+        ETag 的值（不含引号与 W/ 前缀，以弱 ETag 发出）：同一实验、同一种类、同一版本且 extra 相同时表格内容相同，
+        响应中回显的请求字段不参与比较
+        :param extra: 其余区分项，如 rootId、表头中的实验名字（不限于ASCII，取其 crc32）
+        """
+        digest = zlib.crc32("\x00".join(str(item) for item in extra).encode("utf-8"))
+        return f"{self.boot_token}-{uid}-{kind}-{version}-{digest:08x}"
+
+    def version_token(self, uid, version):
+        """发给客户端的表格版本，客户端之后在请求的 table_versions 中原样带回"""
+        return f"{self.boot_token}-{uid}-{version}"
+
+    def get_version(self, token, uid, kind):
+        """
+        客户端带回的版本 token 对应的缓存值
+        :return: 缓存值；token 不是本进程为该实验发出的、或该版本已被淘汰时返回 None
+        """
+        try:
+            boot_token, token_uid, version = str(token).split("-")
+            if boot_token != self.boot_token or int(token_uid) != uid:
+                return None
+            version = int(version)
+        except ValueError:
+            return None
+        return self.get((uid, kind, version))
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "maxsize": self.maxsize, "keep_versions": self.keep_versions, "hits": self.hits, "misses": self.misses}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
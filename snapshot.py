@@ -0,0 +1,232 @@
+import json
+import numpy as np
+from array import array
+from compact import CompactMap
+
+# 快照文件是一个 .npy 文件，内容为一维 uint8 数组：
+#   [0, 8)                 MAGIC
+#   [8, 8 + 16*len(FIELDS)) 目录，每个字段一对 int64 (起始字节, 字节数)，顺序与 FIELDS 相同
+#   之后依次是各字段的数据，每个字段的起始位置按8字节对齐
+# 读取时用 np.load(mmap_mode="r") 映射整个文件，各字段是映射上的视图（.view(dtype)），不复制、不解析文本
+# 名字列表存为以 "\x00" 连接的 UTF-8 字节串，一次 decode + split 还原
+MAGIC = b"CHEMSNP1"
+
+FIELDS = [
+    ("meta", np.uint8),                  # 实验名、table_id、date、conc_engine、recompute_mode，以"\x00"连接
+    ("trial_names", np.uint8),           # 先是 sample_dict 中的 n 个trial，之后是只出现在 composite/master 中的名字
+    ("trial_ids", np.uint8),             # n 个trial的id
+    ("substance_names", np.uint8),
+    ("substance_dict_names", np.uint8),  # substance_dict 的键
+    ("stock", np.uint8),
+    ("solvent", np.uint8),
+    ("dirty", np.uint8),
+    ("total_amount", np.float64),
+    ("existing_amount", np.float64),
+    ("composite_row", np.int64),         # composite 的 COO：composite_row 的试样使用了 composite_col 的试样 composite_vol 的量
+    ("composite_col", np.int64),
+    ("composite_vol", np.float64),
+    ("master_row", np.int64),            # master 的 COO：master_row 的试样被 master_col 的试样使用了 master_vol 的量
+    ("master_col", np.int64),
+    ("master_vol", np.float64),
+    ("conc_row", np.int64),              # 浓度矩阵（trial×物质）的 COO
+    ("conc_col", np.int64),
+    ("conc_val", np.float64),
+    ("json_extra", np.uint8),            # 很少用到的非数值数据：extra_info 与非空的 trial.info，JSON
+]
+
+
+def _join_names(names):
+    for name in names:
+        if "\x00" in name:
+            raise ValueError(f"名字中不能包含\\x00: {name!r}")
+    return np.frombuffer("\x00".join(names).encode("utf-8"), dtype=np.uint8)
+
+
+def _table_lookup(table, known):
+    """驻留表 id -> 快照下标 的换算数组，只填已知的名字，其余为 -1（改名/删除后残留在表中的名字）"""
+    lookup = np.full(len(table), -1, dtype=np.int64)
+    for name, index in known.items():
+        name_id = table.lookup(name)
+        if name_id is not None:
+            lookup[name_id] = index
+    return lookup
+
+
+def _map_coo(trial_list, attr, index_of, table, lookup):
+    """
+    把每个trial的某个 CompactMap（composite/master/substance_conc）合并为 COO 三元组
+    :param index_of: 名字 -> 快照中的下标（没有则追加），用于普通 dict 以及 lookup 中为 -1 的名字
+    :param table: 实验的驻留表，lookup 为其 id -> 快照下标 的换算数组（原地补全）
+    """
+    raws, rows = [], []
+    slow_rows, slow_cols, slow_vals = [], [], []
+    for i, the_trial in enumerate(trial_list):
+        the_map = getattr(the_trial, attr)
+        if isinstance(the_map, CompactMap) and the_map.table is table:
+            raw = the_map.raw()
+            if raw is not None:
+                raws.append(raw)
+                rows.append(i)
+        else:
+            for key, value in the_map.items():
+                slow_rows.append(i)
+                slow_cols.append(index_of(key))
+                slow_vals.append(value)
+
+    row_parts, col_parts, val_parts = [], [], []
+    if raws:
+        lengths = np.fromiter(map(len, raws), dtype=np.int64, count=len(raws)) // 2
+        data = np.frombuffer(b"".join(raws), dtype=np.float64)
+        # 每段前半为id、后半为值
+        starts = np.repeat(np.cumsum(2 * lengths) - 2 * lengths, 2 * lengths)
+        within = np.arange(data.size) - starts
+        is_id = within < np.repeat(lengths, 2 * lengths)
+        ids = data[is_id].astype(np.int64)
+        unknown = np.unique(ids[lookup[ids] < 0])
+        for name_id in unknown.tolist():
+            lookup[name_id] = index_of(table.name(name_id))
+        cols = lookup[ids]
+        row_parts.append(np.repeat(np.asarray(rows, dtype=np.int64), lengths))
+        col_parts.append(cols)
+        val_parts.append(data[~is_id])
+    if slow_rows:
+        row_parts.append(np.asarray(slow_rows, dtype=np.int64))
+        col_parts.append(np.asarray(slow_cols, dtype=np.int64))
+        val_parts.append(np.asarray(slow_vals, dtype=np.float64))
+    if not row_parts:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.float64)
+    row = np.concatenate(row_parts)
+    order = np.argsort(row, kind="stable")
+    return row[order], np.concatenate(col_parts)[order], np.concatenate(val_parts)[order]
+
+
+def composite_coo(exp):
+    """
+    实验当前全部 composite 的 COO 三元组（与快照中 composite_row/col/vol 的做法相同，直接拼接 CompactMap 的数组，不逐个条目访问）
+    :return: (行, 列, 用量)，下标为 sample_dict 中的顺序；指向不在 sample_dict 中的组分的条目已去掉
+    """
+    trial_list = [entry[1] for entry in exp.sample_dict.values()]
+    trial_index = {name: i for i, name in enumerate(exp.sample_dict)}
+    trial_table = exp.trial_name_table
+    row, col, vol = _map_coo(trial_list, "composite", lambda name: trial_index.get(name, -1), trial_table,
+                             _table_lookup(trial_table, trial_index))
+    keep = col >= 0
+    return row[keep], col[keep], vol[keep]
+
+
+def write_snapshot(exp, path):
+    """
+    把一个 Experiment 写成单个二进制快照文件（格式见本模块开头）
+    :param exp: Experiment
+    :param path: 文件路径，建议以 .npy 结尾（np.lib.format 会原样使用给定路径）
+    :return: 写入的字节数
+    """
+    trial_names = list(exp.sample_dict.keys())
+    trial_list = [exp.sample_dict[name][1] for name in trial_names]
+    trial_index = {name: i for i, name in enumerate(trial_names)}
+
+    def trial_index_of(name):
+        if name not in trial_index:
+            trial_index[name] = len(trial_names)
+            trial_names.append(name)
+        return trial_index[name]
+
+    substance_names = []
+    substance_index = {}
+
+    def substance_index_of(name):
+        if name not in substance_index:
+            substance_index[name] = len(substance_names)
+            substance_names.append(name)
+        return substance_index[name]
+
+    trial_table, substance_table = exp.trial_name_table, exp.substance_name_table
+    trial_lookup = _table_lookup(trial_table, trial_index)
+    substance_lookup = _table_lookup(substance_table, {})
+    composite = _map_coo(trial_list, "composite", trial_index_of, trial_table, trial_lookup)
+    master = _map_coo(trial_list, "master", trial_index_of, trial_table, trial_lookup)
+    conc = _map_coo(trial_list, "substance_conc", substance_index_of, substance_table, substance_lookup)
+
+    n = len(trial_list)
+    extra_info = {key: value for key, value in exp.extra_info.items() if key != "substance_trial_dict"}
+    infos = {str(i): the_trial.info for i, the_trial in enumerate(trial_list) if the_trial._info}
+    meta = [exp.name, exp.table_id or "", exp.date or "", exp.conc_engine, exp.recompute_mode]
+    values = {
+        "meta": _join_names([str(item) for item in meta]),
+        "trial_names": _join_names(trial_names),
+        "trial_ids": _join_names([str(the_trial.id) for the_trial in trial_list]),
+        "substance_names": _join_names(substance_names),
+        "substance_dict_names": _join_names(list(exp.substance_dict.keys())),
+        "stock": np.fromiter((the_trial.stock for the_trial in trial_list), dtype=np.uint8, count=n),
+        "solvent": np.fromiter((the_trial.solvent for the_trial in trial_list), dtype=np.uint8, count=n),
+        "dirty": np.fromiter((name in exp.dirty_trials for name in trial_names[:n]), dtype=np.uint8, count=n),
+        "total_amount": np.fromiter((the_trial.total_amount for the_trial in trial_list), dtype=np.float64, count=n),
+        "existing_amount": np.fromiter((the_trial.existing_amount for the_trial in trial_list), dtype=np.float64, count=n),
+        "composite_row": composite[0], "composite_col": composite[1], "composite_vol": composite[2],
+        "master_row": master[0], "master_col": master[1], "master_vol": master[2],
+        "conc_row": conc[0], "conc_col": conc[1], "conc_val": conc[2],
+        "json_extra": np.frombuffer(json.dumps({"extra_info": extra_info, "info": infos}).encode("utf-8"), dtype=np.uint8),
+    }
+
+    directory = np.zeros(2 * len(FIELDS), dtype=np.int64)
+    offset = len(MAGIC) + directory.nbytes
+    for k, (field, dtype) in enumerate(FIELDS):
+        offset = (offset + 7) // 8 * 8
+        nbytes = values[field].astype(dtype, copy=False).nbytes
+        directory[2 * k], directory[2 * k + 1] = offset, nbytes
+        offset += nbytes
+
+    blob = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=(offset,))
+    blob[:len(MAGIC)] = np.frombuffer(MAGIC, dtype=np.uint8)
+    blob[len(MAGIC):len(MAGIC) + directory.nbytes] = directory.view(np.uint8)
+    for k, (field, dtype) in enumerate(FIELDS):
+        start, nbytes = directory[2 * k], directory[2 * k + 1]
+        blob[start:start + nbytes] = np.ascontiguousarray(values[field], dtype=dtype).view(np.uint8)
+    blob.flush()
+    del blob
+    return int(offset)
+
+
+def read_snapshot(path):
+    """
+    以内存映射方式打开快照，只读取目录，不复制任何数组
+    :return: {字段名: 映射上的只读视图}
+    """
+    blob = np.load(path, mmap_mode="r")
+    if blob.dtype != np.uint8 or blob[:len(MAGIC)].tobytes() != MAGIC:
+        raise ValueError(f"{path} 不是实验快照文件")
+    directory = blob[len(MAGIC):len(MAGIC) + 16 * len(FIELDS)].view(np.int64)
+    fields = {}
+    for k, (field, dtype) in enumerate(FIELDS):
+        start, nbytes = int(directory[2 * k]), int(directory[2 * k + 1])
+        fields[field] = blob[start:start + nbytes].view(dtype)
+    return fields
+
+
+def split_names(field, count=0):
+    """
+    还原以"\x00"连接的名字列表
+    :param count: 已知的名字个数，用于区分空列表与只含一个空字符串的列表
+    """
+    if field.size == 0:
+        return [""] * count
+    return field.tobytes().decode("utf-8").split("\x00")
+
+
+def grouped_raw_arrays(n, row, col, val):
+    """
+    把按行排好序的 COO 转为每行一个 CompactMap 底层数组（[k0, k1, ..., v0, v1, ...]），没有条目的行为 None
+    整体用numpy排好一个缓冲区，再按行切片
+    """
+    counts = np.bincount(row, minlength=n) if row.size else np.zeros(n, dtype=np.int64)
+    ptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(counts, out=ptr[1:])
+    # 每行的输出区间为 [2*ptr[i], 2*ptr[i+1])：前半 col（id），后半 val
+    buffer = np.empty(2 * row.size, dtype=np.float64)
+    within = np.arange(row.size) - ptr[row]
+    buffer[2 * ptr[row] + within] = col
+    buffer[2 * ptr[row] + counts[row] + within] = val
+    big = array("d")
+    big.frombytes(buffer.tobytes())
+    bounds = (2 * ptr).tolist()
+    return [big[start:end] if end > start else None for start, end in zip(bounds[:-1], bounds[1:])]
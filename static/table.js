@@ -259,6 +259,45 @@ class EditableTable {
         }
     }
 
+    // 应用后端发来的 delta（见 table_delta.py）：行、列按名字（第一列、第一行）对应，
+    // 先按新的行列顺序排好已有内容，再写入变化的单元格；表格尺寸只在末尾增删，且只改写内容不同的单元格
+    applyDelta(delta) {
+        const current = this.extractContents();
+        const header = current.length ? current[0] : [""];
+        const columns = delta.columns || header.slice(1);
+        const rowNames = delta.rows || current.slice(1).map(row => row[0]);
+        const oldColumnIndex = new Map(header.map((name, j) => [name, j]).slice(1));
+        const oldRows = new Map(current.slice(1).map(row => [row[0], row]));
+
+        const next = [["", ...columns]];
+        for (const rowName of rowNames) {
+            const oldRow = oldRows.get(rowName);
+            next.push([rowName, ...columns.map(name =>
+                (oldRow && oldColumnIndex.has(name)) ? oldRow[oldColumnIndex.get(name)] : "")]);
+        }
+        const rowIndex = new Map(rowNames.map((name, i) => [name, i + 1]));
+        const columnIndex = new Map(columns.map((name, j) => [name, j + 1]));
+        for (const [rowName, columnName, value] of delta.cells) {
+            if (rowIndex.has(rowName) && columnIndex.has(columnName)) {
+                next[rowIndex.get(rowName)][columnIndex.get(columnName)] = value;
+            }
+        }
+
+        while (this.rows > next.length) this.removeRow();
+        while (this.cols > next[0].length) this.removeColumn();
+        while (this.rows < next.length) this.addRow();
+        while (this.cols < next[0].length) this.addColumn();
+        for (let i = 0; i < next.length; i++) {
+            for (let j = 0; j < next[i].length; j++) {
+                const value = next[i][j] === null || next[i][j] === undefined ? "" : String(next[i][j]);
+                const before = (i < current.length && j < current[i].length) ? current[i][j] : null;
+                if (before !== value) {
+                    this.editCell(i, j, value);
+                }
+            }
+        }
+    }
+
     // 提取所有EditableCell中的内容并形成二维数组
     extractContents() {
         const contents = [];
@@ -572,6 +611,20 @@ class Chem_Operator {
     //存储id字符串：{表格实例，headers字典}以取消和提交时使用，用来绑定对应的experiments{}
     table_map = {};
 
+    // 表格请求（exp_table/conc_table）的响应缓存："rootId|table_type|instruction"：{etag, 响应JSON}
+    // 再次请求时带上 If-None-Match，后端返回 304 说明实验没有变化，直接用缓存的响应重建表格
+    responseCache = {};
+
+    // 窗口表格（分页浏览大实验，config.window）的翻页控件：表格id：控件容器
+    tablePagers = {};
+
+    // 表格响应优先使用 base64 列式格式（见后端 table_wire.py），后端不支持时为普通 JSON
+    static ACCEPT = 'application/vnd.chem-table.columnar.base64+json, application/json;q=0.9';
+
+    // 窗口表格每页的行数、列数
+    static WINDOW_ROWS = 100;
+    static WINDOW_COLUMNS = 50;
+
     created_table = 0;
 
     constructor() {
@@ -600,7 +653,8 @@ class Chem_Operator {
                 const tableConfig = this.tableFeatures[tableId];
                 // 这里需要根据实际情况判断表格是否匹配
                 // 例如，检查配置中的table_type或其他唯一标识
-                return tableConfig && tableConfig.table_type === config.table_type;
+                // 窗口表格与完整表格分开显示，互不替换
+                return tableConfig && tableConfig.table_type === config.table_type && !tableConfig.window === !config.window;
             });
             
             if (matchingTableId) {
@@ -626,17 +680,25 @@ class Chem_Operator {
                         }
                     }
 
-                    // 更新表格内容
-                    if (config.tableArray && Array.isArray(config.tableArray)) {
+                    // 更新表格内容：delta 响应只含变化的单元格，在原表格上修改
+                    if (config.delta) {
+                        table.applyDelta(config.delta);
+                    } else if (config.tableArray && Array.isArray(config.tableArray)) {
                         EditableTable.from2DArray(config.tableArray, table);
                     }  
+                    if (config.window) {
+                        this.renderWindowPager(matchingTableId, rootId, config, targetDivId);
+                    }
 
                     return table;
                 }
             }
         }
 
-        // 如果没有找到对应的表格，则创建新表格
+        // 如果没有找到对应的表格，则创建新表格（delta 只会发给已有该类型表格的客户端）
+        if (config.delta) {
+            throw new Error(`收到 ${config.table_type} 表格的 delta，但没有可应用的表格`);
+        }
         const this_table_id = this.add_table_count();
         
         // 更新实验到表格的映射
@@ -704,6 +766,12 @@ class Chem_Operator {
         // 组装所有元素到主容器
         tableContainer.appendChild(headerContainer);
         tableContainer.appendChild(contentContainer);
+        if (config.window) {
+            const pagerContainer = document.createElement('div');
+            pagerContainer.className = 'table-pager-container';
+            tableContainer.appendChild(pagerContainer);
+            this.tablePagers[this_table_id] = pagerContainer;
+        }
         tableContainer.appendChild(buttonContainer);
         
         console.log("config:", config);
@@ -725,6 +793,9 @@ class Chem_Operator {
 
         // 添加事件监听器
         this.addEventListeners(rootId, buttonMap, sending_config, targetDivId, this_table_id);
+        if (config.window) {
+            this.renderWindowPager(this_table_id, rootId, config, targetDivId);
+        }
 
         return table;
     }
@@ -744,6 +815,13 @@ class Chem_Operator {
             { id: 'exp_table', text: '生成实验表格', enabled: config.buttons.exp_table },
             { id: 'conc_table', text: '浓度表格', enabled: config.buttons.conc_table },
             { id: 'substance_table', text: '物质表格', enabled: config.buttons.substance_table },
+            { id: 'plate_table', text: '整板配方', enabled: config.buttons.plate_table },
+            { id: 'conc_window', text: '分页浓度表格', enabled: config.buttons.window },
+            { id: 'exp_window', text: '分页实验表格', enabled: config.buttons.window },
+            { id: 'export_csv', text: '导出CSV', enabled: config.buttons.export },
+            { id: 'export_xlsx', text: '导出XLSX', enabled: config.buttons.export },
+            { id: 'import_stock', text: '导入stock文件', enabled: config.buttons.import },
+            { id: 'import_recipe', text: '导入配方文件', enabled: config.buttons.import },
         ];
 
         buttonDefinitions.forEach(({ id, text, enabled }) => {
@@ -871,7 +949,44 @@ class Chem_Operator {
                 const { expName } = this.table_map[this_table_id];
                 this.sendTableDataToFlask(expName, rootId, { ... sending_config, instruction : "substance_table"}, targetDivId, this_table_id);
             });
+        }
+        if (buttonMap.plate_table) {
+            buttonMap.plate_table.addEventListener('click', () => {
+                const { expName } = this.table_map[this_table_id];
+                this.sendTableDataToFlask(expName, rootId, { ... sending_config, instruction : "plate_table"}, targetDivId, this_table_id);
+            });
         }        
+        // 分页浏览：只请求第一页的行列，之后由翻页控件请求其他窗口
+        for (const tableType of ['conc', 'exp']) {
+            const button = buttonMap[`${tableType}_window`];
+            if (button) {
+                button.addEventListener('click', () => {
+                    const headers = this.table_map[this_table_id].headers;
+                    const expName = headers['Experiment name'] ? headers['Experiment name'].getCurrentContent() : this.table_map[this_table_id].expName;
+                    this.fetchTableWindow(expName, rootId, tableType,
+                        { rows: [0, Chem_Operator.WINDOW_ROWS], columns: [0, Chem_Operator.WINDOW_COLUMNS] }, targetDivId);
+                });
+            }
+        }
+        // 导出：后端按实验当前状态生成文件，浏览器直接下载
+        for (const format of ['csv', 'xlsx']) {
+            const button = buttonMap[`export_${format}`];
+            if (button) {
+                button.addEventListener('click', () => {
+                    window.location.href = `/export/${sending_config.table_type}?rootId=${encodeURIComponent(rootId)}&format=${format}`;
+                });
+            }
+        }
+        // 导入：选择 CSV/XLSX 文件上传，完成后刷新本实验的 exp 表格
+        for (const kind of ['stock', 'recipe']) {
+            const button = buttonMap[`import_${kind}`];
+            if (button) {
+                button.addEventListener('click', () => {
+                    const { expName } = this.table_map[this_table_id];
+                    this.importTableFile(kind, expName, rootId, targetDivId, this_table_id);
+                });
+            }
+        }
         // 取消
         if (buttonMap.cancel) {
             buttonMap.cancel.addEventListener('click', () => {
@@ -895,6 +1010,233 @@ class Chem_Operator {
         }
     }
 
+    // 上传 stock/配方 文件（/import/<kind>），报告出错的行，再请求最新的 exp 表格
+    importTableFile(kind, expName, rootId, targetDivId, this_table_id) {
+        const input = document.createElement('input');
+        input.type = 'file';
+        input.accept = '.csv,.xlsx';
+        input.addEventListener('change', async () => {
+            if (!input.files.length) {
+                return;
+            }
+            const headers = this.table_map[this_table_id].headers;
+            const formData = new FormData();
+            formData.append('file', input.files[0]);
+            formData.append('rootId', rootId);
+            formData.append('exp_name', headers['Experiment name'] ? headers['Experiment name'].getCurrentContent() : expName);
+            try {
+                const response = await fetch(`/import/${kind}`, { method: 'POST', body: formData });
+                const result = await response.json();
+                if (result.error) {
+                    throw new Error(result.error);
+                }
+                let message = `导入 ${result.imported} 行（新增 ${result.added}，修改 ${result.modified}），出错 ${result.errors} 行`;
+                for (const detail of result.error_details.slice(0, 20)) {
+                    message += `\n第 ${detail.row} 行 ${detail.name}: ${detail.error}`;
+                }
+                alert(message);
+                await this.sendTableDataToFlask(expName, rootId, { table_type: 'exp', instruction: 'exp_table' }, targetDivId, this_table_id);
+            } catch (error) {
+                console.error('导入文件时出错：', error);
+                alert(`导入失败：${error.message}`);
+            }
+        });
+        input.click();
+    }
+
+    // 请求 conc/exp 表格的一个窗口（行列范围、排序、筛选，见后端 table_window.normalize_window）
+    async fetchTableWindow(expName, rootId, tableType, tableWindow, targetDivId) {
+        try {
+            const response = await fetch(`/config_acceptor`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json', 'Accept': Chem_Operator.ACCEPT },
+                body: JSON.stringify({
+                    exp_name: expName,
+                    rootId: rootId,
+                    config: { table_type: 'exp', instruction: `${tableType}_table` },
+                    header_cell_content: { 'Experiment name': expName },
+                    window: tableWindow
+                })
+            });
+            const json_response = await response.json();
+            return this.handle_response(json_response, targetDivId);
+        } catch (error) {
+            console.error('请求表格窗口时出错：', error);
+            return { status: 'error', message: error.message };
+        }
+    }
+
+    // 窗口表格的翻页控件：行、列的上一页/下一页，按列排序，按行名或列的数值范围筛选
+    renderWindowPager(this_table_id, rootId, config, targetDivId) {
+        const pager = this.tablePagers[this_table_id];
+        if (!pager) {
+            return;
+        }
+        const info = config.window;
+        const expName = config.headerContents[0];
+        const tableType = config.table_type;
+        const rowSize = Chem_Operator.WINDOW_ROWS;
+        const columnSize = Chem_Operator.WINDOW_COLUMNS;
+        const request = (rows, columns, sort, filter) => {
+            this.fetchTableWindow(expName, rootId, tableType, { rows, columns, sort, filter }, targetDivId);
+        };
+        pager.innerHTML = '';
+
+        const status = document.createElement('span');
+        status.textContent = `行 ${info.rows[0] + 1}–${info.rows[1]} / ${info.total_rows}` +
+            (info.total_rows !== info.unfiltered_rows ? `（筛选自 ${info.unfiltered_rows}）` : '') +
+            `，列 ${info.columns[0] + 1}–${info.columns[1]} / ${info.total_columns}`;
+        pager.appendChild(status);
+
+        const moves = [
+            { text: '上一页', enabled: info.rows[0] > 0, rows: Math.max(0, info.rows[0] - rowSize), columns: info.columns[0] },
+            { text: '下一页', enabled: info.rows[1] < info.total_rows, rows: info.rows[1], columns: info.columns[0] },
+            { text: '左移列', enabled: info.columns[0] > 0, rows: info.rows[0], columns: Math.max(0, info.columns[0] - columnSize) },
+            { text: '右移列', enabled: info.columns[1] < info.total_columns, rows: info.rows[0], columns: info.columns[1] },
+        ];
+        for (const move of moves) {
+            const button = document.createElement('button');
+            button.textContent = move.text;
+            button.className = 'table-action-button';
+            button.disabled = !move.enabled;
+            button.addEventListener('click', () => {
+                request([move.rows, move.rows + rowSize], [move.columns, move.columns + columnSize], info.sort, info.filter);
+            });
+            pager.appendChild(button);
+        }
+
+        // 排序与筛选：改变后回到第一页
+        const inputs = {};
+        const fields = [
+            { key: 'sortColumn', placeholder: '排序列（空为行名）', value: info.sort ? info.sort.column : '' },
+            { key: 'name', placeholder: '行名包含', value: info.filter ? info.filter.name : '' },
+            { key: 'column', placeholder: '筛选列', value: info.filter ? info.filter.column : '' },
+            { key: 'min', placeholder: '下限', value: info.filter && info.filter.min !== null ? info.filter.min : '' },
+            { key: 'max', placeholder: '上限', value: info.filter && info.filter.max !== null ? info.filter.max : '' },
+        ];
+        for (const { key, placeholder, value } of fields) {
+            const input = document.createElement('input');
+            input.placeholder = placeholder;
+            input.value = value;
+            input.size = 10;
+            inputs[key] = input;
+            pager.appendChild(input);
+        }
+        const descending = document.createElement('input');
+        descending.type = 'checkbox';
+        descending.checked = info.sort ? info.sort.descending : false;
+        const descendingLabel = document.createElement('label');
+        descendingLabel.appendChild(descending);
+        descendingLabel.appendChild(document.createTextNode('降序'));
+        pager.appendChild(descendingLabel);
+
+        const apply = document.createElement('button');
+        apply.textContent = '应用';
+        apply.className = 'table-action-button';
+        apply.addEventListener('click', () => {
+            const sort = inputs.sortColumn.value || descending.checked
+                ? { column: inputs.sortColumn.value, descending: descending.checked } : null;
+            const filter = { name: inputs.name.value, column: inputs.column.value, min: inputs.min.value, max: inputs.max.value };
+            request([0, rowSize], [info.columns[0], info.columns[0] + columnSize], sort, filter);
+        });
+        pager.appendChild(apply);
+    }
+
+    static base64ToBytes(text) {
+        const binary = atob(text);
+        const bytes = new Uint8Array(binary.length);
+        for (let i = 0; i < binary.length; i++) {
+            bytes[i] = binary.charCodeAt(i);
+        }
+        return bytes;
+    }
+
+    static bytesToBase64(bytes) {
+        let binary = '';
+        for (let i = 0; i < bytes.length; i += 0x8000) {
+            binary += String.fromCharCode.apply(null, bytes.subarray(i, i + 0x8000));
+        }
+        return btoa(binary);
+    }
+
+    // 列式表格（columns、rows、shape、layout，values/indices 为 JSON 列表或 base64 的小端 float64/int32）还原为带表头的二维数组，空单元格为 ''
+    static decodeColumnar(columnar) {
+        const [rowCount, columnCount] = columnar.shape;
+        const base64 = columnar.encoding === 'base64';
+        const values = base64 ? new Float64Array(Chem_Operator.base64ToBytes(columnar.values).buffer) : columnar.values;
+        const table = [[''].concat(columnar.columns)];
+        for (let i = 0; i < rowCount; i++) {
+            const row = new Array(columnCount + 1).fill('');
+            row[0] = columnar.rows[i];
+            table.push(row);
+        }
+        const setCell = (index, value) => {
+            if (value !== null && !Number.isNaN(value)) {
+                table[Math.floor(index / columnCount) + 1][index % columnCount + 1] = value;
+            }
+        };
+        if (columnar.layout === 'sparse') {
+            const indices = base64 ? new Int32Array(Chem_Operator.base64ToBytes(columnar.indices).buffer) : columnar.indices;
+            for (let k = 0; k < indices.length; k++) {
+                setCell(indices[k], values[k]);
+            }
+        } else {
+            for (let k = 0; k < values.length; k++) {
+                setCell(k, values[k]);
+            }
+        }
+        return table;
+    }
+
+    // 提交的表格（带表头的二维数组）若除表头、行名外都是数字或空，编码为稀疏的 base64 列式表格，否则返回 null（仍发送二维数组）
+    static encodeColumnar(tableData) {
+        if (!Array.isArray(tableData) || tableData.length === 0) {
+            return null;
+        }
+        const columns = tableData[0].slice(1);
+        const indices = [];
+        const values = [];
+        for (let i = 1; i < tableData.length; i++) {
+            const row = tableData[i];
+            if (row.length !== columns.length + 1) {
+                return null;
+            }
+            for (let j = 1; j < row.length; j++) {
+                const cell = row[j] === null || row[j] === undefined ? '' : String(row[j]).trim();
+                if (cell === '') {
+                    continue;
+                }
+                const value = Number(cell);
+                if (!Number.isFinite(value)) {
+                    return null;
+                }
+                indices.push((i - 1) * columns.length + (j - 1));
+                values.push(value);
+            }
+        }
+        return {
+            columns: columns,
+            rows: tableData.slice(1).map(row => row[0]),
+            shape: [tableData.length - 1, columns.length],
+            layout: 'sparse',
+            encoding: 'base64',
+            values: Chem_Operator.bytesToBase64(new Uint8Array(new Float64Array(values).buffer)),
+            indices: Chem_Operator.bytesToBase64(new Uint8Array(new Int32Array(indices).buffer)),
+        };
+    }
+
+    // 该实验已显示的各类型表格的 table_version：{table_type: table_version}，后端据此只返回变化的单元格（delta）
+    tableVersions(rootId) {
+        const versions = {};
+        for (const tableId of this.experiments[rootId] || []) {
+            const features = this.tableFeatures[tableId];
+            if (features && features.table_version && !(features.table_type in versions)) {
+                versions[features.table_type] = features.table_version;
+            }
+        }
+        return versions;
+    }
+
     // 向 Flask 后端发送表格数据
     async sendTableDataToFlask(expName, rootId, sending_config, targetDivId, this_table_id) {
         const exp = this.table_map[this_table_id];
@@ -913,21 +1255,32 @@ class Chem_Operator {
 
             console.log(headerCells);
 
+            const cacheKey = `${rootId}|${sending_config.table_type}|${sending_config.instruction}`;
+            const cached = this.responseCache[cacheKey];
+            const requestHeaders = { 'Content-Type': 'application/json', 'Accept': Chem_Operator.ACCEPT };
+            if (cached) {
+                requestHeaders['If-None-Match'] = cached.etag;
+            }
+
             try {
                 const response = await fetch(`/config_acceptor`, {
                     method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
+                    headers: requestHeaders,
                     body: JSON.stringify({
                         exp_name: expName,
                         rootId: rootId,
                         config : sending_config,
-                        table_content: tableData,
-                        header_cell_content: headerCells
+                        table_content: Chem_Operator.encodeColumnar(tableData) || tableData,
+                        header_cell_content: headerCells,
+                        table_versions: this.tableVersions(rootId)
                     })
                 });
 
+                // 实验未变化，沿用上次的表格
+                if (response.status === 304 && cached) {
+                    return this.handle_response(cached.json, targetDivId);
+                }
+
                 // 检查 HTTP 状态码
                 if (!response.ok) {
                     throw new Error(`HTTP error! Status: ${response.status}`);
@@ -936,6 +1289,11 @@ class Chem_Operator {
                 // 解析响应为 JSON
                 const json_response = await response.json();
                 console.log(json_response); // 打印解析后的 JSON 数据
+                // delta 响应依赖发送时的 table_versions，不能在 304 时重放（后端也不会给它 ETag）
+                const etag = response.headers.get('ETag');
+                if (etag && !(json_response.config && json_response.config.delta)) {
+                    this.responseCache[cacheKey] = { etag: etag, json: json_response };
+                }
                 return this.handle_response(json_response, targetDivId); // 传递解析后的 JSON 数据
                 
             } catch (error) {
@@ -951,7 +1309,17 @@ class Chem_Operator {
             console.error('服务器返回错误:', json_response.error);
             return { status: 'error', message: json_response.error };
         }
-        
+
+        // 有限量的试样不够用：服务器没有做任何修改，列出超量的试样
+        if (json_response.inventory_errors) {
+            let message = '用量超出库存，未做修改：';
+            for (const item of json_response.inventory_errors.slice(0, 20)) {
+                message += `\n${item.trial}: 可用 ${item.available}，需要 ${item.draw}（从 ${item.first_trial} 起超出）`;
+            }
+            alert(message);
+            return { status: 'error', message: json_response.message };
+        }
+
         // 检查响应状态
         if (json_response.status) {
             console.log('表格更新成功:', json_response.message || '');
@@ -962,6 +1330,11 @@ class Chem_Operator {
         else if (json_response.expName && json_response.rootId && json_response.config) {
             // 处理表格配置响应
             const { expName, rootId, config } = json_response;
+            // 列式表格还原为二维数组（就地替换，304 时复用的缓存响应不再重复解码）
+            if (config.columnar) {
+                config.tableArray = Chem_Operator.decodeColumnar(config.columnar);
+                delete config.columnar;
+            }
             try {
                 // 根据配置构建并渲染表格
                 this.buildTableFromConfig(expName, rootId, config, targetDivId);
@@ -0,0 +1,58 @@
+from operator import itemgetter
+
+
+def diff_tables(old_table, new_table, max_cells=None):
+    """
+    两张带表头的二维表格（第一行为列名，第一列为行名，见 chem_interface.dict_to_table）之间的单元格级差异
+    行、列都按名字对应，不依赖位置，因此增删行列、改变顺序都可以表示
+
+    :param old_table: 客户端当前持有的表格
+    :param new_table: 现在的表格
+    :param max_cells: 变化的单元格超过此数时放弃（返回 None），由调用方改发整表
+    :return: {"columns": 新的列名（无变化时省略）, "rows": 新的行名（无变化时省略）,
+              "cells": [[行名, 列名, 新值], ...]}，旧表中没有的行列按空字符串比较；
+              表格为空（dict_to_table 对空实验返回 []）时返回 None
+    """
+    if not old_table or not new_table:
+        return None
+    old_columns, new_columns = old_table[0][1:], new_table[0][1:]
+    old_rows = {row[0]: row for row in old_table[1:]}
+    new_rows = [row[0] for row in new_table[1:]]
+    delta = {}
+    if new_columns != old_columns:
+        delta["columns"] = new_columns
+    if new_rows != [row[0] for row in old_table[1:]]:
+        delta["rows"] = new_rows
+
+    # 把旧行按新列的顺序取出（旧表中没有的列取末尾补上的空字符串），整行相等时跳过，只有不等的行才逐格比较
+    if new_columns == old_columns:
+        reorder = None
+    else:
+        column_index = {name: j for j, name in enumerate(old_columns, start=1)}
+        missing = len(old_columns) + 1
+        reorder = [column_index.get(name, missing) for name in new_columns]
+        getter = itemgetter(*reorder) if len(reorder) > 1 else (lambda row: (row[reorder[0]],))
+    empty_row = [""] * len(new_columns)
+
+    cells = []
+    for row in new_table[1:]:
+        old_row = old_rows.get(row[0])
+        if old_row is None:
+            old_values = empty_row
+        elif reorder is None:
+            old_values = old_row[1:]
+        elif not reorder:
+            old_values = []
+        else:
+            old_values = list(getter(old_row + [""]))
+        values = row[1:]
+        if values == old_values:
+            continue
+        row_name = row[0]
+        for column, value, old_value in zip(new_columns, values, old_values):
+            if value != old_value:
+                cells.append([row_name, column, value])
+        if max_cells is not None and len(cells) > max_cells:
+            return None
+    delta["cells"] = cells
+    return delta
@@ -0,0 +1,138 @@
+import csv
+import io
+import os
+import tempfile
+
+from metrics import logger
+
+
+def conc_rows(the_exp):
+    """
+    浓度表的各行（与 chem_interface.Get_conc_table 相同：行为按名字排序的trial，列为按名字排序的全部物质），第一行为表头
+    逐行从 trial.substance_conc 生成，行、列顺序取自实验维护的 trial_rows / substance_columns
+    """
+    substances = the_exp.substance_columns.ordered()
+    column = the_exp.substance_columns.positions(start=1)
+    yield [""] + substances
+    sample_dict = the_exp.sample_dict
+    for trial_name in the_exp.trial_rows.ordered():
+        row = [trial_name] + [""] * len(substances)
+        for substance, conc in sample_dict[trial_name][1].substance_conc.items():
+            row[column[substance]] = conc
+        yield row
+
+
+def exp_rows(the_exp):
+    """
+    exp 表格的各行（与 chem_interface.Get_exp_table 相同：行、列都是 sample_dict 顺序的trial，单元格为 composite 中的用量）
+    """
+    names = list(the_exp.sample_dict)
+    column = {name: j for j, name in enumerate(names, start=1)}
+    yield [""] + names
+    for name in names:
+        row = [name] + [""] * len(names)
+        for comp_name, amount in the_exp.sample_dict[name][1].composite.items():
+            j = column.get(comp_name)
+            if j is not None:
+                row[j] = amount
+        yield row
+
+
+def substance_rows(the_exp):
+    """
+    物质表的各行：每个物质一行，列为含有它（浓度>0）的trial数、最高浓度，以及物质对象（substance.to_dict）的性质
+    substance_dict 中只登记了名字的物质，性质列为空
+    """
+    properties = []
+    for entry in the_exp.substance_dict.values():
+        if hasattr(entry, "to_dict"):
+            for key in entry.to_dict():
+                if key != "Name" and key not in properties:
+                    properties.append(key)
+    yield ["", "Trials", "Max concentration"] + properties
+    for substance_name in sorted(the_exp.substance_dict):
+        trials_of_substance = the_exp.substance_index.get(substance_name, {})
+        entry = the_exp.substance_dict[substance_name]
+        info = entry.to_dict() if hasattr(entry, "to_dict") else {}
+        yield [substance_name, len(trials_of_substance), max(trials_of_substance.values(), default="")] + \
+            ["" if info.get(key) is None else info[key] for key in properties]
+
+
+# 可导出的表格：table_type -> 行生成函数
+TABLE_ROWS = {"conc": conc_rows, "exp": exp_rows, "substance": substance_rows}
+
+
+def iter_csv(rows, chunk_rows=500):
+    """
+    把行逐块编码为 CSV 文本（UTF-8 带 BOM，Excel 可直接识别中文），每 chunk_rows 行产出一次
+    :param rows: 行的可迭代对象
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write("\ufeff")
+    pending = 0
+    for row in rows:
+        writer.writerow(row)
+        pending += 1
+        if pending >= chunk_rows:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def write_csv(rows):
+    """
+    把 iter_csv 的输出写入临时 .csv 文件（持有实验锁时调用，发送留到释放锁之后，慢客户端不会拖住锁）
+    :return: 临时文件路径，由调用方删除（见 iter_file）
+    """
+    fd, path = tempfile.mkstemp(suffix=".csv", prefix="chem_table_export_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in iter_csv(rows):
+                f.write(chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+
+def write_xlsx(rows, title="Sheet"):
+    """
+    用 openpyxl 的 write-only 模式逐行写入临时 .xlsx 文件（行直接写入磁盘，不在内存中保留单元格）
+    :return: 临时文件路径，由调用方删除（见 iter_file）
+    """
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    # 工作表名最长 31 个字符，且不能含 \ / ? * [ ] : 等字符
+    sheet = workbook.create_sheet(title="".join(ch for ch in title if ch not in '\\/?*[]:')[:31] or "Sheet")
+    for row in rows:
+        sheet.append(row)
+    fd, path = tempfile.mkstemp(suffix=".xlsx", prefix="chem_table_export_")
+    os.close(fd)
+    try:
+        workbook.save(path)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+
+def iter_file(path, chunk_size=1 << 16, delete=True):
+    """分块读出文件，读完（或客户端中途断开、生成器被关闭）后删除"""
+    try:
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        if delete:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning("iter_file: 删除临时文件 %s 失败: %s", path, e)
@@ -0,0 +1,273 @@
+import csv
+import io
+
+import inventory
+from metrics import logger
+from topo_order import CycleError
+
+# 导入的两种文件：stock（与 conc 表格同格式：第一行为物质名，每行一个stock及其浓度）
+# 与 recipe（与 exp 表格同格式：第一行为组分名，每行一个试样及各组分的用量，只需包含要导入的行与用到的组分列）
+IMPORT_KINDS = ("stock", "recipe")
+
+
+def iter_csv_rows(stream):
+    """
+    逐行读取上传的 CSV（UTF-8，可带 BOM）
+    :param stream: 二进制文件对象（如 request.files["file"].stream）
+    """
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    try:
+        for row in csv.reader(text):
+            yield row
+    finally:
+        text.detach()
+
+
+def iter_xlsx_rows(stream):
+    """用 openpyxl 的 read-only 模式逐行读取第一个工作表，空单元格为 None"""
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(stream, read_only=True, data_only=True)
+    try:
+        for row in workbook.worksheets[0].iter_rows(values_only=True):
+            yield list(row)
+    finally:
+        workbook.close()
+
+
+def iter_rows(stream, file_format):
+    """
+    :param file_format: "csv" 或 "xlsx"
+    """
+    if file_format == "csv":
+        return iter_csv_rows(stream)
+    if file_format == "xlsx":
+        return iter_xlsx_rows(stream)
+    raise ValueError(f"不支持的文件格式 {file_format}")
+
+
+def _cell_text(value):
+    if value is None:
+        return ""
+    return value.strip() if isinstance(value, str) else value
+
+
+def _parse_amount(value):
+    """单元格的数值；空单元格返回 None，无法转换或为负数时抛出 ValueError"""
+    value = _cell_text(value)
+    if value == "":
+        return None
+    if isinstance(value, bool):
+        raise ValueError(f"{value!r} 不是数字")
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{value!r} 不是数字") from None
+    if number != number or number < 0:
+        raise ValueError(f"{value!r} 不是非负数")
+    return number
+
+
+class RowImporter:
+    """
+    把逐行读到的 stock/配方 校验后按块交给 Experiment 的批量方法（stock_from_2d_array / recipes_from_2d_array）
+    出错的行跳过并记录（行号从 1 开始，含表头），不影响其他行；每块应用前先调用 on_chunk（chem_interface 用它写日志）
+
+    配方行的校验：组分须为实验中已有的试样或文件中更早的行；不能把已有的stock改为配方；
+    给已有试样新增组分时检查不会形成循环（新增组分不能在该试样的下游）；
+    每块应用之前一次检查有限量试样的总用量（inventory.check_submission），使某个试样第一次超量的行记为出错并跳过
+    （以它为组分的后续行一并跳过），直到剩下的行不再超量
+    """
+
+    def __init__(self, the_exp, kind, chunk_rows=1000, max_errors=200, on_chunk=None, id_prefix=""):
+        """
+        :param the_exp: 导入到的实验
+        :param kind: "stock" 或 "recipe"
+        :param chunk_rows: 每块的有效行数
+        :param max_errors: 返回的错误明细最多条数（错误总数另计）
+        :param on_chunk: on_chunk(kind, rows, ids)，每块应用之前调用
+        :param id_prefix: 新试样id的前缀，id 为 前缀 + 行号
+        """
+        if kind not in IMPORT_KINDS:
+            raise ValueError(f"未知的导入类型 {kind}")
+        self.the_exp = the_exp
+        self.kind = kind
+        self.chunk_rows = chunk_rows
+        self.max_errors = max_errors
+        self.on_chunk = on_chunk
+        self.id_prefix = id_prefix
+        self.header = None
+        self.seen = set()
+        self.pending = {}
+        self.pending_ids = []
+        self.pending_lines = []
+        self.errors = []
+        self.summary = {"rows": 0, "imported": 0, "errors": 0, "added": 0, "modified": 0, "unchanged": 0}
+
+    def error(self, line, name, message):
+        self.summary["errors"] += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({"row": line, "name": name, "error": message})
+
+    def feed(self, rows):
+        """
+        :param rows: 行的可迭代对象（第一行为表头），见 iter_rows
+        :return: self.result()
+        """
+        for line, row in enumerate(rows, start=1):
+            if self.header is None:
+                self.header = [str(_cell_text(cell)) for cell in row]
+                continue
+            if not any(_cell_text(cell) != "" for cell in row):
+                continue  # 空行
+            self.summary["rows"] += 1
+            try:
+                name, values = self.parse_row(row)
+                if self.kind == "stock":
+                    self.check_stock(name, values)
+                else:
+                    self.check_recipe(name, values)
+            except ValueError as e:
+                self.error(line, _cell_text(row[0]) if row else "", str(e))
+                continue
+            self.seen.add(name)
+            self.pending[name] = values
+            self.pending_ids.append(f"{self.id_prefix}{line}")
+            self.pending_lines.append(line)
+            if len(self.pending) >= self.chunk_rows:
+                self.flush()
+        self.flush()
+        if self.header is None:
+            self.error(1, "", "文件为空")
+        return self.result()
+
+    def parse_row(self, row):
+        name = _cell_text(row[0])
+        if name == "":
+            raise ValueError("第一列（名字）为空")
+        name = str(name)
+        if name in self.seen:
+            raise ValueError(f"名字 {name} 在文件中重复")
+        if len(row) > len(self.header):
+            if any(_cell_text(cell) != "" for cell in row[len(self.header):]):
+                raise ValueError("数值多于表头的列数")
+        values = {}
+        for column, cell in zip(self.header[1:], row[1:]):
+            try:
+                amount = _parse_amount(cell)
+            except ValueError as e:
+                raise ValueError(f"列 {column}: {e}") from None
+            if amount is None:
+                continue
+            if column == "":
+                raise ValueError("有数值的列缺少表头")
+            values[column] = amount
+        return name, values
+
+    def check_stock(self, name, values):
+        existing = self.the_exp.sample_dict.get(name)
+        if existing is not None and not existing[1].stock:
+            raise ValueError(f"{name} 是已有的非stock试样")
+
+    def check_recipe(self, name, values):
+        sample_dict = self.the_exp.sample_dict
+        for component in values:
+            if component == name:
+                raise ValueError(f"{name} 不能以自身为组分")
+            if component not in sample_dict and component not in self.pending:
+                raise ValueError(f"组分 {component} 不存在（须为实验中已有的试样或文件中更早的行）")
+        existing = sample_dict.get(name)
+        if existing is None:
+            return  # 新试样没有下游，不会形成循环
+        if existing[1].stock:
+            if values:
+                raise ValueError(f"{name} 是stock，不能设置组分")
+            return
+        added = [component for component in values if component not in existing[1].composite]
+        if not added:
+            return
+        # 循环检查基于已应用的状态，先把之前的行应用掉
+        self.flush()
+        for component in values:
+            if component not in sample_dict:
+                raise ValueError(f"组分 {component} 未能导入")
+        order = self.the_exp.composite_order
+        for component in added:
+            path = order.find_cycle(component, name)
+            if path is not None:
+                raise CycleError(path)
+
+    def flush(self):
+        if not self.pending:
+            return
+        rows, ids = self.pending, self.pending_ids
+        if self.kind == "recipe":
+            rows, ids = self.check_inventory(rows, ids, self.pending_lines)
+        self.pending, self.pending_ids, self.pending_lines = {}, [], []
+        if not rows:
+            return
+        if self.on_chunk is not None:
+            self.on_chunk(self.kind, rows, ids)
+        apply_chunk(self.the_exp, self.kind, rows, ids, self.summary)
+        self.summary["imported"] += len(rows)
+        logger.debug("RowImporter: 已导入 %d 行（%s）", self.summary["imported"], self.kind)
+
+    def check_inventory(self, rows, ids, lines):
+        """
+        去掉这一块中使有限量试样超量的行
+        :return: 剩下的 (rows, ids)
+        """
+        names = list(rows)
+        line_of = dict(zip(names, lines))
+        dropped = set()
+        while True:
+            report = inventory.check_submission(self.the_exp, rows, full_table=False, raise_error=False)
+            if not report:
+                break
+            for item in report:
+                name = item["first_trial"]
+                if name in rows:
+                    self.error(line_of[name], name, f"试样 {item['trial']} 的可用量 {item['available']:g} 不足，"
+                                                    f"本块共需要 {item['draw']:g}")
+                    dropped.add(name)
+                    del rows[name]
+            # 以被跳过的新试样为组分的行也无法导入
+            for name in list(rows):
+                missing = [component for component in rows[name]
+                           if component in dropped and component not in self.the_exp.sample_dict]
+                if missing:
+                    self.error(line_of[name], name, f"组分 {missing[0]} 未能导入")
+                    dropped.add(name)
+                    del rows[name]
+        if dropped:
+            kept = [i for i, name in enumerate(names) if name not in dropped]
+            ids = [ids[i] for i in kept]
+        return rows, ids
+
+    def result(self):
+        return {"kind": self.kind, **self.summary, "error_details": self.errors}
+
+
+def apply_chunk(the_exp, kind, rows, ids, summary=None):
+    """
+    把一块已校验的行交给 Experiment（也用于日志重放）
+    :param rows: {名字: {列名: 数值}}
+    :param summary: 给定时累加 added/modified/unchanged
+    """
+    if kind == "stock":
+        counts = {"added": 0, "modified": 0, "unchanged": 0}
+        for name, values in rows.items():
+            existing = the_exp.sample_dict.get(name)
+            if existing is None:
+                counts["added"] += 1
+            elif existing[1].substance_conc == values:
+                counts["unchanged"] += 1
+            else:
+                counts["modified"] += 1
+        the_exp.stock_from_2d_array(rows, list(ids))
+    else:
+        counts = the_exp.recipes_from_2d_array(rows, list(ids))
+    if summary is not None:
+        for key, value in counts.items():
+            summary[key] += value
+    return counts
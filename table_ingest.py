@@ -0,0 +1,170 @@
+import math
+from collections.abc import Mapping
+
+import numpy as np
+
+import table_wire
+
+
+class IngestedTable(Mapping):
+    """
+    前端提交的表格（第一行为列名，第一列为行名）解析后的结果：float64 矩阵 values 与同形状的有效性掩码 mask，
+    无效（空或非数值）的单元格在 values 中为 NaN；非数值单元格另记入 errors
+
+    同时是 {行名: {列名: 数值}} 的只读映射（与 table_to_dict 的结果相同，只含有效的单元格），
+    Experiment 的 stock_from_2d_array / new_exp_from_2d_array 等直接使用：某一行的字典在访问时才由矩阵的该行生成，
+    没有变化而被跳过的行不会生成；行名重复时与 dict 相同，以最后一行为准，位置为第一次出现的位置
+    """
+
+    def __init__(self, columns, rows, values, mask, errors=None, positions=None):
+        """
+        :param columns: 列名列表
+        :param rows: 行名列表（可重复）
+        :param values: (行数, 列数) 的 float64 矩阵
+        :param mask: 同形状的 bool 矩阵，True 为有效的数值
+        :param errors: [{"row": 行号, "column": 列号, "row_name", "column_name", "value", "error"}]，
+                       行号、列号为在提交的二维数组中的下标（表头为第 0 行，行名为第 0 列）
+        :param positions: 各行在提交的二维数组中的行号，None 时为 1, 2, ...（没有跳过空行）
+        """
+        self.columns = columns
+        self.rows = rows
+        self.values = values
+        self.mask = mask
+        self.errors = errors if errors is not None else []
+        self.positions = positions if positions is not None else list(range(1, len(rows) + 1))
+        self._row_index = {}
+        for i, name in enumerate(rows):
+            self._row_index[name] = i
+
+    def row(self, i):
+        """第 i 行（从 0 开始，不含表头）有效单元格的 {列名: 数值}"""
+        present = np.flatnonzero(self.mask[i])
+        if not len(present):
+            return {}
+        columns = self.columns
+        return dict(zip([columns[j] for j in present.tolist()], self.values[i, present].tolist()))
+
+    def index_of(self, name):
+        """行名对应的行（从 0 开始；行名重复时为最后一行）"""
+        return self._row_index[name]
+
+    def __getitem__(self, name):
+        return self.row(self._row_index[name])
+
+    def __iter__(self):
+        return iter(self._row_index)
+
+    def __len__(self):
+        return len(self._row_index)
+
+    def __contains__(self, name):
+        return name in self._row_index
+
+    def __repr__(self):
+        return f"IngestedTable({len(self.rows)} x {len(self.columns)}, {int(self.mask.sum())} values, {len(self.errors)} errors)"
+
+    def to_dict(self, keep_invalid=False):
+        """
+        :param keep_invalid: 为 True 时非数值单元格以原样的值放入（与原 table_to_dict 相同，substance 表格的文字属性需要）
+        """
+        result = {name: self.row(i) for name, i in self._row_index.items()}
+        if keep_invalid and self.errors:
+            row_of_position = {position: i for i, position in enumerate(self.positions)}
+            invalid = {}
+            for error in self.errors:
+                invalid.setdefault(row_of_position[error["row"]], {})[error["column"] - 1] = error["value"]
+            for i, cells in invalid.items():
+                if self._row_index[self.rows[i]] != i:
+                    continue
+                # 按列的顺序重新组成这一行，列名重复时与逐格赋值的结果相同
+                row = {}
+                for j, column in enumerate(self.columns):
+                    if self.mask[i, j]:
+                        row[column] = self.values[i, j].item()
+                    elif j in cells:
+                        row[column] = cells[j]
+                result[self.rows[i]] = row
+        return result
+
+
+def ingest_table(table_content):
+    """
+    一次性把提交的表格转为 IngestedTable，不逐个单元格调用 float()、也不为每行生成字典：
+    每行用 filter 在 C 层面取出非空的单元格（稀疏表格的大部分单元格为空），list.index 找到它们的列，
+    全部非空单元格由一次 np.array(..., float64) 转换；只有批量转换失败（含非数值）或得到非有限值时才逐个检查，找出出错的位置
+    :param table_content: 二维数组（行可以长短不一：短的补空，长于表头的部分忽略；空行或非列表的行跳过），或列式表格（见 table_wire.py）
+    """
+    if isinstance(table_content, dict):
+        columns, rows, values, mask = table_wire.columnar_matrix(table_content)
+        return IngestedTable(columns, rows, values, mask)
+    if not table_content or not isinstance(table_content[0], list):
+        raise ValueError("输入必须是二维数组")
+    header = table_content[0]
+    columns = list(header[1:])
+    width = len(header)
+    n_columns = width - 1
+    rows = []
+    positions = []
+    flat_indices = []  # 非空单元格在按行展开的 (行数, 列数) 矩阵中的下标
+    cells = []
+    for position, row in enumerate(table_content[1:], start=1):
+        if not isinstance(row, list) or len(row) == 0:
+            continue  # 跳过空行或无效行
+        if len(row) > width:
+            row = row[:width]
+        base = len(rows) * n_columns - 1  # 第 j 列（行名为第 0 列）的下标为 base + j
+        rows.append(row[0])
+        positions.append(position)
+        present = list(filter(None, row))
+        if len(present) + row.count("") < len(row):
+            # 除空字符串外还有假值（None、数值 0 等）被 filter 丢掉，这一行逐个判断
+            present = [j for j in range(1, len(row)) if row[j] != "" and row[j] is not None]
+            flat_indices.extend([base + j for j in present])
+            cells.extend([row[j] for j in present])
+            continue
+        if row[0]:
+            del present[0]  # 行名
+        if not present:
+            continue
+        if len(present) == n_columns:
+            flat_indices.extend(range(base + 1, base + width))
+        else:
+            j, index = 0, row.index
+            for cell in present:
+                j = index(cell, j + 1)
+                flat_indices.append(base + j)
+        cells.extend(present)
+
+    values = np.full(len(rows) * n_columns, np.nan)
+    mask = np.zeros(len(rows) * n_columns, dtype=bool)
+    errors = []
+    if cells:
+        flat_indices = np.array(flat_indices, dtype=np.int64)
+        try:
+            parsed = np.array(cells, dtype=np.float64)
+            suspect = np.flatnonzero(~np.isfinite(parsed))
+        except (TypeError, ValueError):
+            parsed = np.full(len(cells), np.nan)
+            suspect = range(len(cells))
+        values[flat_indices] = parsed
+        mask[flat_indices] = True
+        for k in suspect:
+            cell = cells[k]
+            i, j = divmod(int(flat_indices[k]), n_columns)
+            number = None
+            if isinstance(cell, str) and not cell.strip():
+                mask[flat_indices[k]] = False  # 只有空白的单元格视为空
+                continue
+            try:
+                number = float(cell)
+            except (TypeError, ValueError):
+                pass
+            if number is None or not math.isfinite(number):
+                mask[flat_indices[k]] = False
+                values[flat_indices[k]] = np.nan
+                errors.append({"row": positions[i], "column": j + 1, "row_name": rows[i], "column_name": columns[j],
+                               "value": cell, "error": "不是数字" if number is None else "不是有限的数"})
+            else:
+                values[flat_indices[k]] = number
+    shape = (len(rows), n_columns)
+    return IngestedTable(columns, rows, values.reshape(shape), mask.reshape(shape), errors, positions)
@@ -0,0 +1,88 @@
+import threading
+
+
+class SortedKeys:
+    """
+    按排序顺序维护的键集合，每个键带引用计数（如 substance_conc 中含有某物质的trial数），计数降到0时移除
+    Experiment 用它保存浓度表的列顺序（全部物质）与行顺序（全部trial名），渲染时不必每次收集全部键再排序：
+    增删只先记录下来，取 ordered() 时才合并进有序列表——新增的键排序后接在原列表之后再 sort（timsort 对两段有序序列的合并是线性的），
+    删除的键一次过滤掉；没有变化时直接返回上次的列表
+    add/discard 在实验的写锁下调用；ordered()/positions() 会在读锁下被多个线程同时调用，合并与缓存由自己的锁保护，
+    否则一个线程可能把合并之前的旧列表写回去，新增的键就丢了
+    """
+    __slots__ = ("_counts", "_order", "_added", "_removed", "_positions", "_lock")
+
+    def __init__(self, counts=None):
+        """
+        :param counts: 初始的 {键: 计数}（计数须大于0）
+        """
+        self._counts = dict(counts) if counts else {}
+        self._order = sorted(self._counts)
+        self._added = []
+        self._removed = set()
+        self._positions = None
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        count = self._counts.get(key, 0)
+        self._counts[key] = count + 1
+        if count == 0:
+            if key in self._removed:
+                self._removed.discard(key)  # 还在有序列表（或待合并的新增）中
+            else:
+                self._added.append(key)
+            self._positions = None
+
+    def discard(self, key):
+        count = self._counts.get(key)
+        if count is None:
+            return
+        if count > 1:
+            self._counts[key] = count - 1
+            return
+        del self._counts[key]
+        self._removed.add(key)
+        self._positions = None
+
+    def ordered(self):
+        """
+        排好序的全部键；返回的列表之后不会再被修改（有变化时生成新的列表），调用方不要修改它
+        """
+        with self._lock:
+            return self._merge()
+
+    def _merge(self):
+        if self._added or self._removed:
+            removed = self._removed
+            order = [key for key in self._order if key not in removed] if removed else self._order
+            added = [key for key in self._added if key not in removed]
+            if added:
+                added.sort()
+                order = order + added
+                order.sort()
+            elif order is self._order:
+                order = list(order)
+            self._order = order
+            self._added = []
+            self._removed = set()
+        return self._order
+
+    def positions(self, start=0):
+        """{键: 在 ordered() 中的下标 + start}，在键变化之前缓存"""
+        with self._lock:
+            positions = self._positions
+            if positions is None or positions[0] != start:
+                positions = self._positions = (start, {key: i for i, key in enumerate(self._merge(), start=start)})
+            return positions[1]
+
+    def count(self, key):
+        return self._counts.get(key, 0)
+
+    def __contains__(self, key):
+        return key in self._counts
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __repr__(self):
+        return f"SortedKeys({len(self._counts)} keys)"
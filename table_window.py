@@ -0,0 +1,143 @@
+import json
+
+# 可分窗口读取的表格（与 chem_interface.Get_conc_table / Get_exp_table 的行列相同）
+WINDOW_TABLES = ("conc", "exp")
+
+
+def _range(value, name):
+    if value is None:
+        return None
+    if not isinstance(value, (list, tuple)) or len(value) != 2:
+        raise ValueError(f"window.{name} 应为 [起始, 结束]")
+    try:
+        start, end = int(value[0]), int(value[1])
+    except (TypeError, ValueError):
+        raise ValueError(f"window.{name} 应为整数") from None
+    if start < 0 or end < start:
+        raise ValueError(f"window.{name} 的范围无效: {value}")
+    return start, end
+
+
+def _bound(value, name):
+    if value in (None, ""):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"window.filter.{name} 应为数字") from None
+
+
+def normalize_window(window):
+    """
+    校验并规范请求中的 window
+    :param window: {"rows": [起始, 结束], "columns": [起始, 结束],  # 左闭右开，省略为全部
+                    "sort": {"column": 列名, "descending": bool},  # 按某列的值排序行，列名为空时按行名
+                    "filter": {"name": 行名包含的文字, "column": 列名, "min": 下限, "max": 上限}}  # 列条件只保留该列有值且在范围内的行
+    :return: 同结构的字典（sort/filter 没有时为 None）
+    """
+    if not isinstance(window, dict):
+        raise ValueError("window 应为字典")
+    sort = window.get("sort") or None
+    if sort is not None:
+        if not isinstance(sort, dict):
+            raise ValueError("window.sort 应为字典")
+        sort = {"column": str(sort.get("column") or ""), "descending": bool(sort.get("descending"))}
+    row_filter = window.get("filter") or None
+    if row_filter is not None:
+        if not isinstance(row_filter, dict):
+            raise ValueError("window.filter 应为字典")
+        row_filter = {"name": str(row_filter.get("name") or ""), "column": str(row_filter.get("column") or ""),
+                      "min": _bound(row_filter.get("min"), "min"), "max": _bound(row_filter.get("max"), "max")}
+        if not row_filter["column"] and (row_filter["min"] is not None or row_filter["max"] is not None):
+            raise ValueError("window.filter 的 min/max 需要指定 column")
+        if not row_filter["name"] and not row_filter["column"]:
+            row_filter = None
+    return {"rows": _range(window.get("rows"), "rows"), "columns": _range(window.get("columns"), "columns"),
+            "sort": sort, "filter": row_filter}
+
+
+def order_key(window):
+    """决定行顺序的部分（sort 与 filter），用作行顺序缓存的键"""
+    return json.dumps([window["sort"], window["filter"]], sort_keys=True, ensure_ascii=False)
+
+
+def table_axes(the_exp, table_type):
+    """
+    整表的行名与列名，顺序与 dict_to_table 相同：
+    conc 表行为按名字排序的trial、列为按名字排序的全部物质（取自实验维护的 trial_rows / substance_columns，不再扫描排序）；
+    exp 表行、列都是 sample_dict 顺序的trial
+    :return: (行名列表, 列名列表)
+    """
+    if table_type == "conc":
+        return list(the_exp.trial_rows.ordered()), list(the_exp.substance_columns.ordered())
+    names = list(the_exp.sample_dict)
+    return names, names
+
+
+def column_values(the_exp, table_type, column):
+    """
+    某一列中有值的单元格 {行名: 值}，直接取自实验的索引而不逐行查找：
+    conc 表取 substance_index（只含浓度>0的trial），exp 表取该trial的 master（使用了它的trial及用量）
+    """
+    if table_type == "conc":
+        return the_exp.substance_index.get(column, {})
+    entry = the_exp.sample_dict.get(column)
+    return entry[1].master if entry is not None else {}
+
+
+def row_order(the_exp, table_type, rows, sort=None, row_filter=None):
+    """
+    按 sort/filter 排列、筛选后的行名
+    :param rows: table_axes 给出的整表行名
+    :return: 行名列表；按列排序时该列没有值的行排在最后，保持原有顺序
+    """
+    if row_filter is not None:
+        if row_filter["column"]:
+            values = column_values(the_exp, table_type, row_filter["column"])
+            low, high = row_filter["min"], row_filter["max"]
+            candidates = {name for name, value in values.items()
+                          if (low is None or value >= low) and (high is None or value <= high)}
+            if table_type == "conc":
+                rows = sorted(candidates)  # conc 表的行本就按名字排序，不必扫描全部行
+            else:
+                rows = [name for name in rows if name in candidates]
+        if row_filter["name"]:
+            text = row_filter["name"].lower()
+            rows = [name for name in rows if text in name.lower()]
+    if sort is None:
+        return list(rows)
+    if not sort["column"]:
+        return sorted(rows, reverse=sort["descending"])
+    if table_type == "conc":
+        # substance_index 已按浓度排好序的列表（Experiment 中缓存，浓度变化时失效）
+        ranked = [name for name, _ in the_exp.trials_by_concentration(sort["column"])]
+        if not sort["descending"]:
+            ranked.reverse()
+    else:
+        values = column_values(the_exp, table_type, sort["column"])
+        ranked = sorted(values, key=values.__getitem__, reverse=sort["descending"])
+    present = set(rows)
+    ranked = [name for name in ranked if name in present]
+    ranked_set = set(ranked)
+    return ranked + [name for name in rows if name not in ranked_set]
+
+
+def clip(span, total):
+    """把 [起始, 结束) 限制在 [0, total] 之内，None 为全部"""
+    if span is None:
+        return 0, total
+    start = min(span[0], total)
+    return start, max(start, min(span[1], total))
+
+
+def window_table(the_exp, table_type, rows, columns):
+    """
+    只生成给定行、列的二维表格（格式同 dict_to_table：第一行为列名，第一列为行名，空单元格为空字符串）
+    """
+    table = [[""] + list(columns)]
+    sample_dict = the_exp.sample_dict
+    for name in rows:
+        the_trial = sample_dict[name][1]
+        cells = the_trial.substance_conc if table_type == "conc" else the_trial.composite
+        table.append([name] + [cells.get(column, "") for column in columns])
+    return table
@@ -0,0 +1,167 @@
+import base64
+import gzip
+import json
+import struct
+from itertools import chain
+
+import numpy as np
+
+# 表格的列式传输格式（客户端用 Accept 选择，默认仍为 application/json 的二维数组）：
+#   COLUMNAR_JSON   config.columnar 中的数值为 JSON 列表
+#   COLUMNAR_BASE64 数值为 base64 编码的小端 float64/int32 数组，仍是一个 JSON 响应
+#   COLUMNAR_BINARY 整个响应为二进制帧：MAGIC + uint32 元数据长度 + 元数据JSON（不含数值）+ 按 8 字节对齐的各数组
+COLUMNAR_JSON = "application/vnd.chem-table.columnar+json"
+COLUMNAR_BASE64 = "application/vnd.chem-table.columnar.base64+json"
+COLUMNAR_BINARY = "application/octet-stream"
+MEDIA_TYPES = ("application/json", COLUMNAR_JSON, COLUMNAR_BASE64, COLUMNAR_BINARY)
+# 同一内容不同格式的响应 ETag 不同
+ETAG_SUFFIX = {COLUMNAR_JSON: "col", COLUMNAR_BASE64: "b64", COLUMNAR_BINARY: "bin"}
+MAGIC = b"CTB1"
+VALUE_DTYPE = "<f8"
+INDEX_DTYPE = "<i4"
+# 有值单元格的比例低于此值时用稀疏格式（下标 + 数值），否则稠密（空单元格为 NaN / null）
+SPARSE_DENSITY = 0.25
+
+
+def to_columnar(table, sparse_density=SPARSE_DENSITY):
+    """
+    带表头的二维表格（dict_to_table 的输出）转为列式
+    :return: {"columns": 列名, "rows": 行名, "shape": [行数, 列数], "layout": "dense" 或 "sparse",
+              "values": float64 数组（稠密为按行展开的全部单元格，空为 NaN；稀疏为有值的单元格）,
+              "indices": 稀疏时有值单元格在按行展开中的下标（int32）}；
+             表格为空或含有非数值的单元格时返回 None（调用方改用二维数组）
+    """
+    if not table:
+        return None
+    columns = list(table[0][1:])
+    rows = [row[0] for row in table[1:]]
+    n_columns = len(columns)
+    if any(len(row) != n_columns + 1 for row in table[1:]):
+        return None
+    # 先放入 object 数组，空单元格的判断与数值转换都由 numpy 逐元素完成
+    cells = np.fromiter(chain.from_iterable(row[1:] for row in table[1:]), dtype=object, count=len(rows) * n_columns)
+    present = (cells != "") & np.not_equal(cells, None)
+    try:
+        present_values = cells[present].astype(np.float64)
+    except (TypeError, ValueError):
+        return None
+    values = np.full(len(cells), np.nan)
+    values[present] = present_values
+    present = ~np.isnan(values)  # 字符串 "nan" 等同于空单元格
+    result = {"columns": columns, "rows": rows, "shape": [len(rows), n_columns]}
+    if values.size and np.count_nonzero(present) < sparse_density * values.size and values.size < 2 ** 31:
+        indices = np.flatnonzero(present).astype(INDEX_DTYPE)
+        result.update(layout="sparse", values=values[indices], indices=indices)
+    else:
+        result.update(layout="dense", values=values)
+    return result
+
+
+def columnar_matrix(columnar):
+    """
+    列式表格（JSON 列表、base64 或已解码的 numpy 数组，见 encode_columnar）还原为矩阵，不逐个解析单元格
+    :return: (列名, 行名, (行数, 列数) 的 float64 矩阵（空为 NaN）, 有效性掩码)，见 table_ingest.IngestedTable
+    """
+    columns, rows = list(columnar["columns"]), list(columnar["rows"])
+    n_rows, n_columns = len(rows), len(columns)
+    values = _array(columnar["values"], VALUE_DTYPE, columnar.get("encoding"))
+    if columnar.get("layout") == "sparse":
+        indices = _array(columnar["indices"], INDEX_DTYPE, columnar.get("encoding")).astype(np.int64)
+        if len(indices) != len(values) or (len(indices) and (indices.min() < 0 or indices.max() >= n_rows * n_columns)):
+            raise ValueError("列式表格的下标与数值不匹配")
+        matrix = np.full(n_rows * n_columns, np.nan)
+        matrix[indices] = values
+    else:
+        if len(values) != n_rows * n_columns:
+            raise ValueError(f"列式表格应有 {n_rows * n_columns} 个数值，实际 {len(values)} 个")
+        matrix = np.array(values, dtype=np.float64)
+    matrix = matrix.reshape(n_rows, n_columns)
+    return columns, rows, matrix, np.isfinite(matrix)
+
+
+def row_names(table_content):
+    """请求中表格（二维数组或列式）的行名，与 table_content[1:] 的第一列对应"""
+    if isinstance(table_content, dict):
+        return list(table_content.get("rows", []))
+    return [row[0] if row else "" for row in table_content[1:]]
+
+
+def _array(data, dtype, encoding):
+    if isinstance(data, np.ndarray):
+        return data
+    if encoding == "base64":
+        return np.frombuffer(base64.b64decode(data), dtype=dtype)
+    return np.array([np.nan if value is None else value for value in data], dtype=np.float64) \
+        if dtype == VALUE_DTYPE else np.array(data, dtype=np.int64)
+
+
+def encode_columnar(columnar, media_type):
+    """
+    列式表格按媒体类型编码为可放入 JSON 的字典；COLUMNAR_BINARY 返回 (元数据字典, [各数组的 bytes])
+    """
+    meta = {key: columnar[key] for key in ("columns", "rows", "shape", "layout")}
+    arrays = [("values", columnar["values"])]
+    if columnar["layout"] == "sparse":
+        arrays.append(("indices", columnar["indices"]))
+    if media_type == COLUMNAR_JSON:
+        for name, array in arrays:
+            meta[name] = [None if value != value else value for value in array.tolist()]
+        return meta
+    dtypes = {"values": VALUE_DTYPE, "indices": INDEX_DTYPE}
+    if media_type == COLUMNAR_BASE64:
+        meta["encoding"] = "base64"
+        for name, array in arrays:
+            meta[name] = base64.b64encode(array.astype(dtypes[name]).tobytes()).decode("ascii")
+            meta[f"{name}_dtype"] = dtypes[name]
+        return meta
+    meta["encoding"] = "binary"
+    buffers = []
+    for name, array in arrays:
+        data = array.astype(dtypes[name]).tobytes()
+        meta[f"{name}_dtype"] = dtypes[name]
+        meta[f"{name}_bytes"] = len(data)
+        buffers.append(data)
+    return meta, buffers
+
+
+def encode_response(result, media_type):
+    """
+    表格响应（json_config_composer 的输出）中 config.tableArray 改为 config.columnar
+    :return: (内容, Content-Type)：JSON 类型的内容为字典（由调用方 jsonify），COLUMNAR_BINARY 为 bytes 帧：
+             MAGIC、uint32 元数据长度、元数据 JSON（UTF-8，补空格到 8 字节对齐）、依次排列的数组；
+             表格不能转为列式（或没有 tableArray，如 delta 响应）时原样返回，类型为 application/json
+    """
+    config = result.get("config") if isinstance(result, dict) else None
+    columnar = to_columnar(config.get("tableArray")) if isinstance(config, dict) else None
+    if columnar is None:
+        return result, "application/json"
+    result = dict(result)
+    result["config"] = {key: value for key, value in config.items() if key != "tableArray"}
+    if media_type != COLUMNAR_BINARY:
+        result["config"]["columnar"] = encode_columnar(columnar, media_type)
+        return result, media_type
+    result["config"]["columnar"], buffers = encode_columnar(columnar, media_type)
+    meta = json.dumps(result, ensure_ascii=False).encode("utf-8")
+    meta += b" " * (-(len(MAGIC) + 4 + len(meta)) % 8)
+    return b"".join([MAGIC, struct.pack("<I", len(meta)), meta] + buffers), media_type
+
+
+def decode_response(data):
+    """COLUMNAR_BINARY 帧还原为 (响应字典, 列式表格字典)，数组为 numpy 数组（用于测试与 Python 客户端）"""
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("不是列式二进制帧")
+    (meta_length,) = struct.unpack_from("<I", data, len(MAGIC))
+    offset = len(MAGIC) + 4
+    result = json.loads(data[offset:offset + meta_length].decode("utf-8"))
+    offset += meta_length
+    columnar = dict(result["config"]["columnar"])
+    for name in ("values", "indices"):
+        if f"{name}_bytes" in columnar:
+            size = columnar[f"{name}_bytes"]
+            columnar[name] = np.frombuffer(data[offset:offset + size], dtype=columnar[f"{name}_dtype"])
+            offset += size
+    return result, columnar
+
+
+def gzip_body(data, level=6):
+    return gzip.compress(data, compresslevel=level)
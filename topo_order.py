@@ -0,0 +1,265 @@
+from collections import deque
+
+import numpy as np
+
+import conc_matrix
+
+
+class CycleError(ValueError):
+    """
+    新加的组分关系会形成循环依赖；在修改任何状态之前抛出
+    path 为 [组分, 使用者, ..., 组分]：前一个用于后一个，最后一条是已有的关系，第一条是新加的
+    """
+
+    def __init__(self, path):
+        self.path = path
+        super().__init__(f"把 {path[0]} 加为 {path[1]} 的组分会形成循环依赖: {' -> '.join(path)}")
+
+
+def find_path(source, target, successors):
+    """
+    不借助拓扑顺序，从 source 沿 successors 深度优先找到 target 的一条路径（没有维护顺序时的后备做法，开销为 source 的整个下游）
+    :return: [source, ..., target]，找不到时为 None
+    """
+    parent = {source: None}
+    stack = [source]
+    while stack:
+        name = stack.pop()
+        if name == target:
+            path = []
+            while name is not None:
+                path.append(name)
+                name = parent[name]
+            return path[::-1]
+        for successor in successors(name):
+            if successor not in parent:
+                parent[successor] = name
+                stack.append(successor)
+    return None
+
+
+def cycle_path(n, edge_row, edge_col):
+    """
+    一张完整的图（边 edge_col -> edge_row，即 edge_row 用到了 edge_col）中的一个循环，用于整表提交在写入之前的检查：
+    一次分层的 Kahn 排序（conc_matrix.topological_levels），有剩余节点时沿剩余节点之间的边走到重复的节点
+    :return: 循环的节点下标 [组分, 使用者, ..., 组分]，没有循环时为 None
+    """
+    _, remaining = conc_matrix.topological_levels(n, edge_row, edge_col)
+    if not remaining.size:
+        return None
+    left = np.zeros(n, dtype=bool)
+    left[remaining] = True
+    keep = left[edge_row] & left[edge_col]
+    component_of = {}
+    for row, col in zip(edge_row[keep].tolist(), edge_col[keep].tolist()):
+        component_of.setdefault(row, col)
+    # 剩余的节点都至少有一个剩余的组分，沿"组分"一直走必然回到走过的节点
+    walk, seen = [], {}
+    node = int(remaining[0])
+    while node not in seen:
+        seen[node] = len(walk)
+        walk.append(node)
+        node = component_of[node]
+    return (walk[seen[node]:] + [node])[::-1]
+
+
+class TopologicalOrder:
+    """
+    实验中全部trial的拓扑顺序（组分排在使用它的trial之前），加边时按 Pearce–Kelly 算法在线维护：
+    新边 组分 -> 使用者 已符合顺序时 O(1)；否则只在两者位置之间的区域内向前、向后搜索，
+    搜索到组分本身即为循环（给出路径），没有循环时把这两部分节点在它们原有的位置中重新排列
+    边取自 trial.composite 与 trial.master（master 只用来找下游，是否真有这条边以 composite 为准）
+
+    直接改写 composite/master 的代码（如 generate_trials_bulk 的同名替换、快照加载）不经过这里，
+    它们调用 invalidate()（或使试样数与 sample_dict 不一致），下次使用时用一次 Kahn 排序整体重建；
+    重算浓度时另以 consistent() 线性核对一遍，不对时同样重建
+    """
+    __slots__ = ("sample_dict", "_position", "_next", "_ordered")
+
+    def __init__(self, sample_dict):
+        """
+        :param sample_dict: 所属实验的 sample_dict（trial名：[id，路由]）
+        """
+        self.sample_dict = sample_dict
+        self._position = None  # {trial名: 位置}，位置只需互不相同、保持先后，None 为需要重建
+        self._next = 0
+        self._ordered = None
+
+    def composite_of(self, name):
+        entry = self.sample_dict.get(name)
+        return entry[1].composite if entry is not None else {}
+
+    def successors(self, name):
+        """name 的使用者（其 composite 中确实含有 name 的 master 条目）"""
+        entry = self.sample_dict.get(name)
+        if entry is None:
+            return []
+        composite_of = self.composite_of
+        return [consumer for consumer in entry[1].master if name in composite_of(consumer)]
+
+    def invalidate(self):
+        self._position = None
+        self._ordered = None
+
+    def positions(self):
+        """{trial名: 位置}，需要时先重建"""
+        if self._position is None or len(self._position) != len(self.sample_dict):
+            self.rebuild()
+        return self._position
+
+    def rebuild(self):
+        """
+        由 sample_dict 的 composite 用 Kahn 算法整体重建（入度相同的按 sample_dict 的顺序）
+        :return: 因循环依赖未能排序的trial名（按 sample_dict 的顺序，排在最后），没有循环时为空列表
+        """
+        sample_dict = self.sample_dict
+        in_degree, consumers = {}, {}
+        for name, entry in sample_dict.items():
+            degree = 0
+            for component in entry[1].composite:
+                if component in sample_dict:
+                    consumers.setdefault(component, []).append(name)
+                    degree += 1
+            in_degree[name] = degree
+        queue = deque(name for name, degree in in_degree.items() if degree == 0)
+        ordered = []
+        while queue:
+            name = queue.popleft()
+            ordered.append(name)
+            for consumer in consumers.get(name, ()):
+                in_degree[consumer] -= 1
+                if in_degree[consumer] == 0:
+                    queue.append(consumer)
+        remaining = []
+        if len(ordered) < len(in_degree):
+            remaining = [name for name, degree in in_degree.items() if degree > 0]
+            ordered.extend(remaining)
+        self._position = {name: i for i, name in enumerate(ordered)}
+        self._next = len(ordered)
+        self._ordered = ordered
+        return remaining
+
+    def ordered(self):
+        """按拓扑顺序排列的全部trial名；返回的列表调用方不要修改"""
+        position = self.positions()
+        if self._ordered is None:
+            self._ordered = sorted(position, key=position.__getitem__)
+        return self._ordered
+
+    def consistent(self, names):
+        """给定的trial的每个组分是否都排在它之前（O(这些trial的组分数)）"""
+        position = self.positions()
+        for name in names:
+            own = position.get(name)
+            if own is None:
+                return False
+            for component in self.composite_of(name):
+                other = position.get(component)
+                if other is not None and other >= own:
+                    return False
+        return True
+
+    def add(self, name):
+        """
+        登记新trial（须已在 sample_dict 中），排在最后；
+        已有位置（如事务检查它的组分关系时由 insert_edge 放入）且组分都在前、使用者都在后时保留原位置；
+        其余已经登记过、已有下游或有尚未登记的组分时无法直接确定位置，改为下次使用时重建
+        """
+        position = self._position
+        if position is None:
+            return
+        the_trial = self.sample_dict[name][1]
+        own = position.get(name)
+        if own is not None:
+            sample_dict = self.sample_dict
+            if all(position.get(component, own) < own for component in the_trial.composite if component in sample_dict) \
+                    and all(position.get(consumer, own + 1) > own for consumer in the_trial.master):
+                return
+            self.invalidate()
+            return
+        if len(the_trial.master) or any(component not in position for component in the_trial.composite):
+            self.invalidate()
+            return
+        position[name] = self._next
+        self._next += 1
+        if self._ordered is not None:
+            self._ordered.append(name)
+
+    def discard(self, name):
+        if self._position is not None and self._position.pop(name, None) is not None:
+            self._ordered = None
+
+    def rename(self, old_name, new_name):
+        if self._position is not None and old_name in self._position:
+            self._position[new_name] = self._position.pop(old_name)
+            self._ordered = None
+
+    def _search(self, start, bound, neighbours, inside):
+        """从 start 沿 neighbours 深度优先，只进入 inside(位置) 的节点；返回 {节点: 前驱}"""
+        position = self._position
+        parent = {start: None}
+        stack = [start]
+        while stack:
+            name = stack.pop()
+            for neighbour in neighbours(name):
+                if neighbour in parent:
+                    continue
+                other = position.get(neighbour)
+                if other is not None and (other == bound or inside(other)):
+                    parent[neighbour] = name
+                    if other == bound:
+                        return parent, neighbour
+                    stack.append(neighbour)
+        return parent, None
+
+    def _path(self, parent, found, component):
+        path = []
+        while found is not None:
+            path.append(found)
+            found = parent[found]
+        return [component] + path[::-1]
+
+    def find_cycle(self, component, consumer, successors=None):
+        """
+        加入 组分 -> 使用者 这条边是否会形成循环，不修改顺序
+        :param successors: successors(trial名) 给出使用它的trial，默认为 self.successors（事务中另含暂存的新边）
+        :return: 循环的路径 [组分, 使用者, ..., 组分]，不会形成循环时为 None
+        """
+        if component == consumer:
+            return [component, consumer]
+        position = self.positions()
+        if component not in position or consumer not in position:
+            return None  # 不在实验中的试样没有下游
+        upper = position[component]
+        if position[consumer] > upper:
+            return None
+        parent, found = self._search(consumer, upper, successors or self.successors, lambda other: other < upper)
+        return None if found is None else self._path(parent, found, component)
+
+    def insert_edge(self, component, consumer, successors=None, predecessors=None):
+        """
+        加入 组分 -> 使用者 这条边之前调用：会形成循环时抛出 CycleError；否则在需要时调整顺序，使组分排在使用者之前
+        :param successors: 同 find_cycle
+        :param predecessors: predecessors(trial名) 给出它的组分，默认为当前的 composite
+        :raises CycleError: 使用者已经（直接或间接）用到了组分
+        """
+        if component == consumer:
+            raise CycleError([component, consumer])
+        position = self.positions()
+        for name in (component, consumer):
+            if name not in position:
+                position[name] = self._next
+                self._next += 1
+                self._ordered = None
+        lower, upper = position[consumer], position[component]
+        if lower > upper:
+            return
+        forward, found = self._search(consumer, upper, successors or self.successors, lambda other: other < upper)
+        if found is not None:
+            raise CycleError(self._path(forward, found, component))
+        backward, _ = self._search(component, None, predecessors or self.composite_of, lambda other: other > lower)
+        # 上游部分整体移到下游部分之前，两部分内部保持原有的先后，占用的仍是原来那些位置
+        moved = sorted(backward, key=position.__getitem__) + sorted(forward, key=position.__getitem__)
+        for name, slot in zip(moved, sorted(position[name] for name in moved)):
+            position[name] = slot
+        self._ordered = None
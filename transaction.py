@@ -0,0 +1,269 @@
+import inventory
+from metrics import logger
+from topo_order import CycleError, find_path
+
+
+class CompositeTransaction:
+    """
+    组分关系的批量修改（change set）：add / remove / set_composite / detach 先只暂存，commit 时
+      1. 按顺序在普通 dict 上算出每个涉及的试样最终的 composite（每个名字只在 all_trials 中查一次），并检查组分存在、用量足够；
+      2. 新加的组分关系不能形成循环（有 the_exp 时按其 composite_order 在线检查，见 topo_order.py）；
+         把变化按组分汇总，每个试样的 composite、每个组分的 master 只整体重建一次，existing_amount 一次加减净变化；
+      3. 应用中途出错时按撤销记录恢复已改动的 composite / master / existing_amount，再抛出原来的异常
+    检查不通过时不做任何修改。用作 with 块时正常结束即 commit，块中抛出异常则放弃暂存的修改：
+        with the_exp.transaction() as tx:
+            tx.set_composite("T1", {"S1": 10.0})
+            tx.add("T2", "S1", 5.0)
+    """
+
+    def __init__(self, all_trials, the_exp=None, check_inventory=False, require_existing=False):
+        """
+        :param all_trials: 全trial查表，格式（键为trial的名字，值为列表（0：id，1：路由）
+        :param the_exp: 所属的 Experiment，给定时 commit 后把 composite 有变化的试样标记为dirty
+        :param check_inventory: 是否先检查有限量试样的总用量（inventory.check_submission，需要 the_exp）
+        :param require_existing: 是否要求 existing_amount 不为 -1 的组分剩余量足够（与 add_to_composite 的默认行为相同）
+        """
+        self.all_trials = all_trials
+        self.the_exp = the_exp
+        self.check_inventory = check_inventory
+        self.require_existing = require_existing
+        self.operations = []
+        self.changed = None
+        self._undo = []  # 最近一次 commit 的撤销记录 [(试样, 属性, 原值)]，供 revert 使用
+        self._given = {}  # 直接传入的、可能尚未登记的试样
+
+    def _name(self, the_trial):
+        if isinstance(the_trial, str):
+            return the_trial
+        self._given[the_trial.name] = the_trial
+        return the_trial.name
+
+    def add(self, trial_name, component, amount):
+        """给 trial_name 的组分 component 增加用量（没有则新加）"""
+        self.operations.append(("add", self._name(trial_name), component, float(amount)))
+        return self
+
+    def remove(self, trial_name, component, amount=-1):
+        """减少 trial_name 中组分 component 的用量，amount 为 -1 或不小于现有用量时移除该组分"""
+        self.operations.append(("remove", self._name(trial_name), component, amount))
+        return self
+
+    def set_composite(self, trial_name, composite_dict):
+        """
+        把试样的组分整体改为 composite_dict（组分名：用量），非数字的用量跳过；
+        用量没变的组分保持原来的位置，其余按 composite_dict 的顺序排在后面（与逐个先删后加的结果相同）
+        """
+        new_composite = {}
+        for composite_name, composite_num in composite_dict.items():
+            if not isinstance(composite_num, (int, float)):
+                logger.warning("%s 的用量 %s 不是数字，已跳过", composite_name, composite_num)
+                continue
+            new_composite[composite_name] = float(composite_num)
+        self.operations.append(("set", self._name(trial_name), new_composite))
+        return self
+
+    def detach(self, trial_name):
+        """解除试样与上下游的全部组分关系：清空它的 composite，并从使用它的试样的 composite 中去掉它"""
+        self.operations.append(("detach", self._name(trial_name)))
+        return self
+
+    def discard(self):
+        """放弃暂存的修改"""
+        self.operations = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
+        return False
+
+    def _check_cycles(self, new_edges, old, final, resolve):
+        """
+        逐条检查新加的边（组分, 使用者）：检查时的图为原有的边去掉本次移除的，再加上已经检查过的新边；
+        commit 之后失败时 composite_order 中多出的约束不影响它仍是一个合法的拓扑顺序
+        :raises CycleError: 某条新边会形成循环
+        """
+        current, added = {}, {}
+
+        def components_of(name):
+            composite = current.get(name)
+            if composite is None:
+                if name in final:
+                    after = final[name]
+                    composite = {component for component in old[name] if component in after}
+                else:
+                    the_trial = resolve(name)
+                    composite = set(the_trial.composite.keys()) if the_trial is not None else set()
+                current[name] = composite
+            return composite
+
+        def successors(name):
+            the_trial = resolve(name)
+            candidates = list(the_trial.master) if the_trial is not None else []
+            candidates.extend(added.get(name, ()))
+            return [consumer for consumer in candidates if name in components_of(consumer)]
+
+        order = self.the_exp.composite_order if self.the_exp is not None else None
+        for component, consumer in new_edges:
+            if order is not None:
+                order.insert_edge(component, consumer, successors, components_of)
+            else:
+                path = find_path(consumer, component, successors)
+                if path is not None:
+                    raise CycleError([component] + path)
+            components_of(consumer).add(component)
+            added.setdefault(component, []).append(consumer)
+
+    def revert(self):
+        """
+        撤销已经 commit 的修改（恢复 composite / master / existing_amount），
+        用于同一次提交中后面的步骤出错、需要整体回滚的情况（如 Experiment.new_exp_from_2d_array）
+        """
+        undo, self._undo = self._undo, []
+        for the_trial, attribute, value in reversed(undo):
+            setattr(the_trial, attribute, value)
+        if undo and self.the_exp is not None:
+            self.the_exp.mark_dirty(*(self.changed or ()))
+
+    def commit(self):
+        """
+        一次应用全部暂存的修改
+        :return: composite 有变化的试样名列表（同 self.changed）
+        :raises ValueError: 试样或组分不存在、要移除的组分不在 composite 中、用量不足（含 inventory.InventoryError）、
+                            形成循环依赖（topo_order.CycleError）
+        """
+        operations, self.operations = self.operations, []
+        trials = dict(self._given)
+        all_trials = self.all_trials
+
+        def resolve(name):
+            the_trial = trials.get(name)
+            if the_trial is None:
+                entry = all_trials.get(name)
+                if entry is None:
+                    return None
+                the_trial = trials[name] = entry[1]
+            return the_trial
+
+        old, final = {}, {}
+
+        def composite_of(name):
+            composite = final.get(name)
+            if composite is None:
+                the_trial = resolve(name)
+                if the_trial is None:
+                    raise ValueError(f"试样 {name} 未找到")
+                old[name] = dict(the_trial.composite.items())
+                composite = final[name] = dict(old[name])
+            return composite
+
+        for operation in operations:
+            kind, name = operation[0], operation[1]
+            composite = composite_of(name)
+            if kind == "add":
+                component, amount = operation[2], operation[3]
+                composite[component] = composite.get(component, 0.0) + amount
+            elif kind == "remove":
+                component, amount = operation[2], operation[3]
+                if component not in composite:
+                    raise ValueError(f"{component} does not compose the trial {name}")
+                if amount == -1 or composite[component] <= amount:
+                    del composite[component]
+                else:
+                    composite[component] -= amount
+            elif kind == "set":
+                new_composite = operation[2]
+                if composite == new_composite:
+                    continue
+                kept = {key: value for key, value in composite.items() if new_composite.get(key) == value}
+                if kept:
+                    for key, value in new_composite.items():
+                        if key not in kept:
+                            kept[key] = value
+                    final[name] = kept
+                else:
+                    final[name] = dict(new_composite)
+            else:  # detach
+                composite.clear()
+                the_trial = resolve(name)
+                for consumer in set(the_trial.master.keys()) | {key for key, value in final.items() if name in value}:
+                    if consumer != name and (consumer in final or resolve(consumer) is not None):
+                        composite_of(consumer).pop(name, None)
+
+        changed = [name for name in final if final[name] != old[name]]
+        self.changed = changed
+        if not changed:
+            return changed
+
+        # 按组分汇总：{组分名: {使用者: 新用量，移除为 None}}，同时累计组分用量的净变化
+        master_updates, drawn, new_edges = {}, {}, []
+        for name in changed:
+            before, after = old[name], final[name]
+            for component, amount in before.items():
+                if component not in after:
+                    updates = master_updates.get(component)
+                    if updates is None:
+                        updates = master_updates[component] = {}
+                    updates[name] = None
+                    drawn[component] = drawn.get(component, 0.0) - amount
+            for component, amount in after.items():
+                previous = before.get(component)
+                if previous != amount:
+                    updates = master_updates.get(component)
+                    if updates is None:
+                        if resolve(component) is None:
+                            raise ValueError(f"组分 {component} 未找到，请检查输入数据")
+                        updates = master_updates[component] = {}
+                    updates[name] = amount
+                    drawn[component] = drawn.get(component, 0.0) + amount - (previous or 0.0)
+                    if previous is None:
+                        new_edges.append((component, name))
+        if new_edges:
+            self._check_cycles(new_edges, old, final, resolve)
+
+        # existing_amount 为 -1（无限量）或已不存在的组分不记用量
+        for component in list(drawn):
+            the_trial = resolve(component)
+            if the_trial is None or the_trial.existing_amount == -1:
+                del drawn[component]
+            elif self.require_existing and drawn[component] > 0 and the_trial.existing_amount < drawn[component]:
+                raise ValueError(f"试样 {component} 的剩余量 {the_trial.existing_amount:g} 不足，需要 {drawn[component]:g}")
+        if self.check_inventory and self.the_exp is not None:
+            inventory.check_submission(self.the_exp, {name: final[name] for name in changed}, full_table=False)
+
+        undo = []
+        try:
+            for name in changed:
+                the_trial = trials[name]
+                undo.append((the_trial, "composite", old[name]))
+                the_trial.composite = final[name]
+            for component, updates in master_updates.items():
+                the_trial = resolve(component)
+                if the_trial is None:
+                    continue  # 指向已不存在的试样的残留条目，只从 composite 中去掉
+                undo.append((the_trial, "master", the_trial.master))
+                new_master = dict(the_trial.master.items())
+                for consumer, amount in updates.items():
+                    if amount is None:
+                        new_master.pop(consumer, None)
+                    else:
+                        new_master[consumer] = amount
+                the_trial.master = new_master
+                if component in drawn:
+                    undo.append((the_trial, "existing_amount", the_trial.existing_amount))
+                    the_trial.existing_amount -= drawn[component]
+        except BaseException:
+            for the_trial, attribute, value in reversed(undo):
+                setattr(the_trial, attribute, value)
+            logger.error("CompositeTransaction: 应用修改时出错，已回滚 %d 项", len(undo))
+            raise
+
+        self._undo = undo
+        if self.the_exp is not None:
+            self.the_exp.mark_dirty(*changed)
+        logger.debug("CompositeTransaction: %d 个试样的组分有变化，更新了 %d 个组分的 master", len(changed), len(master_updates))
+        return changed
@@ -1,10 +1,18 @@
 import json
 import os
 from substance import substance
+from compact import CompactMap
+from metrics import logger
+from transaction import CompositeTransaction
+from topo_order import CycleError, find_path
 from collections import defaultdict, deque
 from typing import Dict, List, Optional, Tuple, Any
 
 class trial:
+    # 用 __slots__ 代替实例 __dict__；登记到 Experiment 后 composite/master/substance_conc 存为 CompactMap
+    # （键为实验名字驻留表中的整数id，值在 array('d') 中），对外仍以 dict 的接口读写，赋值时传入普通 dict 即可
+    __slots__ = ("name", "_info", "_composite", "_master", "_substance_conc", "existing_amount", "total_amount",
+                 "stock", "solvent", "id", "exp_name")
 
     def __init__(self, name="", exp_name = "", composite=None, master=None, substance_conc=None, total_amount = 0, id = "", existing_amount = 0, stock=False, solvent = False, info=None):
         """
@@ -21,12 +29,13 @@ class trial:
         :param total_amount: float数字，总共的数量，一般是体积，-1则为无限量
         :param stock: 布尔值，表示是否为实验最初制备的试样，没有composite，仅有substance_conc
         :param solvent: 布尔值，表示是否为实验中使用的试剂，没有composite，substance_conc可以自定（如摩尔数量每体积）
+        尚未登记到 Experiment 的试样用普通 dict 保存，登记时由 bind_name_tables 转为紧凑存储
         """
         self.name = name
-        self.info = info if info is not None else {}
-        self.composite = composite if composite is not None else {}
-        self.master = master if master is not None else {}
-        self.substance_conc = substance_conc if substance_conc is not None else {}
+        self._info = info if info else None
+        self._composite = dict(composite) if composite else {}
+        self._master = dict(master) if master else {}
+        self._substance_conc = dict(substance_conc) if substance_conc else {}
         self.existing_amount = float(existing_amount)
         self.total_amount = float(total_amount)
         self.stock = bool(stock)
@@ -34,6 +43,91 @@ class trial:
         self.id = id
         self.exp_name = exp_name
 
+    @property
+    def info(self):
+        # 大多数试样没有 info，第一次访问时才创建字典
+        if self._info is None:
+            self._info = {}
+        return self._info
+
+    @info.setter
+    def info(self, value):
+        self._info = value if value else None
+
+    @property
+    def composite(self):
+        return self._composite
+
+    @composite.setter
+    def composite(self, value):
+        self._composite = trial._same_storage(self._composite, value)
+
+    @property
+    def master(self):
+        return self._master
+
+    @master.setter
+    def master(self, value):
+        self._master = trial._same_storage(self._master, value)
+
+    @property
+    def substance_conc(self):
+        return self._substance_conc
+
+    @substance_conc.setter
+    def substance_conc(self, value):
+        self._substance_conc = trial._same_storage(self._substance_conc, value)
+
+    @staticmethod
+    def _same_storage(current, value):
+        """按当前的存储方式（普通 dict 或某张驻留表上的 CompactMap）保存新赋的值"""
+        if isinstance(current, CompactMap):
+            return CompactMap(current.table, value)
+        return dict(value.items()) if value else {}
+
+    @staticmethod
+    def _rename_key(mapping, old_key, new_key):
+        """把 mapping 中的键 old_key 改为 new_key；CompactMap 原地改名（大映射不必重建索引）"""
+        if isinstance(mapping, CompactMap):
+            mapping.rename(old_key, new_key)
+        else:
+            mapping[new_key] = mapping.pop(old_key)
+
+    def bind_name_tables(self, trial_names, substance_names):
+        """
+        改为以所属 Experiment 的名字驻留表紧凑存储，已绑定到这两张表时不做任何事
+        :param trial_names: composite/master 键所用的 NameTable
+        :param substance_names: substance_conc 键所用的 NameTable
+        """
+        if isinstance(self._composite, CompactMap) and self._composite.table is trial_names \
+                and self._substance_conc.table is substance_names:
+            return
+        self._composite = CompactMap(trial_names, self._composite)
+        self._master = CompactMap(trial_names, self._master)
+        self._substance_conc = CompactMap(substance_names, self._substance_conc)
+
+    def set_compact_maps(self, composite, master, substance_conc):
+        """直接放入已经构建好的 CompactMap（快照加载时使用，三者须已在所属实验的驻留表上）"""
+        self._composite = composite
+        self._master = master
+        self._substance_conc = substance_conc
+
+    def to_dict(self):
+        """以普通 dict 的形式导出全部属性，键与 __init__ 的参数一致"""
+        return {
+            "name": self.name,
+            "exp_name": self.exp_name,
+            "composite": dict(self._composite.items()),
+            "master": dict(self._master.items()),
+            "substance_conc": dict(self._substance_conc.items()),
+            "total_amount": self.total_amount,
+            "id": self.id,
+            "existing_amount": self.existing_amount,
+            "stock": self.stock,
+            "solvent": self.solvent,
+            "info": dict(self._info) if self._info else {},
+        }
+
     @staticmethod
     def create_stock(stock_name="", substance_conc=None, total_amount = -1, exp_name = "", solvent = False, id = "", s_info=None):
         """
@@ -52,13 +146,10 @@ class trial:
 
     def compose(self, dict_of_trial, all_trials):
         """compose things from other trials, create trial object
-        把自己一个个都拿出来，再按新的给的字典一个个加一遍
+        把composite整体换成新给的字典，经 CompositeTransaction 一次应用：组分不存在或剩余量不够时不做任何修改
         :param dict_of_trial: key:name of other trial, value: amount to add in this trial
         """
-        for trial_name, trial_number in self.composite.items():
-            self.remove_from_composite(all_trials[trial_name], trial_number, all_trials)
-        for trial_name, trial_number in dict_of_trial.items():
-            self.add_to_composite(all_trials[trial_name], trial_number, all_trials)
+        CompositeTransaction(all_trials, require_existing=True).set_composite(self, dict_of_trial).commit()
 
     def is_regular_sample(self):
         """可能可以扩展"""
@@ -75,14 +166,24 @@ class trial:
         pass
 
 
-    def add_to_composite(self, trial_name, amount, all_trials, regardless_of_negative_amount = False):
+    def add_to_composite(self, trial_name, amount, all_trials, regardless_of_negative_amount = False, order=None):
         """
         加入，不含重算浓度函数，但master已经确保搞定
+        新的组分关系先检查不会形成循环（trial_name 不能已经直接或间接用到了本试样），否则抛出 topo_order.CycleError，不做修改
         :param trial_name:名字
         :param amount:
         :param all_trials:全trial查表，格式（键为trial的名字，值为列表（0：id，1：路由）
+        :param order: 所属实验的 composite_order（topo_order.TopologicalOrder），给定时按它检查并维护顺序，否则从本试样沿master向下游搜索
         :return:
         """
+        if trial_name not in self.composite:
+            if order is not None:
+                order.insert_edge(trial_name, self.name)
+            else:
+                path = find_path(self.name, trial_name,
+                                 lambda name: all_trials[name][1].master if name in all_trials else ())
+                if path is not None:
+                    raise CycleError([trial_name] + path)
         if regardless_of_negative_amount:
             if all_trials[trial_name][1].existing_amount == -1:
                 if trial_name in self.composite:
@@ -121,7 +222,7 @@ class trial:
                     all_trials[trial_name][1].existing_amount -= amount
                 else:
                     raise ValueError("not enough to add")
-        print(f"trial: add_to_composite trial: {trial_name} added to: {self.name} amount: {amount}, current_self_composite: {self.composite}")
+        logger.debug("trial: add_to_composite trial: %s added to: %s amount: %s, current_self_composite: %s", trial_name, self.name, amount, self.composite)
 
     def remove_from_composite(self, trial_name, amount, all_trials:Dict[str,List[Any]]):
         """
@@ -154,13 +255,17 @@ class trial:
         self.name = new_name
 
         for target_name, amount in self.composite.items():
+            if target_name not in all_trials:
+                continue
             the_trial = all_trials[target_name][1]
-            the_trial.master[new_name] = the_trial.master[old_name]
-            del the_trial.master[old_name]
+            if old_name in the_trial.master:
+                trial._rename_key(the_trial.master, old_name, new_name)
         for target_name, amount in self.master.items():
+            if target_name not in all_trials:
+                continue
             the_trial = all_trials[target_name][1]
-            the_trial.composite[new_name] = the_trial.composite[old_name]
-            del the_trial.composite[old_name]
+            if old_name in the_trial.composite:
+                trial._rename_key(the_trial.composite, old_name, new_name)
 
     def update_substance_conc(self, all_trials, assigned_amount=None):
         """
@@ -191,7 +296,7 @@ class trial:
 
     def save_to_txt(self, filename):
         """将对象的属性数据保存为 JSON 文件"""
-        data = self.__dict__.copy()
+        data = self.to_dict()
         with open(filename, 'w') as f:
             json.dump(data, f, indent=2)
 